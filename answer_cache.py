@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+答案缓存模块 - 对相同问题、相同检索上下文的生成结果进行缓存
+
+@remarks LLM生成是整个问答流程中最昂贵的一步。问题（规范化后）、检索到的文本块ID、
+         索引版本和模型都相同时，生成的提示完全相同，可以直接复用上一次的答案。
+         内存中按LRU淘汰并支持TTL过期，可选地写入SQLite，重启后仍然有效
+@author AI Assistant
+@version 1.0
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """
+    规范化问题文本：全角转半角、统一大小写、合并空白
+
+    @param question - 用户问题
+    @returns 规范化后的问题
+    @example
+    ```python
+    normalize_question("  张三  在哪个部门？ ")  # "张三 在哪个部门?"
+    ```
+    """
+    text = unicodedata.normalize("NFKC", question).casefold()
+    return _WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+def answer_cache_key(question: str, chunk_ids: Sequence[str], index_version: str, model: str) -> str:
+    """
+    计算答案缓存的键
+
+    @param question - 用户问题（内部会规范化）
+    @param chunk_ids - 检索到的文本块ID，顺序与提示中的上下文顺序一致
+    @param index_version - 向量索引版本
+    @param model - 生成答案的模型名称
+    @returns 十六进制摘要
+    """
+    payload = json.dumps(
+        [normalize_question(question), list(chunk_ids), index_version, model],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def iter_replay_chunks(answer: str, chunk_chars: int = 32) -> Iterator[str]:
+    """
+    将缓存的答案切成小段，用于在流式接口中回放
+
+    @param answer - 完整答案
+    @param chunk_chars - 每段的字符数
+    @returns 答案片段的迭代器
+    """
+    for start in range(0, len(answer), chunk_chars):
+        yield answer[start:start + chunk_chars]
+
+
+class AnswerCache:
+    """
+    带TTL和LRU淘汰的答案缓存，可选SQLite持久化
+
+    @remarks 内存层保存最近使用的 max_entries 条答案；配置了 db_path 时，
+             写入同时落盘，内存未命中时再查磁盘。过期条目在读取时丢弃。
+             所有方法都是线程安全的
+    @example
+    ```python
+    cache = AnswerCache(ttl_seconds=600, max_entries=512)
+    key = answer_cache_key(question, chunk_ids, index_version, "qwen3:4b")
+    answer = cache.get(key)
+    if answer is None:
+        answer = generate(...)
+        cache.put(key, answer)
+    ```
+    """
+
+    def __init__(self, ttl_seconds: float = 600, max_entries: int = 512, db_path: Optional[Path] = None):
+        """
+        初始化答案缓存
+
+        @param ttl_seconds - 答案的有效期（秒），0或负数表示永不过期
+        @param max_entries - 内存（以及磁盘）中保存的答案数量上限
+        @param db_path - SQLite数据库路径，None表示只使用内存
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (created_at, answer)
+        self._lock = threading.Lock()
+
+        self._conn = None
+        if db_path is not None:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " key TEXT PRIMARY KEY,"
+                " answer TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_used ON answers(last_used)")
+            self._conn.commit()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        """
+        判断条目是否已过期
+
+        @param created_at - 条目写入时间
+        @param now - 当前时间
+        @returns 已过期返回True
+        """
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        查询缓存的答案
+
+        @param key - 缓存键，见 answer_cache_key()
+        @returns 命中时返回答案，否则返回None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT created_at, answer FROM answers WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = (row[0], row[1])
+                    self._remember(key, entry)
+
+            if entry is not None and self._expired(entry[0], now):
+                self._discard(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            if self._conn is not None:
+                self._conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, answer: str):
+        """
+        写入答案
+
+        @param key - 缓存键，见 answer_cache_key()
+        @param answer - 生成的答案
+        @returns 无返回值
+        """
+        now = time.time()
+        with self._lock:
+            self._remember(key, (now, answer))
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO answers (key, answer, created_at, last_used) VALUES (?, ?, ?, ?)",
+                    (key, answer, now, now)
+                )
+                self._conn.execute(
+                    "DELETE FROM answers WHERE key NOT IN "
+                    "(SELECT key FROM answers ORDER BY last_used DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+                self._conn.commit()
+
+    def _remember(self, key: str, entry: tuple):
+        """
+        写入内存层并按LRU淘汰（调用方需持有锁）
+
+        @param key - 缓存键
+        @param entry - (写入时间, 答案)
+        @returns 无返回值
+        """
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _discard(self, key: str):
+        """
+        删除一个条目（调用方需持有锁）
+
+        @param key - 缓存键
+        @returns 无返回值
+        """
+        self._entries.pop(key, None)
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self):
+        """
+        清空全部答案
+
+        @returns 无返回值
+        """
+        with self._lock:
+            self._entries.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM answers")
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存的命中统计
+
+        @returns 包含条目数、命中/未命中次数和命中率的字典
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "persistent": self._conn is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None
+            }
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+向量索引类型对比脚本
+
+@remarks 在同一批向量上构建 flat / ivf_flat / hnsw / ivf_pq 索引（可选 fp16/sq8/pq 量化），
+         以精确检索（flat）的结果为标准，输出每个向量占用的索引字节数、不同 nprobe / efSearch 下的
+         recall@k（量化索引同时给出精确重排后的结果）与每次查询的耗时，用于选择 VECTOR_INDEX_TYPE、
+         VECTOR_QUANTIZATION、IVF_NPROBE、HNSW_EF_SEARCH 和 VECTOR_RERANK_FACTOR。
+         向量可以取自现有的向量库，也可以随机生成
+@author AI Assistant
+@version 1.0
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from vector_index import ChunkVectorStore, choose_index_spec, is_lossy_spec
+
+
+def load_store_vectors(store_dir: Path) -> np.ndarray:
+    """
+    从现有向量库中读取全部向量（量化索引从段中读取原始向量，其余仅支持 flat / hnsw 索引）
+
+    @param store_dir - 向量库目录（vector_store/chunk_store）
+    @returns 形状为 (N, dim) 的 float32 矩阵
+    """
+    store = ChunkVectorStore.load(store_dir)
+    segment_vectors = [segment.vectors for segment in store._segments]
+    if segment_vectors and all(vectors is not None for vectors in segment_vectors):
+        return np.concatenate(segment_vectors)
+    if not isinstance(store.index, faiss.IndexIDMap) or is_lossy_spec(store.index_spec):
+        raise ValueError(f"索引 {store.index_spec} 不保存原始向量，请改用 --synthetic")
+    return store.index.index.reconstruct_n(0, store.index.ntotal)
+
+
+def create_synthetic_vectors(count: int, dim: int, seed: int = 42) -> np.ndarray:
+    """
+    生成带聚类结构的随机向量（比均匀分布更接近真实的文本嵌入）
+
+    @param count - 向量数量
+    @param dim - 向量维度
+    @param seed - 随机种子
+    @returns 形状为 (count, dim) 的 float32 矩阵
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(count // 100, 1), dim)).astype(np.float32)
+    labels = rng.integers(0, len(centers), count)
+    return centers[labels] + 0.3 * rng.standard_normal((count, dim)).astype(np.float32)
+
+
+def build_index(spec: str, vectors: np.ndarray) -> tuple:
+    """
+    构建并训练索引
+
+    @param spec - index_factory 描述串
+    @param vectors - 全部向量
+    @returns (索引, 构建耗时秒数)
+    """
+    start = time.perf_counter()
+    index = faiss.index_factory(vectors.shape[1], spec)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add_with_ids(vectors, np.arange(len(vectors), dtype=np.int64))
+    return index, time.perf_counter() - start
+
+
+def evaluate(index: faiss.Index, queries: np.ndarray, ground_truth: np.ndarray, k: int,
+             vectors: np.ndarray = None, rerank_factor: int = 0) -> tuple:
+    """
+    计算 recall@k 和每次查询的平均耗时
+
+    @param index - 待测索引
+    @param queries - 查询向量
+    @param ground_truth - 精确检索的前k个结果
+    @param k - 返回结果数
+    @param vectors - 原始向量（精确重排时使用）
+    @param rerank_factor - 取 k*rerank_factor 个候选再用原始向量重排，0表示不重排
+    @returns (recall@k, 每次查询毫秒数)
+    """
+    found = []
+    start = time.perf_counter()
+    for query in queries:
+        # 逐条查询，与线上每个问题单独检索的方式一致
+        _, ids = index.search(query[None, :], k * max(rerank_factor, 1))
+        candidates = ids[0][ids[0] >= 0]
+        if rerank_factor > 1:
+            distances = ((vectors[candidates] - query) ** 2).sum(axis=1)
+            candidates = candidates[np.argsort(distances, kind="stable")]
+        found.append(candidates[:k])
+    elapsed = time.perf_counter() - start
+    hits = sum(len(set(row.tolist()) & set(truth.tolist())) for row, truth in zip(found, ground_truth))
+    return hits / (len(queries) * k), elapsed / len(queries) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对比不同向量索引类型的召回率与查询延迟")
+    parser.add_argument("--store", type=Path, default=Path("./vector_store/chunk_store"), help="现有向量库目录")
+    parser.add_argument("--synthetic", type=int, default=0, help="改用随机生成的向量数量")
+    parser.add_argument("--dim", type=int, default=384, help="随机向量的维度")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--k", type=int, default=5, help="每次检索返回的结果数")
+    parser.add_argument("--types", nargs="+", default=["flat", "ivf_flat", "hnsw"], help="对比的索引类型")
+    parser.add_argument("--quantization", nargs="+", default=["none", "fp16", "sq8", "pq"], help="对比的向量存储方式")
+    parser.add_argument("--rerank-factor", type=int, default=4, help="量化索引精确重排的候选倍数")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64], help="IVF 的 nprobe 取值")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256], help="HNSW 的 efSearch 取值")
+    args = parser.parse_args()
+
+    vectors = create_synthetic_vectors(args.synthetic, args.dim) if args.synthetic else load_store_vectors(args.store)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+
+    flat_index, flat_build = build_index("IDMap2,Flat", vectors)
+    _, ground_truth = flat_index.search(queries, args.k)
+    _, flat_ms = evaluate(flat_index, queries, ground_truth, args.k)
+
+    print(f"📊 向量索引对比：{len(vectors):,} 个向量，维度 {vectors.shape[1]}，{len(queries)} 次查询，k={args.k}")
+    print(f"{'索引':>24} {'参数':>14} {'字节/向量':>10} {'构建(秒)':>10} {f'recall@{args.k}':>10} "
+          f"{'毫秒/查询':>10} {'重排recall':>10} {'重排毫秒':>10}")
+    flat_bytes = len(faiss.serialize_index(flat_index)) / len(vectors)
+    print(f"{'IDMap2,Flat':>24} {'-':>14} {flat_bytes:>10.1f} {flat_build:>10.2f} {1.0:>10.3f} {flat_ms:>10.3f}")
+    for index_type in args.types:
+        for quantization in args.quantization:
+            spec = choose_index_spec(index_type, len(vectors), vectors.shape[1], quantization)
+            if spec == "IDMap2,Flat":
+                continue
+            index, build_seconds = build_index(spec, vectors)
+            bytes_per_vector = len(faiss.serialize_index(index)) / len(vectors)
+            if index_type == "hnsw":
+                hnsw_index = faiss.downcast_index(index.index)
+                settings = [("efSearch", value) for value in args.ef_search]
+            elif index_type == "flat":
+                settings = [("-", None)]
+            else:
+                settings = [("nprobe", value) for value in args.nprobe]
+
+            for name, value in settings:
+                if name == "efSearch":
+                    hnsw_index.hnsw.efSearch = value
+                elif name == "nprobe":
+                    faiss.extract_index_ivf(index).nprobe = value
+                recall, ms = evaluate(index, queries, ground_truth, args.k)
+                rerank = "-"
+                if is_lossy_spec(spec) and args.rerank_factor > 1:
+                    rerank_recall, rerank_ms = evaluate(index, queries, ground_truth, args.k, vectors, args.rerank_factor)
+                    rerank = f"{rerank_recall:>10.3f} {rerank_ms:>10.3f}"
+                label = f"{name}={value}" if value is not None else "-"
+                print(f"{spec:>24} {label:>14} {bytes_per_vector:>10.1f} {build_seconds:>10.2f} {recall:>10.3f} "
+                      f"{ms:>10.3f} {rerank:>10}")
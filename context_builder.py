@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+上下文组装模块 - 在token预算内把检索结果和对话历史拼进提示
+
+@remarks CPU上的Ollama预填充（prefill）耗时与提示长度成正比，不加限制地拼接检索结果和
+         对话历史会直接拉长首个token的等待时间。这里：
+         1. 按目标模型的分词器计数（安装了 tokenizers 且能加载分词器时），否则使用 estimate_tokens 估算；
+         2. 按检索排名逐行装入检索结果，装不下的行跳过，排名靠后的文本块只装入能放下的部分；
+         3. 同一工作表的文本块只保留一次表头，重复的行去掉，超长单元格切分时
+            CHUNK_OVERLAP 留下的重叠前缀也会去掉；
+         4. 对话历史从最近的一轮向前保留，超出预算的早期轮次丢弃
+@author AI Assistant
+@version 1.0
+"""
+
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+from excel_ingest import ROW_SEPARATOR, estimate_tokens
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+# 检索结果之间（不同工作表之间）的分隔符
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+# 判定为切分重叠的最短公共前后缀（字符），避免把偶然相同的一两个字符当作重叠
+MIN_OVERLAP_CHARS = 8
+
+
+class TokenCounter:
+    """
+    目标模型的token计数器，分词器在首次计数时加载
+
+    @remarks 分词器名称为空、未安装 tokenizers 或加载失败（如离线）时使用 estimate_tokens 估算
+    @example
+    ```python
+    counter = TokenCounter("Qwen/Qwen3-4B")
+    counter.count("张三在哪个部门？")
+    ```
+    """
+
+    def __init__(self, tokenizer_name: Optional[str] = None):
+        """
+        初始化计数器（不立即加载分词器）
+
+        @param tokenizer_name - HuggingFace上的分词器名称，None或空表示只做估算
+        """
+        self.tokenizer_name = tokenizer_name or None
+        self._tokenizer = None
+        self._load_attempted = self.tokenizer_name is None or Tokenizer is None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        """
+        实际使用的计数方式
+
+        @returns 分词器名称，或 "estimate"
+        """
+        return self.tokenizer_name if self._get_tokenizer() is not None else "estimate"
+
+    def _get_tokenizer(self):
+        """
+        获取（必要时加载）分词器
+
+        @returns 分词器对象，不可用时返回None
+        """
+        if not self._load_attempted:
+            with self._lock:
+                if not self._load_attempted:
+                    try:
+                        self._tokenizer = Tokenizer.from_pretrained(self.tokenizer_name)
+                    except Exception as e:
+                        print(f"加载分词器 {self.tokenizer_name} 失败，改用估算的token数: {e}")
+                    self._load_attempted = True
+        return self._tokenizer
+
+    def count(self, text: str) -> int:
+        """
+        计算文本的token数量
+
+        @param text - 文本
+        @returns token数量
+        """
+        if not text:
+            return 0
+        tokenizer = self._get_tokenizer()
+        if tokenizer is None:
+            return estimate_tokens(text)
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def _trim_overlap(line: str, previous_lines: Sequence[str], max_overlap: int) -> str:
+    """
+    去掉与已装入行末尾重叠的前缀（超长单元格按字符切分时相邻两段的重叠部分）
+
+    @param line - 待装入的行
+    @param previous_lines - 同一行号已装入的片段
+    @param max_overlap - 可能的最大重叠字符数
+    @returns 去掉重叠前缀后的行
+    """
+    best = 0
+    for previous in previous_lines:
+        limit = min(max_overlap, len(previous), len(line) - 1)
+        for size in range(limit, max(best, MIN_OVERLAP_CHARS - 1), -1):
+            if previous.endswith(line[:size]):
+                best = size
+                break
+    return line[best:].lstrip() if best else line
+
+
+def build_context(documents: List[Document], token_budget: int, count_tokens: Callable[[str], int],
+                  overlap_chars: int = 0) -> Tuple[str, List[Document], Dict[str, Any]]:
+    """
+    在token预算内按排名装入检索结果
+
+    @remarks 文本块的第一行是表头，其余每行是一条记录（见 excel_ingest.iter_row_chunks）。
+             同一工作表的行合并到一个段落下、只保留一次表头，段落按首次出现的排名排列
+    @param documents - 按相关度从高到低排列的检索结果
+    @param token_budget - 上下文可用的token数，0或负数表示不限制
+    @param count_tokens - token计数函数
+    @param overlap_chars - 切分超长单元格时的重叠字符数（CHUNK_OVERLAP），0表示不检查重叠
+    @returns (上下文文本, 实际装入的文本块, 统计信息)
+    @example
+    ```python
+    context, used_docs, info = build_context(docs, 1024, TokenCounter().count, overlap_chars=50)
+    ```
+    """
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR)
+    newline_tokens = count_tokens(ROW_SEPARATOR)
+    sections: Dict[Tuple[str, str, str], List[str]] = {}
+    seen_lines = set()
+    fragments: Dict[Tuple, List[str]] = {}
+    used_docs = []
+    used_tokens = 0
+    info = {"budget": token_budget, "candidates": len(documents), "chunks_used": 0, "chunks_truncated": 0,
+            "chunks_dropped": 0, "duplicate_lines": 0, "overlap_chars_trimmed": 0}
+
+    def fits(tokens: int) -> bool:
+        return token_budget <= 0 or used_tokens + tokens <= token_budget
+
+    for doc in documents:
+        header, _, body = doc.page_content.partition(ROW_SEPARATOR)
+        if not body:
+            header, body = "", header
+        metadata = doc.metadata
+        section_key = (metadata.get("source_file", ""), metadata.get("sheet_name", ""), header)
+        row_key = None
+        if metadata.get("row_start") is not None and metadata.get("row_start") == metadata.get("row_end"):
+            # 单行的文本块可能是超长单元格切分出的片段，同一行号的片段之间可能有重叠
+            row_key = section_key + (metadata["row_start"],)
+
+        lines = sections.get(section_key)
+        added = 0
+        truncated = False
+        for line in body.split(ROW_SEPARATOR):
+            if not line.strip():
+                continue
+            if (section_key, line) in seen_lines:
+                info["duplicate_lines"] += 1
+                continue
+            text = line
+            if row_key is not None and overlap_chars > 0 and row_key in fragments:
+                text = _trim_overlap(line, fragments[row_key], overlap_chars)
+                if not text:
+                    info["duplicate_lines"] += 1
+                    continue
+            # 新段落需要分隔符和表头，已有段落只需要换行
+            if lines is None:
+                cost = (separator_tokens if sections else 0) + count_tokens(header) + newline_tokens
+            else:
+                cost = newline_tokens
+            cost += count_tokens(text)
+            if not fits(cost):
+                truncated = True
+                continue
+            if lines is None:
+                lines = sections[section_key] = []
+            info["overlap_chars_trimmed"] += len(line) - len(text)
+            lines.append(text)
+            seen_lines.add((section_key, line))
+            if row_key is not None:
+                fragments.setdefault(row_key, []).append(line)
+            used_tokens += cost
+            added += 1
+
+        if added:
+            used_docs.append(doc)
+            info["chunks_used"] += 1
+            if truncated:
+                info["chunks_truncated"] += 1
+        elif truncated:
+            info["chunks_dropped"] += 1
+
+    info["context_tokens"] = used_tokens
+    parts = []
+    for (_, _, header), lines in sections.items():
+        parts.append(ROW_SEPARATOR.join([header] + lines) if header else ROW_SEPARATOR.join(lines))
+    return CONTEXT_SEPARATOR.join(parts), used_docs, info
+
+
+def fit_history(turns: Sequence[Tuple[str, str]], token_budget: int, count_tokens: Callable[[str], int]) -> str:
+    """
+    从最近的一轮开始向前保留对话历史，直到用完token预算
+
+    @remarks 最近一轮本身超出预算时只保留它的末尾部分（按字符比例截取）
+    @param turns - (角色标签, 内容) 列表，按时间顺序排列，如 [("用户", "..."), ("助手", "...")]
+    @param token_budget - 历史可用的token数，0或负数表示不限制
+    @param count_tokens - token计数函数
+    @returns 历史文本，每轮一行，格式为 "角色: 内容"
+    """
+    lines = [f"{role}: {content}" for role, content in turns]
+    if token_budget <= 0:
+        return "".join(f"{line}\n" for line in lines)
+
+    kept = []
+    used_tokens = 0
+    for line in reversed(lines):
+        tokens = count_tokens(line) + 1
+        if used_tokens + tokens > token_budget:
+            if not kept:
+                # 按比例截取末尾，再逐步缩短直到放得下
+                keep_chars = max(len(line) * token_budget // tokens, 1)
+                while keep_chars > 1 and count_tokens(line[-keep_chars:]) + 1 > token_budget:
+                    keep_chars = keep_chars * 9 // 10
+                kept.append("…" + line[-keep_chars:])
+            break
+        kept.append(line)
+        used_tokens += tokens
+    return "".join(f"{line}\n" for line in reversed(kept))
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+嵌入向量缓存模块 - 按内容寻址的持久化嵌入缓存
+
+@remarks 重建向量库时绝大多数文本块与上次逐字节相同，重新计算嵌入纯属浪费。
+         这里以 (嵌入模型, 文本SHA-256) 为键把向量以 float32 存入 SQLite，
+         重建和重新上传只需为真正新增的文本付出计算；
+         条目数超过上限时按最近使用时间淘汰（LRU）。
+         另外提供进程内的查询向量LRU缓存，重复的问题不再重新编码
+@author AI Assistant
+@version 1.0
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Sequence
+
+import numpy as np
+
+# 单条SQL语句中绑定参数的数量上限（SQLite默认999）
+_SQL_BATCH = 500
+
+
+def text_digest(text: str) -> str:
+    """
+    计算文本内容的SHA-256摘要
+
+    @param text - 文本
+    @returns 十六进制摘要
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    基于SQLite的嵌入向量缓存
+
+    @remarks 同一个数据库可以同时保存多个模型的向量，model_key 不同互不影响；
+             修改嵌入模型或归一化设置时应使用不同的 model_key。
+             所有方法都是线程安全的
+    @example
+    ```python
+    cache = EmbeddingCache(Path("./vector_store/embedding_cache.sqlite3"), "model|normalize=False")
+    found = cache.get_many(["你好"])  # {0: [...]} 或 {}
+    cache.put_many(["你好"], [[0.1, 0.2]])
+    ```
+    """
+
+    def __init__(self, db_path: Path, model_key: str, max_entries: int = 500_000):
+        """
+        打开（或创建）缓存数据库
+
+        @param db_path - SQLite数据库文件路径
+        @param model_key - 模型标识，包含模型名及影响向量结果的设置
+        @param max_entries - 缓存条目上限，超过时淘汰最久未使用的条目
+        """
+        self.db_path = Path(db_path)
+        self.model_key = model_key
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " digest TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, digest))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    def get_many(self, texts: Sequence[str]) -> Dict[int, List[float]]:
+        """
+        批量查询文本的缓存向量
+
+        @param texts - 文本列表
+        @returns 命中的 {文本下标: 向量}，未命中的下标不出现
+        """
+        digests = [text_digest(text) for text in texts]
+        unique_digests = list(dict.fromkeys(digests))
+        found = {}
+        with self._lock:
+            for start in range(0, len(unique_digests), _SQL_BATCH):
+                batch = unique_digests[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT digest, vector FROM embeddings WHERE model = ? AND digest IN ({placeholders})",
+                    [self.model_key, *batch]
+                ).fetchall()
+                for digest, blob in rows:
+                    found[digest] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND digest = ?",
+                    [(now, self.model_key, digest) for digest in found]
+                )
+                self._conn.commit()
+
+            result = {i: found[digest] for i, digest in enumerate(digests) if digest in found}
+            self.hits += len(result)
+            self.misses += len(texts) - len(result)
+        return result
+
+    def put_many(self, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        """
+        批量写入文本的向量，并在超出上限时淘汰旧条目
+
+        @param texts - 文本列表
+        @param vectors - 与文本一一对应的向量
+        @returns 无返回值
+        """
+        if not texts:
+            return
+        now = time.time()
+        rows = [
+            (self.model_key, text_digest(text), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, digest, vector, last_used) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """
+        淘汰最久未使用的条目，使总条目数不超过上限（调用方需持有锁）
+
+        @returns 无返回值
+        """
+        total = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = total - self.max_entries
+        if excess <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,)
+        )
+        self.evictions += excess
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存的命中统计
+
+        @returns 包含条目数、命中/未命中次数和命中率的字典
+        """
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings WHERE model = ?", (self.model_key,)
+            ).fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None
+        }
+
+    def close(self):
+        """
+        关闭数据库连接
+
+        @returns 无返回值
+        """
+        with self._lock:
+            self._conn.close()
+
+
+class QueryEmbeddingCache:
+    """
+    进程内的查询向量LRU缓存
+
+    @remarks 查询向量只取决于问题文本和嵌入模型，因此只有模型变化时才需要失效：
+             model_key 变化时自动清空。仪表盘反复提交的相同问题可以跳过一次模型编码
+    @example
+    ```python
+    cache = QueryEmbeddingCache(1024)
+    vector = cache.get_or_compute("model", "张三在哪个部门", embeddings.embed_query)
+    ```
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        """
+        初始化缓存
+
+        @param max_entries - 缓存的问题数量上限
+        """
+        self.max_entries = max_entries
+        self.model_key = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, model_key: str, text: str, compute: Callable[[str], List[float]]) -> List[float]:
+        """
+        获取问题的查询向量，未命中时调用 compute 计算并缓存
+
+        @param model_key - 嵌入模型标识，变化时清空缓存
+        @param text - 问题文本
+        @param compute - 计算查询向量的函数（在锁外调用）
+        @returns 查询向量
+        """
+        with self._lock:
+            if model_key != self.model_key:
+                self._entries.clear()
+                self.model_key = model_key
+            vector = self._entries.get(text)
+            if vector is not None:
+                self._entries.move_to_end(text)
+                self.hits += 1
+                return vector
+            self.misses += 1
+
+        vector = compute(text)
+        with self._lock:
+            if model_key == self.model_key:
+                self._entries[text] = vector
+                self._entries.move_to_end(text)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return vector
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取缓存的命中统计
+
+        @returns 包含条目数、命中/未命中次数和命中率的字典
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None
+            }
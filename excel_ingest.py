@@ -0,0 +1,821 @@
+# -*- coding: utf-8 -*-
+"""
+Excel摄取模块 - 读取工作簿并按行切分为适合嵌入的文本块
+
+@remarks 电子表格是按行组织的记录，按字符偏移切分会把一行拆成两半，
+         并且 CHUNK_OVERLAP 会把重复内容写进每个向量。这里按整行分组，
+         每个文本块都重复表头，并在元数据中记录行范围。
+         指定 table_dir 时解析结果按文件哈希保存为Parquet快照（见 table_engine），
+         文件未变化时直接从快照切分，不再解析Excel
+@author AI Assistant
+@version 1.0
+"""
+
+import hashlib
+import re
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from table_engine import TableWriter, read_snapshot, remove_tables
+
+# 中日韩统一表意文字，每个字大约对应一个token
+_CJK_RANGES = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_TOKEN_PATTERN = re.compile(rf"[{_CJK_RANGES}]|[^\W{_CJK_RANGES}]+|[^\w\s]")
+
+# 行与行之间、单元格之间的分隔符
+ROW_SEPARATOR = "\n"
+CELL_SEPARATOR = ", "
+# 从快照读取行文本时每批的行数
+SNAPSHOT_BATCH_ROWS = 50_000
+# iterrows 逐行构造 Series：新版pandas把只含字符串和空值的行推断为字符串类型，行中的 None、pd.NA 都变为 nan
+_ROW_INFERS_STRING = pd.Series(np.array(["", None], dtype=object)).dtype != object
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的token数量
+
+    @remarks 中文按每字一个token计算，英文/数字按每4个字符一个token计算，
+             标点符号各算一个token；无需加载分词器，适合在切分时对每行调用
+    @param text - 需要估算的文本
+    @returns 估算的token数量
+    @example
+    ```python
+    estimate_tokens("姓名: 张三")  # 5
+    ```
+    """
+    count = 0
+    for match in _TOKEN_PATTERN.finditer(text):
+        piece = match.group()
+        if len(piece) > 1:
+            count += (len(piece) + 3) // 4
+        else:
+            count += 1
+    return count
+
+
+def read_workbook(file_path: Path) -> Optional[Dict[str, pd.DataFrame]]:
+    """
+    读取工作簿的所有工作表
+
+    @param file_path - Excel文件路径（.xlsx 或 .xls）
+    @returns 工作表名到DataFrame的字典，读取失败时返回None
+    """
+    # 根据文件扩展名选择合适的引擎
+    file_extension = file_path.suffix.lower()
+    if file_extension == '.xls':
+        # 对于 .xls 文件，尝试使用 xlrd 引擎
+        try:
+            return pd.read_excel(file_path, sheet_name=None, engine='xlrd')
+        except ImportError:
+            print(f"    警告：缺少 xlrd 依赖，无法读取 .xls 文件 {file_path.name}")
+            print(f"    请运行: pip install xlrd")
+            return None
+        except Exception as e:
+            print(f"    使用 xlrd 引擎读取 .xls 文件失败，尝试默认引擎: {e}")
+            try:
+                return pd.read_excel(file_path, sheet_name=None)
+            except Exception as e2:
+                print(f"    使用默认引擎也失败: {e2}")
+                return None
+
+    # 对于 .xlsx 文件，使用默认引擎（openpyxl）
+    return pd.read_excel(file_path, sheet_name=None)
+
+
+def _whole_seconds(column: np.ndarray) -> bool:
+    """
+    判断datetime64列的所有值是否都是整秒（NaT除外）
+
+    @param column - datetime64类型的numpy数组
+    @returns 全部为整秒返回True
+    """
+    ticks = column.view("int64")
+    valid = ~np.isnat(column)
+    ticks_per_second = np.timedelta64(1, "s") // np.timedelta64(1, np.datetime_data(column.dtype)[0])
+    return bool((ticks[valid] % ticks_per_second == 0).all())
+
+
+def _column_values(series: pd.Series) -> np.ndarray:
+    """
+    按 df.values（对象类型）中的取值方式取出一列
+
+    @param series - 列数据
+    @returns numpy数组：低精度浮点提升为float64（iterrows 取出的是Python float），扩展类型（如 Int64）为对象数组
+    """
+    if not isinstance(series.dtype, np.dtype):
+        return series.to_numpy(dtype=object)
+    column = series.to_numpy()
+    if column.dtype.kind == "f" and column.dtype.itemsize < 8:
+        return column.astype(np.float64)
+    return column
+
+
+def _missing_cells(column: np.ndarray, dtype) -> np.ndarray:
+    """
+    对象数组中哪些单元格是空值（None、nan、pd.NA；NaT不算，iterrows 不会因它推断为字符串行）
+
+    @param column - 对象类型的numpy数组
+    @param dtype - 列原来的类型，字符串类型的列直接向量化判断
+    @returns 布尔数组
+    """
+    if isinstance(dtype, pd.StringDtype):
+        return pd.isna(column)
+    return np.fromiter((value is None or value is pd.NA or (isinstance(value, float) and value != value)
+                        for value in column), dtype=bool, count=len(column))
+
+
+def _string_rows(columns: List[np.ndarray], dtypes: List) -> np.ndarray:
+    """
+    找出 iterrows 会推断为字符串类型的行：至少有一个字符串，其余单元格都是空值（None、nan、pd.NA）
+
+    @param columns - _column_values() 取出的各列
+    @param dtypes - 各列原来的类型
+    @returns 布尔数组
+    """
+    row_count = len(columns[0])
+    has_string = np.zeros(row_count, dtype=bool)
+    has_other = np.zeros(row_count, dtype=bool)
+    for column, dtype in zip(columns, dtypes):
+        if column.dtype.kind == "f":
+            has_other |= ~np.isnan(column)
+        elif column.dtype.kind != "O":
+            # 整数、布尔、日期（包括NaT）都不是字符串
+            has_other[:] = True
+        elif isinstance(dtype, pd.StringDtype):
+            has_string |= ~pd.isna(column)
+        else:
+            is_string = np.fromiter((isinstance(value, str) for value in column), dtype=bool, count=row_count)
+            has_string |= is_string
+            has_other |= ~is_string & ~_missing_cells(column, dtype)
+    return has_string & ~has_other
+
+
+def sheet_row_texts(df: pd.DataFrame, skip_nan: bool = True) -> pd.Series:
+    """
+    按列向量化地把工作表的每一行转换为 "列名: 值, 列名: 值" 形式的文本
+
+    @remarks 与逐行 df.iterrows() 的结果逐字节一致：取值方式与 iterrows 相同
+             （全数值表会被统一提升为浮点数，float32 按Python float输出，可空整数的空值按所在行
+             输出为 nan 或 <NA>），对每个单元格取 str() 后去除首尾空格，
+             跳过空字符串（以及 skip_nan 时的 'nan'）。不同之处在于按列整体处理，
+             避免了每行构造Series和字符串反复拼接的开销
+    @param df - 工作表数据
+    @param skip_nan - 是否跳过值为 'nan' 的单元格
+    @returns 以行号（从0开始，不含表头）为索引的行文本Series，空行不包含在内
+    @example
+    ```python
+    df = pd.DataFrame({'姓名': ['张三', None], '部门': ['技术部', '市场部']})
+    sheet_row_texts(df).tolist()  # ['姓名: 张三, 部门: 技术部', '部门: 市场部']
+    ```
+    """
+    # 全数值表（包括可空整数）在 iterrows 中会被统一提升为同一数值类型（如整数变成 15000.0），这里保持一致；
+    # 其他情况下每个单元格保留原来的Python对象，直接使用各列自身的值即可
+    columns = None
+    if all(pd.api.types.is_numeric_dtype(dtype) for dtype in df.dtypes):
+        values = df.to_numpy()
+        if values.dtype.kind in "biuf":
+            if values.dtype.kind == "f" and values.dtype.itemsize < 8:
+                values = values.astype(np.float64)
+            columns = [values[:, col_position] for col_position in range(values.shape[1])]
+    string_rows = None
+    if columns is None:
+        columns = [_column_values(df.iloc[:, col_position]) for col_position in range(df.shape[1])]
+        if _ROW_INFERS_STRING and columns and any(column.dtype.kind == "O" for column in columns):
+            string_rows = _string_rows(columns, list(df.dtypes))
+
+    row_count = len(df)
+    joined = np.full(row_count, "", dtype=object)
+
+    for column, col_name, dtype in zip(columns, df.columns, df.dtypes):
+        if column.dtype.kind in "biuf":
+            # 数值列直接用numpy整体转换为字符串，结果与逐个 str() 相同
+            cell_texts = pd.Series(column.astype(str), dtype=object).str.strip()
+        elif column.dtype.kind == "M" and _whole_seconds(column):
+            # 不含亚秒部分的日期列：str(Timestamp) 即 "YYYY-MM-DD HH:MM:SS"，避免逐个构造Timestamp
+            iso_texts = pd.Series(np.datetime_as_string(column, unit="s").astype(object), dtype=object)
+            cell_texts = iso_texts.str.slice_replace(10, 11, " ").where(~np.isnat(column), "NaT")
+        else:
+            cell_texts = pd.Series(column, dtype=column.dtype).map(str).str.strip()
+            if string_rows is not None and column.dtype.kind == "O":
+                cell_texts = cell_texts.mask(_missing_cells(column, dtype) & string_rows, "nan")
+        keep = cell_texts.ne("")
+        if skip_nan:
+            keep &= cell_texts.ne("nan")
+        keep = keep.to_numpy(dtype=bool)
+        if not keep.any():
+            continue
+
+        pieces = f"{str(col_name).strip()}: " + cell_texts.to_numpy(dtype=object)
+        has_text = joined != ""
+        append = keep & has_text
+        joined[append] = joined[append] + CELL_SEPARATOR + pieces[append]
+        first = keep & ~has_text
+        joined[first] = pieces[first]
+
+    non_empty = np.flatnonzero(joined != "")
+    return pd.Series(joined[non_empty], index=non_empty, dtype=object)
+
+
+def serialize_sheet(df: pd.DataFrame, skip_nan: bool = True) -> str:
+    """
+    把整个工作表转换为一段文本，每行一条记录
+
+    @param df - 工作表数据
+    @param skip_nan - 是否跳过值为 'nan' 的单元格
+    @returns 工作表文本（已去除首尾空白），空表返回空字符串
+    """
+    return ROW_SEPARATOR.join(sheet_row_texts(df, skip_nan).tolist()).strip()
+
+
+def iter_sheet_rows(df: pd.DataFrame, skip_nan: bool = True) -> Iterator[Tuple[int, str]]:
+    """
+    逐行产出工作表的行文本
+
+    @param df - 工作表数据
+    @param skip_nan - 是否跳过值为 'nan' 的单元格
+    @returns 生成 (行号, 行文本) 的迭代器，行号从0开始且不含表头，空行被跳过
+    """
+    row_texts = sheet_row_texts(df, skip_nan)
+    for row_number, row_text in zip(row_texts.index.tolist(), row_texts.tolist()):
+        yield row_number, row_text
+
+
+def build_sheet_header(sheet_name: str, columns: Iterable) -> str:
+    """
+    生成在每个文本块开头重复的表头
+
+    @param sheet_name - 工作表名
+    @param columns - 列名列表
+    @returns 表头文本
+    """
+    column_names = CELL_SEPARATOR.join(str(col).strip() for col in columns)
+    return f"工作表: {sheet_name} | 列: {column_names}"
+
+
+def _split_oversized_row(row_text: str, budget: int,
+                         text_splitter: RecursiveCharacterTextSplitter) -> List[str]:
+    """
+    把超出token预算的单行按单元格边界拆开；单个单元格仍然超出时按字符切分
+
+    @param row_text - 行文本
+    @param budget - 可用的token预算（已扣除表头）
+    @param text_splitter - 用于切分超长单元格的字符分割器
+    @returns 拆分后的文本片段列表
+    """
+    pieces = []
+    current = []
+    current_tokens = 0
+    for cell in row_text.split(CELL_SEPARATOR):
+        cell_tokens = estimate_tokens(cell)
+        if cell_tokens > budget:
+            if current:
+                pieces.append(CELL_SEPARATOR.join(current))
+                current, current_tokens = [], 0
+            pieces.extend(text_splitter.split_text(cell))
+            continue
+        if current and current_tokens + cell_tokens > budget:
+            pieces.append(CELL_SEPARATOR.join(current))
+            current, current_tokens = [], 0
+        current.append(cell)
+        current_tokens += cell_tokens
+    if current:
+        pieces.append(CELL_SEPARATOR.join(current))
+    return pieces
+
+
+def iter_row_chunks(rows: Iterable[Tuple[int, str]], header: str, metadata: Dict,
+                    token_budget: int, text_splitter: RecursiveCharacterTextSplitter) -> Iterator[Document]:
+    """
+    把整行文本按token预算分组为文本块，每个块以表头开头
+
+    @remarks 行不会被拆到两个块中；只有单行本身超出预算时才会拆分该行。
+             输入可以是任意可迭代对象，整个过程只保留当前块，便于流式处理大表
+    @param rows - (行号, 行文本) 的可迭代对象
+    @param header - 每个块开头重复的表头
+    @param metadata - 每个块共享的元数据（如 source_file、sheet_name）
+    @param token_budget - 每个块的token预算（包含表头）
+    @param text_splitter - 用于切分超长单元格的字符分割器
+    @returns 生成Document的迭代器，元数据包含 row_start/row_end（含两端）
+    """
+    header_tokens = estimate_tokens(header)
+    # 表头本身过长时至少给行内容留出一半预算
+    row_budget = max(token_budget - header_tokens, token_budget // 2, 1)
+
+    def make_chunk(lines: List[str], row_start: int, row_end: int) -> Document:
+        chunk_metadata = dict(metadata)
+        chunk_metadata["row_start"] = row_start
+        chunk_metadata["row_end"] = row_end
+        return Document(page_content=header + ROW_SEPARATOR + ROW_SEPARATOR.join(lines), metadata=chunk_metadata)
+
+    lines = []
+    used_tokens = 0
+    row_start = row_end = None
+    for row_number, row_text in rows:
+        row_tokens = estimate_tokens(row_text)
+        if row_tokens > row_budget:
+            if lines:
+                yield make_chunk(lines, row_start, row_end)
+                lines, used_tokens = [], 0
+            for piece in _split_oversized_row(row_text, row_budget, text_splitter):
+                yield make_chunk([piece], row_number, row_number)
+            continue
+
+        if lines and used_tokens + row_tokens > row_budget:
+            yield make_chunk(lines, row_start, row_end)
+            lines, used_tokens = [], 0
+        if not lines:
+            row_start = row_number
+        lines.append(row_text)
+        used_tokens += row_tokens
+        row_end = row_number
+
+    if lines:
+        yield make_chunk(lines, row_start, row_end)
+
+
+def _should_stream(file_path: Path, stream_min_bytes: Optional[int]) -> bool:
+    """
+    判断文件是否需要走流式读取（只支持 .xlsx）
+
+    @param file_path - Excel文件路径
+    @param stream_min_bytes - 触发流式读取的文件大小（字节），None表示不使用流式读取
+    @returns 需要流式读取返回True
+    """
+    if stream_min_bytes is None or file_path.suffix.lower() != '.xlsx':
+        return False
+    try:
+        return file_path.stat().st_size >= stream_min_bytes
+    except OSError:
+        return False
+
+
+def workbook_hash(file_path: Path) -> Optional[str]:
+    """
+    计算工作簿文件的MD5哈希（解析快照的键）
+
+    @param file_path - Excel文件路径
+    @returns 十六进制哈希，读取失败时返回None
+    """
+    hash_md5 = hashlib.md5()
+    try:
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                hash_md5.update(block)
+    except OSError as e:
+        print(f"    计算文件哈希时出错 {file_path.name}: {e}")
+        return None
+    return hash_md5.hexdigest()
+
+
+def _open_snapshot(file_path: Path, table_dir: Optional[Path],
+                   file_hash: Optional[str]) -> Optional[List[Tuple[Dict, object]]]:
+    """
+    打开与文件内容一致的解析快照（以内存映射方式打开每个工作表的行文本文件）
+
+    @param file_path - Excel文件路径
+    @param table_dir - 快照的根目录，None表示不使用快照
+    @param file_hash - 文件当前的哈希
+    @returns [(工作表条目, pyarrow.parquet.ParquetFile)]，没有可用的快照时返回None
+    """
+    if table_dir is None or not file_hash:
+        return None
+    snapshot = read_snapshot(table_dir, file_path.name, file_hash)
+    if snapshot is None:
+        return None
+    try:
+        import pyarrow.parquet as pq
+        return [(sheet, pq.ParquetFile(Path(snapshot["dir"]) / sheet["rows_file"], memory_map=True))
+                for sheet in snapshot["sheets"]]
+    except Exception as e:
+        print(f"    读取文件 {file_path.name} 的解析快照失败，重新解析: {e}")
+        return None
+
+
+def iter_snapshot_chunks(file_path: Path, sheets: List[Tuple[Dict, object]], token_budget: int,
+                         text_splitter: RecursiveCharacterTextSplitter) -> Iterator[Document]:
+    """
+    从解析快照中的行文本切分文本块，结果与直接解析Excel一致
+
+    @remarks 行文本按批从内存映射的Parquet中读取，内存占用与工作表大小无关。
+             读出的行数与清单不一致（快照被截断）时抛出 ValueError
+    @param file_path - Excel文件路径（写入元数据）
+    @param sheets - _open_snapshot() 的返回值
+    @param token_budget - 每个文本块的token预算
+    @param text_splitter - 用于切分超长单元格的字符分割器
+    @returns 生成Document的迭代器
+    """
+    for sheet, parquet_file in sheets:
+        metadata = {
+            "source_file": file_path.name,
+            "sheet_name": sheet["sheet_name"],
+            "file_path": str(file_path)
+        }
+        header = build_sheet_header(sheet["sheet_name"], sheet["header_columns"])
+        read_rows = [0]
+
+        def rows() -> Iterator[Tuple[int, str]]:
+            for batch in parquet_file.iter_batches(batch_size=SNAPSHOT_BATCH_ROWS, columns=["row", "text"]):
+                read_rows[0] += batch.num_rows
+                yield from zip(batch.column(0).to_pylist(), batch.column(1).to_pylist())
+
+        yield from iter_row_chunks(rows(), header, metadata, token_budget, text_splitter)
+        if read_rows[0] != sheet["text_rows"]:
+            raise ValueError(f"工作表 {sheet['sheet_name']} 的快照中有 {read_rows[0]} 行，"
+                             f"与清单记录的 {sheet['text_rows']} 行不一致")
+
+
+def _write_table(writer: Optional[TableWriter], write, *args) -> Optional[TableWriter]:
+    """
+    写入列式表；写入失败只放弃该工作簿的表，不影响文本块的生成
+
+    @param writer - 表写入器，None表示不写表或已经放弃
+    @param write - 写入方法名（"write_sheet" 或 "append_rows"）
+    @param args - 写入参数
+    @returns 继续使用的写入器，失败时返回None
+    """
+    if writer is None:
+        return None
+    try:
+        getattr(writer, write)(*args)
+        return writer
+    except Exception as e:
+        print(f"    写入列式表失败（{writer.source_file}）: {e}")
+        writer.abort()
+        return None
+
+
+def load_workbook_chunks(file_path: Path, token_budget: int, chunk_size: int,
+                         chunk_overlap: int, table_dir: Optional[Path] = None) -> List[Document]:
+    """
+    读取工作簿并把每个非空工作表切分为按行分组的文本块
+
+    @param file_path - Excel文件路径
+    @param token_budget - 每个文本块的token预算
+    @param chunk_size - 切分超长单元格时每段的最大字符数
+    @param chunk_overlap - 切分超长单元格时段与段之间的重叠字符数
+    @param table_dir - 解析快照（Parquet列式表和行文本）的根目录，文件哈希与快照一致时直接从快照切分，
+                       否则解析Excel并写入新快照；None表示不使用快照
+    @returns Document列表；读取或解析失败时抛出异常，调用方不能把文件当作没有内容处理
+    @example
+    ```python
+    chunks = load_workbook_chunks(Path("./knowledge_base/员工.xlsx"), 256, 500, 50)
+    print(chunks[0].metadata["row_start"], chunks[0].metadata["row_end"])
+    ```
+    """
+    print(f"  正在处理文件: {file_path.name}")
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        is_separator_regex=False,
+    )
+    chunks = []
+    writer = None
+    try:
+        file_hash = workbook_hash(file_path) if table_dir is not None else None
+        snapshot = _open_snapshot(file_path, table_dir, file_hash)
+        if snapshot is not None:
+            try:
+                chunks = list(iter_snapshot_chunks(file_path, snapshot, token_budget, text_splitter))
+                print("    文件未变化，已从解析快照切分")
+                return chunks
+            except Exception as e:
+                print(f"    从解析快照切分文件 {file_path.name} 失败，删除快照并重新解析: {e}")
+                remove_tables(table_dir, file_path.name)
+                chunks = []
+
+        xls = read_workbook(file_path)
+        if xls is None:
+            if table_dir is not None:
+                remove_tables(table_dir, file_path.name)
+            raise ValueError(f"无法读取工作簿 {file_path.name}")
+
+        writer = TableWriter(table_dir, file_path.name, file_hash) if table_dir is not None else None
+        for sheet_name, df in xls.items():
+            if df.empty:
+                continue
+            metadata = {
+                "source_file": file_path.name,
+                "sheet_name": sheet_name,
+                "file_path": str(file_path)
+            }
+            header = build_sheet_header(sheet_name, df.columns)
+            row_texts = sheet_row_texts(df)
+            rows = zip(row_texts.index.tolist(), row_texts.tolist())
+            chunks.extend(iter_row_chunks(rows, header, metadata, token_budget, text_splitter))
+            writer = _write_table(writer, "write_sheet", sheet_name, df, row_texts)
+        if writer is not None:
+            writer.commit()
+            writer = None
+    except Exception as e:
+        print(f"    处理文件 {file_path.name} 时发生错误: {e}")
+        if "xlrd" in str(e).lower():
+            print(f"    提示：这是一个 .xls 文件，需要安装 xlrd 依赖")
+            print(f"    请运行: pip install xlrd")
+        raise
+    finally:
+        if writer is not None:
+            writer.abort()
+    return chunks
+
+
+def write_workbook_tables(file_path: Path, table_dir: Path, stream_min_bytes: Optional[int] = None,
+                          batch_rows: int = 5000) -> bool:
+    """
+    只把工作簿写为解析快照（Parquet列式表和行文本，不切分文本块），用于为已有的向量库补建表
+
+    @param file_path - Excel文件路径
+    @param table_dir - 快照的根目录
+    @param stream_min_bytes - 触发流式读取的文件大小（字节），None表示不使用流式读取
+    @param batch_rows - 流式读取时每批的行数
+    @returns 写入成功返回True
+    """
+    writer = TableWriter(table_dir, file_path.name, workbook_hash(file_path))
+    try:
+        if _should_stream(file_path, stream_min_bytes):
+            for sheet_name, row_offset, frame in iter_xlsx_row_batches(file_path, batch_rows):
+                row_texts = sheet_row_texts(frame)
+                row_texts.index = row_texts.index + row_offset
+                writer.append_rows(sheet_name, frame, row_texts)
+        else:
+            xls = read_workbook(file_path)
+            if xls is None:
+                return False
+            for sheet_name, df in xls.items():
+                if not df.empty:
+                    writer.write_sheet(sheet_name, df, sheet_row_texts(df))
+        writer.commit()
+        writer = None
+        return True
+    except Exception as e:
+        print(f"    为文件 {file_path.name} 写入列式表时发生错误: {e}")
+        return False
+    finally:
+        if writer is not None:
+            writer.abort()
+
+
+def _unique_columns(raw_header: List) -> List[str]:
+    """
+    规范化表头：空列名命名为 "Unnamed: i"，重复列名追加 ".1"、".2"，与 pandas.read_excel 一致
+
+    @param raw_header - 第一行的原始单元格值
+    @returns 列名列表
+    """
+    columns = []
+    seen = {}
+    for position, value in enumerate(raw_header):
+        name = f"Unnamed: {position}" if value is None or str(value).strip() == "" else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    return columns
+
+
+def iter_xlsx_row_batches(file_path: Path, batch_rows: int) -> Iterator[Tuple[str, int, pd.DataFrame]]:
+    """
+    以openpyxl只读模式流式读取 .xlsx 文件，按固定行数分批产出工作表数据
+
+    @remarks 只读模式按需解析XML，内存中只保留当前批次的行，峰值内存与工作簿大小无关。
+             第一行作为表头；单元格保持openpyxl返回的原始Python值（每批都是object类型），
+             不会像pandas那样把整列提升为浮点数，因此整数值显示为 "15000" 而不是 "15000.0"
+    @param file_path - .xlsx 文件路径
+    @param batch_rows - 每批的最大行数
+    @returns 生成 (工作表名, 批次首行行号, 批次DataFrame) 的迭代器，行号从0开始且不含表头
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            rows = worksheet.iter_rows(values_only=True)
+            raw_header = next(rows, None)
+            if raw_header is None:
+                continue
+            columns = _unique_columns(list(raw_header))
+
+            batch = []
+            row_offset = 0
+            for values in rows:
+                if len(values) > len(columns):
+                    # 数据比表头宽：补充未命名列，后续批次使用扩展后的表头
+                    columns = _unique_columns(list(raw_header) + [None] * (len(values) - len(raw_header)))
+                batch.append(values)
+                if len(batch) >= batch_rows:
+                    yield worksheet.title, row_offset, _batch_frame(batch, columns)
+                    row_offset += len(batch)
+                    batch = []
+            if batch:
+                yield worksheet.title, row_offset, _batch_frame(batch, columns)
+    finally:
+        workbook.close()
+
+
+def _batch_frame(batch: List[Tuple], columns: List[str]) -> pd.DataFrame:
+    """
+    把一批原始行转换为object类型的DataFrame，行宽不足的补None
+
+    @param batch - 原始行列表
+    @param columns - 列名列表
+    @returns DataFrame
+    """
+    width = len(columns)
+    padded = [tuple(values[:width]) + (None,) * (width - len(values)) for values in batch]
+    return pd.DataFrame(padded, columns=columns, dtype=object)
+
+
+def iter_streaming_workbook_chunks(file_path: Path, token_budget: int, chunk_size: int,
+                                  chunk_overlap: int, batch_rows: int,
+                                  table_dir: Optional[Path] = None) -> Iterator[Document]:
+    """
+    流式读取大型 .xlsx 文件并按行切分为文本块
+
+    @remarks 行批次 -> 向量化序列化 -> 按行分组切分，全程惰性求值，调用方按需取块即可
+             把内存峰值限制在一个批次以内。读取出错时打印错误、放弃写入快照并重新抛出异常，
+             调用方据此回滚已写入的部分文本块，保留该文件原来的向量
+    @param file_path - .xlsx 文件路径
+    @param token_budget - 每个文本块的token预算
+    @param chunk_size - 切分超长单元格时每段的最大字符数
+    @param chunk_overlap - 切分超长单元格时段与段之间的重叠字符数
+    @param batch_rows - 每批读取的行数
+    @param table_dir - 解析快照的根目录，文件哈希与快照一致时直接从快照切分（快照损坏时删除快照并抛出异常），
+                       否则边读取边按批写入新快照（只有完整读完工作簿时才替换旧快照）；None表示不使用快照
+    @returns 生成Document的迭代器
+    """
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        is_separator_regex=False,
+    )
+    file_hash = workbook_hash(file_path) if table_dir is not None else None
+    snapshot = _open_snapshot(file_path, table_dir, file_hash)
+    if snapshot is not None:
+        print(f"  正在从解析快照读取大文件: {file_path.name}")
+        try:
+            yield from iter_snapshot_chunks(file_path, snapshot, token_budget, text_splitter)
+        except Exception as e:
+            # 已产出的文本块不完整：删除快照后抛出，调用方回滚，下次更新时重新解析Excel
+            print(f"    从解析快照读取文件 {file_path.name} 时发生错误，已删除快照: {e}")
+            remove_tables(table_dir, file_path.name)
+            raise
+        return
+
+    print(f"  正在流式处理大文件: {file_path.name}")
+    batches = iter_xlsx_row_batches(file_path, batch_rows)
+    pending = [next(batches, None)]
+    writer = [TableWriter(table_dir, file_path.name, file_hash) if table_dir is not None else None]
+
+    def sheet_rows(sheet_name: str) -> Iterator[Tuple[int, str]]:
+        # 连续产出同一工作表的所有批次，遇到下一个工作表的批次时留给外层循环
+        while pending[0] is not None and pending[0][0] == sheet_name:
+            _, row_offset, frame = pending[0]
+            row_texts = sheet_row_texts(frame)
+            row_texts.index = row_texts.index + row_offset
+            writer[0] = _write_table(writer[0], "append_rows", sheet_name, frame, row_texts)
+            yield from zip(row_texts.index.tolist(), row_texts.tolist())
+            pending[0] = next(batches, None)
+
+    try:
+        while pending[0] is not None:
+            sheet_name, _, frame = pending[0]
+            metadata = {
+                "source_file": file_path.name,
+                "sheet_name": sheet_name,
+                "file_path": str(file_path)
+            }
+            header = build_sheet_header(sheet_name, frame.columns)
+            yield from iter_row_chunks(sheet_rows(sheet_name), header, metadata, token_budget, text_splitter)
+        if writer[0] is not None:
+            writer[0].commit()
+            writer[0] = None
+    except Exception as e:
+        print(f"    流式处理文件 {file_path.name} 时发生错误: {e}")
+        raise
+    finally:
+        batches.close()
+        if writer[0] is not None:
+            writer[0].abort()
+
+
+def _failed_chunks(error: Exception) -> Iterator[Document]:
+    """
+    读取失败的文件对应的文本块迭代器：迭代时抛出原来的异常
+
+    @param error - 读取时发生的异常
+    @returns 第一次迭代即抛出异常的迭代器
+    """
+    raise error
+    yield
+
+
+def _load_or_fail(file_path: Path, token_budget: int, chunk_size: int, chunk_overlap: int,
+                  table_dir: Optional[Path]) -> Iterable[Document]:
+    """
+    在当前进程中读取工作簿，失败时返回迭代时抛出异常的迭代器
+
+    @param file_path - Excel文件路径
+    @param token_budget - 每个文本块的token预算
+    @param chunk_size - 切分超长单元格时每段的最大字符数
+    @param chunk_overlap - 切分超长单元格时段与段之间的重叠字符数
+    @param table_dir - 解析快照的根目录，None表示不使用快照
+    @returns Document列表，或 _failed_chunks() 迭代器
+    """
+    try:
+        return load_workbook_chunks(file_path, token_budget, chunk_size, chunk_overlap, table_dir)
+    except Exception as e:
+        return _failed_chunks(e)
+
+
+def iter_workbook_chunks(file_paths: Iterable[Path], token_budget: int, chunk_size: int,
+                         chunk_overlap: int, max_workers: int = 1, stream_min_bytes: Optional[int] = None,
+                         stream_batch_rows: int = 5000,
+                         table_dir: Optional[Path] = None) -> Iterator[Tuple[Path, Iterable[Document]]]:
+    """
+    并行解析多个工作簿，按完成顺序逐个产出每个文件的文本块
+
+    @remarks openpyxl解析是CPU密集且单线程的，这里用进程池并行处理不同文件。
+             同时在途的文件数限制为工作进程数的两倍，调用方可以边接收边嵌入，
+             解析结果不会在内存中堆积。子进程使用spawn方式启动，不会继承父进程中的线程、锁和已加载的模型；
+             但spawn会在每个子进程中重新导入主模块（以 python rag_api_server.py 启动时即服务器模块及其
+             依赖的 faiss、langchain 等），每个工作进程启动时有一次性的导入开销。主模块的启动代码
+             位于 if __name__ == "__main__" 和 FastAPI 启动事件中，不会在子进程中执行。
+             单个文件出错只影响该文件：读取失败（包括工作进程崩溃）的文件产出的迭代器在迭代时抛出异常，
+             流式读取的文件读到一半出错时同样抛出，调用方按文件处理异常，不能把已产出的文本块当作完整内容。
+             不小于 stream_min_bytes 的 .xlsx 文件不会整体读入内存，而是在当前进程中
+             以惰性迭代器的形式返回，由调用方分批消费；此时进程池继续解析其他文件
+    @param file_paths - Excel文件路径列表
+    @param token_budget - 每个文本块的token预算
+    @param chunk_size - 切分超长单元格时每段的最大字符数
+    @param chunk_overlap - 切分超长单元格时段与段之间的重叠字符数
+    @param max_workers - 工作进程数，小于等于1或只有一个文件时在当前进程中解析
+    @param stream_min_bytes - 触发流式读取的文件大小（字节），None表示不使用流式读取
+    @param stream_batch_rows - 流式读取时每批的行数
+    @param table_dir - 解析快照的根目录，内容未变化的文件直接从快照切分；None表示不使用快照
+    @returns 生成 (文件路径, 文本块列表或惰性迭代器) 的迭代器
+    @example
+    ```python
+    for file_path, chunks in iter_workbook_chunks(files, 256, 500, 50, max_workers=8):
+        print(file_path.name, len(chunks))
+    ```
+    """
+    pending_paths = []
+    streamed_paths = []
+    for file_path in file_paths:
+        if _should_stream(file_path, stream_min_bytes):
+            streamed_paths.append(file_path)
+        else:
+            pending_paths.append(file_path)
+
+    def streamed(file_path: Path) -> Iterator[Document]:
+        return iter_streaming_workbook_chunks(file_path, token_budget, chunk_size, chunk_overlap, stream_batch_rows,
+                                              table_dir)
+
+    workers = min(max_workers, len(pending_paths))
+    if workers <= 1:
+        for file_path in streamed_paths:
+            yield file_path, streamed(file_path)
+        for file_path in pending_paths:
+            yield file_path, _load_or_fail(file_path, token_budget, chunk_size, chunk_overlap, table_dir)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        in_flight = {}
+        pending_paths.reverse()
+        first_round = True
+        while pending_paths or in_flight:
+            while pending_paths and len(in_flight) < workers * 2:
+                file_path = pending_paths.pop()
+                future = executor.submit(load_workbook_chunks, file_path, token_budget, chunk_size, chunk_overlap,
+                                         table_dir)
+                in_flight[future] = file_path
+
+            if first_round:
+                # 进程池开始解析小文件后，在当前进程中流式处理大文件
+                first_round = False
+                for file_path in streamed_paths:
+                    yield file_path, streamed(file_path)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_path = in_flight.pop(future)
+                try:
+                    chunks = future.result()
+                except Exception as e:
+                    print(f"    处理文件 {file_path.name} 时工作进程发生错误: {e}")
+                    chunks = _failed_chunks(e)
+                yield file_path, chunks
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
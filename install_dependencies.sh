@@ -13,6 +13,12 @@ pip install pandas openpyxl sentence-transformers faiss-cpu langchain langchain-
 # 如果你的机器有NVIDIA GPU并且安装了CUDA，可以考虑安装 faiss-gpu 以获得更好的性能
 # pip install faiss-gpu
 
+# 可选：安装 jieba 后关键词检索使用中文分词（未安装时使用二字组切分），安装后首次启动会重建关键词索引
+# pip install jieba
+
+# 可选：安装 tokenizers 后按目标模型的分词器计算提示token数（未安装时按字符估算）
+# pip install tokenizers
+
 echo "依赖安装完成。"
 echo "请确保你已经安装并运行了Ollama服务，并且拉取了至少一个模型，例如："
 echo "ollama pull qwen2:7b-instruct  (推荐，中文能力较好)"
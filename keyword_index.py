@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+关键词倒排索引模块 - 基于BM25的单元格文本检索，与向量检索做倒数排名融合
+
+@remarks 表格问题经常是精确查找（"张三在哪个部门"），多语言MiniLM嵌入对人名、工号这类
+         字符串区分度很差。这里对文本块建立倒排索引：
+         1. 分词：英文/数字按词切分；中文安装了 jieba 时使用搜索引擎模式分词，
+            否则使用相邻二字组（bigram），不依赖词典也能命中人名；
+         2. 每个词的倒排表是两个紧凑数组（文本块ID、词频），检索时零拷贝转为numpy向量化打分；
+         3. 文本块长度按ID存放在数组中（文本块ID由向量库连续分配），删除只把长度置0，
+            已删除文本块过多时在保存时清理倒排表；
+         4. 持久化为 npy 数组 + JSON 清单，不使用pickle
+@author AI Assistant
+@version 1.0
+"""
+
+import json
+import math
+import os
+import re
+import unicodedata
+import uuid
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+except ImportError:
+    jieba = None
+
+INDEX_FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 出现在超过该比例文本块中的词（如每个块都重复的列名）在还有其他查询词时忽略，避免扫描超长倒排表
+MAX_DF_RATIO = 0.5
+# 已删除文本块超过该比例时，保存时清理倒排表
+COMPACT_DEAD_RATIO = 0.3
+# 融合时使用的RRF常数
+RRF_K = 60
+
+_TOKEN_PATTERN = re.compile(r"[0-9a-z]+(?:[._@-][0-9a-z]+)*|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+
+def tokenizer_name() -> str:
+    """
+    当前使用的分词方式（写入清单，变化时需要重建索引）
+
+    @returns "jieba" 或 "bigram"
+    """
+    return "jieba" if jieba is not None else "bigram"
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    把文本切分为检索词
+
+    @param text - 文本
+    @returns 检索词列表（保留重复，用于计算词频）
+    @example
+    ```python
+    tokenize("张三 在 技术部, 工号 E-1024")  # ["张三", "技术", "术部", "工号", "e-1024"]（未安装jieba时）
+    ```
+    """
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text).casefold()):
+        word = match.group()
+        if word.isascii():
+            tokens.append(word)
+        elif jieba is not None:
+            tokens.extend(token for token in jieba.lcut_for_search(word) if token.strip())
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int, rrf_k: int = RRF_K) -> List[int]:
+    """
+    倒数排名融合：score(d) = Σ 1 / (rrf_k + rank)
+
+    @param rankings - 多个按相关度排序的ID列表
+    @param k - 返回的数量
+    @param rrf_k - RRF常数，越大越弱化头部名次的差异
+    @returns 融合后的前k个ID
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (rrf_k + rank + 1)
+    # 同分时保持首次出现的顺序（字典按插入顺序，sorted 稳定）
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+class KeywordIndex:
+    """
+    BM25关键词倒排索引，按文本块ID增量增删
+
+    @remarks 调用方负责加锁（EnhancedRAGSystem 在 _index_lock 下访问）
+    @example
+    ```python
+    index = KeywordIndex()
+    index.add([0, 1], ["姓名: 张三, 部门: 技术部", "姓名: 李四, 部门: 市场部"])
+    index.search("张三在哪个部门", k=3)  # [(0, 3.2), ...]
+    index.save(Path("./vector_store/keyword_index"))
+    ```
+    """
+
+    def __init__(self):
+        """
+        创建空索引
+        """
+        self.tokenizer = tokenizer_name()
+        self._postings: Dict[str, Tuple[array, array]] = {}  # 词 -> (文本块ID, 词频)
+        self._lengths = array("i")  # 按文本块ID索引的词数，0表示不存在或已删除
+        self._documents = 0
+        self._total_length = 0
+        self._dead_documents = 0
+
+    def __len__(self) -> int:
+        return self._documents
+
+    def add(self, chunk_ids: Sequence[int], texts: Sequence[str]):
+        """
+        添加文本块
+
+        @param chunk_ids - 文本块ID（向量库分配的ID，单调递增、不会重复使用）
+        @param texts - 与ID一一对应的文本
+        @returns 无返回值
+        """
+        for chunk_id, text in zip(chunk_ids, texts):
+            tokens = tokenize(text)
+            if not tokens:
+                continue
+            if chunk_id >= len(self._lengths):
+                self._lengths.extend([0] * (chunk_id + 1 - len(self._lengths)))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                posting = self._postings.get(token)
+                if posting is None:
+                    posting = self._postings[token] = (array("q"), array("i"))
+                posting[0].append(chunk_id)
+                posting[1].append(count)
+            self._lengths[chunk_id] = len(tokens)
+            self._documents += 1
+            self._total_length += len(tokens)
+
+    def delete(self, chunk_ids: Iterable[int]):
+        """
+        删除文本块（倒排表中的条目在清理时移除）
+
+        @param chunk_ids - 文本块ID
+        @returns 无返回值
+        """
+        for chunk_id in chunk_ids:
+            if 0 <= chunk_id < len(self._lengths) and self._lengths[chunk_id]:
+                self._total_length -= self._lengths[chunk_id]
+                self._lengths[chunk_id] = 0
+                self._documents -= 1
+                self._dead_documents += 1
+
+    def search(self, query: str, k: int = 10, allowed_ids: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        BM25检索
+
+        @param query - 查询文本
+        @param k - 返回的数量
+        @param allowed_ids - 只在这些文本块中检索（升序ID数组），None表示不限制
+        @returns 按得分降序的 (文本块ID, 得分) 列表
+        """
+        terms = [term for term in dict.fromkeys(tokenize(query)) if term in self._postings]
+        if not terms or self._documents == 0 or k <= 0:
+            return []
+        # 极常见的词几乎不贡献得分，只在没有其他词时使用
+        rare_terms = [term for term in terms if len(self._postings[term][0]) <= MAX_DF_RATIO * self._documents]
+        terms = rare_terms or terms
+
+        lengths = np.frombuffer(self._lengths, dtype=np.int32)
+        average_length = self._total_length / self._documents
+        all_ids, all_scores = [], []
+        for term in terms:
+            ids = np.frombuffer(self._postings[term][0], dtype=np.int64)
+            tfs = np.frombuffer(self._postings[term][1], dtype=np.int32)
+            doc_lengths = lengths[ids]
+            live = doc_lengths > 0
+            if allowed_ids is not None:
+                live &= np.isin(ids, allowed_ids)
+            if not live.any():
+                continue
+            ids, tfs, doc_lengths = ids[live], tfs[live], doc_lengths[live]
+            df = len(ids)
+            idf = math.log(1 + (self._documents - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / average_length)
+            all_ids.append(ids)
+            all_scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+        if not all_ids:
+            return []
+
+        if len(all_ids) == 1:
+            ids, scores = all_ids[0], all_scores[0]
+        else:
+            ids, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        if len(ids) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(ids))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    def _compacted_postings(self) -> Dict[str, Tuple[array, array]]:
+        """
+        生成移除了已删除文本块条目的倒排表（不修改当前索引）
+
+        @returns 新的倒排表
+        """
+        lengths = np.frombuffer(self._lengths, dtype=np.int32)
+        postings = {}
+        for term, (term_ids, term_tfs) in self._postings.items():
+            ids = np.frombuffer(term_ids, dtype=np.int64)
+            live = lengths[ids] > 0
+            if live.all():
+                postings[term] = (term_ids, term_tfs)
+            elif live.any():
+                tfs = np.frombuffer(term_tfs, dtype=np.int32)
+                postings[term] = (array("q", ids[live].tobytes()), array("i", tfs[live].tobytes()))
+        return postings
+
+    def save(self, directory: Path):
+        """
+        持久化到目录：倒排表拼接为数组写入npy，再原子地替换清单
+
+        @remarks 需要在写文件期间继续检索时，依次调用 write_files()、apply_saved_files()
+        @param directory - 存储目录
+        @returns 无返回值
+        """
+        self.apply_saved_files(directory, self.write_files(directory))
+
+    def write_files(self, directory: Path) -> Dict[str, object]:
+        """
+        写入npy数组和清单，不修改内存中的索引
+
+        @remarks 写文件期间可以与检索并发执行，但不能有增删
+        @param directory - 存储目录
+        @returns 写入结果，传给 apply_saved_files()
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        postings, dead_documents = self._postings, self._dead_documents
+        compacted = dead_documents > COMPACT_DEAD_RATIO * max(self._documents + dead_documents, 1)
+        if compacted:
+            postings, dead_documents = self._compacted_postings(), 0
+
+        terms = list(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term][0]) for term in terms])
+        token = uuid.uuid4().hex
+        files = {name: f"{name}-{token}.npy" for name in ("ids", "tfs", "offsets", "lengths")}
+        ids = b"".join(postings[term][0].tobytes() for term in terms)
+        tfs = b"".join(postings[term][1].tobytes() for term in terms)
+        np.save(directory / files["ids"], np.frombuffer(ids, dtype=np.int64))
+        np.save(directory / files["tfs"], np.frombuffer(tfs, dtype=np.int32))
+        np.save(directory / files["offsets"], offsets)
+        np.save(directory / files["lengths"], np.frombuffer(self._lengths, dtype=np.int32))
+
+        manifest = {
+            "format": INDEX_FORMAT_VERSION,
+            "tokenizer": self.tokenizer,
+            "terms": terms,
+            "documents": self._documents,
+            "total_length": self._total_length,
+            "dead_documents": dead_documents,
+            "files": files
+        }
+        temp_path = directory / f"{MANIFEST_NAME}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(temp_path, directory / MANIFEST_NAME)
+        return {"postings": postings if compacted else None, "referenced": set(files.values()) | {MANIFEST_NAME}}
+
+    def apply_saved_files(self, directory: Path, written: Dict[str, object]):
+        """
+        切换到压缩后的倒排表（如果写入时做了压缩），并清理不再引用的旧文件
+
+        @remarks 修改内存中的索引，调用方需保证期间没有检索
+        @param directory - 存储目录
+        @param written - write_files() 的返回值
+        @returns 无返回值
+        """
+        if written["postings"] is not None:
+            self._postings = written["postings"]
+            self._dead_documents = 0
+        for path in Path(directory).iterdir():
+            if path.name not in written["referenced"]:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    @classmethod
+    def load(cls, directory: Path) -> Optional["KeywordIndex"]:
+        """
+        从目录加载索引
+
+        @param directory - 存储目录
+        @returns 索引；目录中没有清单或分词方式已变化（需要重建）时返回None
+        """
+        manifest_path = Path(directory) / MANIFEST_NAME
+        if not manifest_path.exists():
+            return None
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != INDEX_FORMAT_VERSION or manifest.get("tokenizer") != tokenizer_name():
+            return None
+
+        files = {name: Path(directory) / file_name for name, file_name in manifest["files"].items()}
+        ids, tfs, offsets = np.load(files["ids"]), np.load(files["tfs"]), np.load(files["offsets"])
+        index = cls()
+        for i, term in enumerate(manifest["terms"]):
+            start, end = offsets[i], offsets[i + 1]
+            index._postings[term] = (array("q", ids[start:end].tobytes()), array("i", tfs[start:end].tobytes()))
+        index._lengths = array("i", np.load(files["lengths"]).tobytes())
+        index._documents = manifest["documents"]
+        index._total_length = manifest["total_length"]
+        index._dead_documents = manifest["dead_documents"]
+        return index
+
+    def stats(self) -> Dict[str, object]:
+        """
+        获取索引统计
+
+        @returns 包含文本块数、词表大小和倒排条目数的字典
+        """
+        return {
+            "tokenizer": self.tokenizer,
+            "documents": self._documents,
+            "terms": len(self._postings),
+            "postings": sum(len(posting[0]) for posting in self._postings.values()),
+            "dead_documents": self._dead_documents
+        }
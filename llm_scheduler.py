@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+LLM生成调度模块 - 在单个本地Ollama实例前做并发控制、优先级排队和相同请求合并
+
+@remarks 多个用户同时提问时，每个请求各自调用 client.generate，本地模型被并发请求互相争抢，
+         所有人的延迟一起变差。调度器限制同时进行的生成数量，排队时流式（交互）请求优先于
+         非流式（批量）请求；完全相同的提示正在生成时，新的请求直接共享这一次生成的结果。
+         所有方法都需要在同一个事件循环中调用
+@author AI Assistant
+@version 1.0
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+# 优先级：数值越小越先执行
+PRIORITY_INTERACTIVE = 0  # 流式对话，用户正在等待首个token
+PRIORITY_BATCH = 1  # 非流式请求、批量任务
+# 流式生成最多领先最慢的订阅者多少个内容块，超出时暂停读取模型输出
+DEFAULT_STREAM_WINDOW = 32
+
+
+class _SharedResult:
+    """
+    一次非流式生成的共享状态：生成任务和等待它的请求数
+    """
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.subscribers = 0
+
+
+class _SharedStream:
+    """
+    一次流式生成的共享缓冲：生成任务写入，所有订阅者从头读取
+
+    @remarks 缓冲大小与答案长度相同（答案本身也需要完整保存用于缓存）；生成任务最多领先
+             最慢的订阅者 window 个内容块，之后暂停读取模型输出，慢速客户端通过TCP流控反压到Ollama。
+             所有订阅者都离开时取消生成任务，不再占用模型
+    """
+
+    def __init__(self, window: int = DEFAULT_STREAM_WINDOW):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.window = max(window, 1)
+        self._positions: Dict[int, int] = {}  # 订阅者 -> 已取走的内容块数量
+        self._next_subscriber = itertools.count()
+        self._changed = asyncio.Event()
+        self._consumed = asyncio.Event()
+
+    def _notify_consumed(self):
+        """
+        唤醒等待订阅者追上的生成任务
+
+        @returns 无返回值
+        """
+        self._consumed.set()
+        self._consumed = asyncio.Event()
+
+    async def wait_for_subscribers(self):
+        """
+        等待最慢的订阅者追到距离最新内容块 window 个以内
+
+        @returns 无返回值
+        """
+        while self._positions and min(self._positions.values()) < len(self.chunks) - self.window:
+            await self._consumed.wait()
+
+    def publish(self, chunk: Optional[str] = None, error: Optional[BaseException] = None, done: bool = False):
+        """
+        写入新的内容块或结束状态，并唤醒等待中的订阅者
+
+        @param chunk - 新的内容块
+        @param error - 生成失败时的异常
+        @param done - 是否已结束
+        @returns 无返回值
+        """
+        if chunk is not None:
+            self.chunks.append(chunk)
+        if error is not None:
+            self.error = error
+        self.done = self.done or done
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """
+        从头读取全部内容块，直到生成结束
+
+        @returns 内容块的异步迭代器
+        """
+        subscriber = next(self._next_subscriber)
+        position = self._positions[subscriber] = 0
+        try:
+            while True:
+                changed = self._changed
+                while position < len(self.chunks):
+                    yield self.chunks[position]
+                    # 消费方取下一块时才算取走上一块
+                    position += 1
+                    self._positions[subscriber] = position
+                    self._notify_consumed()
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            del self._positions[subscriber]
+            self._notify_consumed()
+
+
+class GenerationScheduler:
+    """
+    LLM生成调度器：有界并发 + 优先级队列 + 相同提示合并
+
+    @example
+    ```python
+    scheduler = GenerationScheduler(max_concurrent=1)
+    answer = await scheduler.generate(prompt_key, lambda: agenerate(prompt), PRIORITY_BATCH)
+    async for token in scheduler.stream(prompt_key, lambda: astream(prompt), PRIORITY_INTERACTIVE):
+        ...
+    ```
+    """
+
+    def __init__(self, max_concurrent: int = 1, stream_window: int = DEFAULT_STREAM_WINDOW):
+        """
+        初始化调度器
+
+        @param max_concurrent - 同时进行的生成数量上限
+        @param stream_window - 流式生成最多领先最慢订阅者的内容块数量
+        """
+        self.max_concurrent = max_concurrent
+        self.stream_window = stream_window
+        self._active = 0
+        self._waiters = []  # 堆：(优先级, 序号, Future)
+        self._sequence = itertools.count()
+        self._inflight_results: Dict[str, _SharedResult] = {}
+        self._inflight_streams: Dict[str, _SharedStream] = {}
+        self._stats = {
+            "requests": 0,
+            "deduplicated": 0,
+            "queued": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0
+        }
+
+    async def _acquire(self, priority: int):
+        """
+        获取一个生成名额，名额不足时按优先级排队
+
+        @param priority - 优先级，数值越小越先执行
+        @returns 无返回值
+        """
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            return
+
+        start_time = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._stats["queued"] += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 名额已经转交给本请求但请求被取消，需要把名额继续传下去
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        finally:
+            waited = time.perf_counter() - start_time
+            self._stats["wait_seconds"] += waited
+            self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+
+    def _release(self):
+        """
+        归还名额：直接转交给队列中优先级最高的请求，没有等待者时释放
+
+        @returns 无返回值
+        """
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    async def generate(self, key: str, factory: Callable[[], Awaitable[Any]],
+                       priority: int = PRIORITY_BATCH) -> Any:
+        """
+        执行一次非流式生成；相同key的生成正在进行时共享其结果
+
+        @remarks 生成在独立的任务中执行，某个请求被取消不会影响共享该生成的其他请求；
+                 所有请求都取消时生成任务也随之取消，并先从合并表中移除，之后相同的请求重新生成
+        @param key - 请求标识（通常为模型与提示的摘要）
+        @param factory - 创建生成协程的函数，只有真正执行时才调用
+        @param priority - 优先级
+        @returns 生成结果（factory 协程的返回值）
+        """
+        self._stats["requests"] += 1
+        shared = self._inflight_results.get(key)
+        if shared is not None:
+            self._stats["deduplicated"] += 1
+        else:
+            shared = _SharedResult(asyncio.create_task(self._run(key, factory, priority)))
+            self._inflight_results[key] = shared
+
+        shared.subscribers += 1
+        try:
+            return await asyncio.shield(shared.task)
+        finally:
+            shared.subscribers -= 1
+            if shared.subscribers == 0 and not shared.task.done():
+                # 先移除再取消：取消生效前到达的相同请求不能再加入这次即将结束的生成
+                if self._inflight_results.get(key) is shared:
+                    del self._inflight_results[key]
+                shared.task.cancel()
+
+    async def _run(self, key: str, factory: Callable[[], Awaitable[Any]], priority: int) -> Any:
+        """
+        获取名额后执行非流式生成
+
+        @param key - 请求标识
+        @param factory - 创建生成协程的函数
+        @param priority - 优先级
+        @returns 生成结果（factory 协程的返回值）
+        """
+        try:
+            await self._acquire(priority)
+            try:
+                return await factory()
+            finally:
+                self._release()
+        finally:
+            shared = self._inflight_results.get(key)
+            if shared is not None and shared.task is asyncio.current_task():
+                del self._inflight_results[key]
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]],
+                     priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[str]:
+        """
+        执行一次流式生成；相同key的生成正在进行时从头回放并继续跟随
+
+        @remarks 所有订阅者都离开时取消生成，并先从合并表中移除，之后相同的请求重新生成
+        @param key - 请求标识（通常为模型与提示的摘要）
+        @param factory - 创建内容块异步迭代器的函数，只有真正执行时才调用
+        @param priority - 优先级
+        @returns 内容块的异步迭代器
+        """
+        self._stats["requests"] += 1
+        shared = self._inflight_streams.get(key)
+        if shared is not None:
+            self._stats["deduplicated"] += 1
+        else:
+            shared = _SharedStream(self.stream_window)
+            self._inflight_streams[key] = shared
+            shared.task = asyncio.create_task(self._produce(key, shared, factory, priority))
+
+        shared.subscribers += 1
+        try:
+            async for chunk in shared.subscribe():
+                yield chunk
+        finally:
+            shared.subscribers -= 1
+            if shared.subscribers == 0 and not shared.done:
+                # 所有客户端都已断开，停止生成，释放模型；先移除，取消生效前到达的相同请求重新生成
+                if self._inflight_streams.get(key) is shared:
+                    del self._inflight_streams[key]
+                shared.task.cancel()
+
+    async def _produce(self, key: str, shared: _SharedStream,
+                       factory: Callable[[], AsyncIterator[str]], priority: int):
+        """
+        获取名额后执行流式生成，把内容块写入共享缓冲
+
+        @param key - 请求标识
+        @param shared - 共享缓冲
+        @param factory - 创建内容块异步迭代器的函数
+        @param priority - 优先级
+        @returns 无返回值
+        """
+        try:
+            await self._acquire(priority)
+            try:
+                async for chunk in factory():
+                    shared.publish(chunk)
+                    # 订阅者落后太多时暂停读取，让模型输出停留在连接中（TCP流控）
+                    await shared.wait_for_subscribers()
+            finally:
+                self._release()
+            shared.publish(done=True)
+        except asyncio.CancelledError:
+            # CancelledError 不是 Exception，转为普通异常交给仍在读取的订阅者，调用方能按失败处理
+            shared.publish(error=RuntimeError("流式生成已取消"), done=True)
+        except Exception as e:
+            shared.publish(error=e, done=True)
+        finally:
+            if self._inflight_streams.get(key) is shared:
+                del self._inflight_streams[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取调度器的运行指标
+
+        @returns 包含并发数、队列深度、合并次数和等待时间的字典
+        """
+        queued = self._stats["queued"]
+        waiting = [priority for priority, _, future in self._waiters if not future.done()]
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self._active,
+            "queue_depth": len(waiting),
+            "queue_depth_interactive": waiting.count(PRIORITY_INTERACTIVE),
+            "queue_depth_batch": waiting.count(PRIORITY_BATCH),
+            "requests": self._stats["requests"],
+            "deduplicated": self._stats["deduplicated"],
+            "queued": queued,
+            "avg_wait_ms": round(self._stats["wait_seconds"] / queued * 1000, 1) if queued else 0.0,
+            "max_wait_ms": round(self._stats["max_wait_seconds"] * 1000, 1)
+        }
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+LLM用量统计模块 - 从Ollama的生成响应中读取真实的token数和耗时
+
+@remarks Ollama 在非流式响应和流式响应的最后一块（done=True）中返回
+         prompt_eval_count / eval_count（提示与生成的token数）以及各阶段耗时（纳秒）。
+         提示前缀命中Ollama的KV缓存时 prompt_eval_count 可能缺失，此时用本地计数补齐并标记为估算值。
+         每次生成的用量同时累计到全局统计中，供 /metrics 查看
+@author AI Assistant
+@version 1.0
+"""
+
+import threading
+from typing import Any, Dict, Mapping, Optional
+
+_NANOSECONDS_PER_MS = 1_000_000
+
+
+def _field(response: Any, name: str) -> Optional[int]:
+    """
+    读取响应字段（兼容 dict 和 ollama 的响应对象）
+
+    @param response - Ollama 生成响应
+    @param name - 字段名
+    @returns 字段值，缺失时返回None
+    """
+    value = response.get(name) if hasattr(response, "get") else getattr(response, name, None)
+    return int(value) if value is not None else None
+
+
+def usage_from_response(response: Any, estimated_prompt_tokens: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    从Ollama生成响应（或流式的最后一块）中提取用量
+
+    @param response - 包含 prompt_eval_count、eval_count 和耗时字段的响应
+    @param estimated_prompt_tokens - 本地计数的提示token数，响应中缺少 prompt_eval_count 时使用
+    @returns 用量字典（token数、各阶段毫秒数、每秒生成token数），响应不含 eval_count 时返回None
+    @example
+    ```python
+    usage = usage_from_response(client.generate(model=model, prompt=prompt))
+    usage["completion_tokens"], usage["tokens_per_second"]
+    ```
+    """
+    completion_tokens = _field(response, "eval_count")
+    if completion_tokens is None:
+        return None
+    prompt_tokens = _field(response, "prompt_eval_count")
+    usage = {}
+    if prompt_tokens is None:
+        prompt_tokens = estimated_prompt_tokens or 0
+        usage["prompt_tokens_estimated"] = True
+    usage.update({
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    })
+
+    eval_duration = _field(response, "eval_duration") or 0
+    prompt_eval_duration = _field(response, "prompt_eval_duration") or 0
+    usage.update({
+        "prompt_eval_ms": round(prompt_eval_duration / _NANOSECONDS_PER_MS, 1),
+        "eval_ms": round(eval_duration / _NANOSECONDS_PER_MS, 1),
+        "load_ms": round((_field(response, "load_duration") or 0) / _NANOSECONDS_PER_MS, 1),
+        "total_ms": round((_field(response, "total_duration") or 0) / _NANOSECONDS_PER_MS, 1),
+        "tokens_per_second": round(completion_tokens / (eval_duration / 1e9), 2) if eval_duration else None,
+        "prompt_tokens_per_second": (round(prompt_tokens / (prompt_eval_duration / 1e9), 2)
+                                     if prompt_eval_duration and "prompt_tokens_estimated" not in usage else None)
+    })
+    return usage
+
+
+def estimated_usage(prompt_tokens: int, completion_tokens: int) -> Dict[str, Any]:
+    """
+    生成没有Ollama计数时（如回退到langchain）的估算用量
+
+    @param prompt_tokens - 本地计数的提示token数
+    @param completion_tokens - 本地计数的生成token数
+    @returns 标记为估算值的用量字典
+    """
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "estimated": True
+    }
+
+
+def cached_usage() -> Dict[str, Any]:
+    """
+    答案缓存命中（未调用LLM）时的用量
+
+    @returns token数均为0、标记为缓存命中的用量字典
+    """
+    return {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached": True}
+
+
+class UsageStats:
+    """
+    累计所有生成的token数和耗时（线程安全）
+
+    @example
+    ```python
+    stats = UsageStats()
+    stats.record(usage)
+    stats.stats()["avg_tokens_per_second"]
+    ```
+    """
+
+    def __init__(self):
+        """
+        初始化累计统计
+        """
+        self._lock = threading.Lock()
+        self._totals = {
+            "generations": 0,
+            "estimated": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "prompt_eval_ms": 0.0,
+            "eval_ms": 0.0,
+            "load_ms": 0.0,
+            "total_ms": 0.0,
+            "timed_prompt_tokens": 0,  # 有真实提示token数和 prompt_eval_duration 的生成，用于计算预填充速度
+            "timed_prompt_eval_ms": 0.0,
+            "timed_completion_tokens": 0  # 有 eval_duration 的生成token数，用于计算生成速度
+        }
+
+    def record(self, usage: Optional[Mapping[str, Any]]):
+        """
+        累计一次生成的用量
+
+        @param usage - usage_from_response() 或 estimated_usage() 的返回值，None表示忽略
+        @returns 无返回值
+        """
+        if not usage:
+            return
+        with self._lock:
+            totals = self._totals
+            totals["generations"] += 1
+            totals["prompt_tokens"] += usage["prompt_tokens"]
+            totals["completion_tokens"] += usage["completion_tokens"]
+            if usage.get("estimated"):
+                totals["estimated"] += 1
+                return
+            for name in ("prompt_eval_ms", "eval_ms", "load_ms", "total_ms"):
+                totals[name] += usage.get(name) or 0.0
+            if usage.get("eval_ms"):
+                totals["timed_completion_tokens"] += usage["completion_tokens"]
+            if usage.get("prompt_eval_ms") and not usage.get("prompt_tokens_estimated"):
+                totals["timed_prompt_tokens"] += usage["prompt_tokens"]
+                totals["timed_prompt_eval_ms"] += usage["prompt_eval_ms"]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取累计用量
+
+        @returns 包含总token数、平均耗时和平均每秒token数的字典
+        """
+        with self._lock:
+            totals = dict(self._totals)
+        measured = totals["generations"] - totals["estimated"]
+        return {
+            "generations": totals["generations"],
+            "estimated_generations": totals["estimated"],
+            "prompt_tokens": totals["prompt_tokens"],
+            "completion_tokens": totals["completion_tokens"],
+            "total_tokens": totals["prompt_tokens"] + totals["completion_tokens"],
+            "avg_prompt_eval_ms": round(totals["prompt_eval_ms"] / measured, 1) if measured else None,
+            "avg_eval_ms": round(totals["eval_ms"] / measured, 1) if measured else None,
+            "avg_load_ms": round(totals["load_ms"] / measured, 1) if measured else None,
+            "avg_total_ms": round(totals["total_ms"] / measured, 1) if measured else None,
+            "avg_tokens_per_second": (round(totals["timed_completion_tokens"] / (totals["eval_ms"] / 1000), 2)
+                                      if totals["eval_ms"] else None),
+            "avg_prompt_tokens_per_second": (round(totals["timed_prompt_tokens"] / (totals["timed_prompt_eval_ms"] / 1000), 2)
+                                             if totals["timed_prompt_eval_ms"] else None)
+        }
+
@@ -10,41 +10,104 @@ RAG API服务器 - 提供标准的Chat API和文件上传接口
 
 import os
 import json
+import uuid
+import shutil
 import hashlib
 import asyncio
+import threading
+import time
+import functools
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Optional, Union, Tuple, Iterable, Iterator
 from pathlib import Path
 
 # FastAPI相关导入
 from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
-import asyncio
 
 # 文件监控
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 # 原有的RAG系统导入
-import pandas as pd
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.llms import Ollama
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.documents import Document
 
+# Excel摄取（按行分组切分）
+from excel_ingest import load_workbook_chunks, iter_workbook_chunks, write_workbook_tables
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache
+from answer_cache import AnswerCache, answer_cache_key, iter_replay_chunks
+from llm_scheduler import GenerationScheduler, PRIORITY_BATCH, PRIORITY_INTERACTIVE
+from vector_index import ChunkVectorStore
+from keyword_index import KeywordIndex, reciprocal_rank_fusion
+from reranker import CrossEncoderReranker
+from context_builder import TokenCounter, build_context, fit_history
+from llm_usage import UsageStats, cached_usage, estimated_usage, usage_from_response
+from table_engine import TableStore, TableQueryEngine, describe_result
+
 # --- 全局配置 ---
 KNOWLEDGE_BASE_DIR = "./knowledge_base/"  # 知识库文件存储目录
 VECTOR_STORE_DIR = "./vector_store/"      # 向量数据库存储目录
 EMBEDDING_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
 LLM_MODEL_NAME = "qwen3:4b"
-CHUNK_SIZE = 500
-CHUNK_OVERLAP = 50
+CHUNK_TOKEN_BUDGET = 256  # 每个文本块的token预算，整行分组，表头在每个块中重复
+CHUNK_SIZE = 500  # 单个单元格超出预算时按字符切分的段大小
+CHUNK_OVERLAP = 50  # 切分超长单元格时段与段之间的重叠字符数
+INGEST_WORKERS = os.cpu_count() or 1  # 并行解析工作簿的进程数，设为1则在当前进程中逐个解析
+EXCEL_STREAM_MIN_BYTES = 20 * 1024 * 1024  # 不小于该大小的 .xlsx 文件使用只读模式流式读取
+EXCEL_STREAM_BATCH_ROWS = 5000  # 流式读取时每批的行数
+INDEX_ADD_BATCH = 1024  # 每批嵌入并写入向量库的文本块数量
+VECTOR_INDEX_TYPE = "auto"  # 向量索引类型：auto/flat/ivf_flat/hnsw/ivf_pq，auto 按语料规模选择（修改后重建生效）
+IVF_NPROBE = 16  # IVF索引检索时访问的聚类数量，越大召回越高、越慢
+HNSW_EF_SEARCH = 64  # HNSW索引检索时的候选队列长度，越大召回越高、越慢
+VECTOR_QUANTIZATION = "none"  # 索引中向量的存储方式：none/fp16/sq8/pq，量化可大幅减少索引内存（修改后重建生效）
+VECTOR_RERANK_FACTOR = 4  # 量化索引先取 k*该倍数 个候选，再用磁盘上的原始向量精确重排，0表示不重排
+HYBRID_SEARCH_ENABLED = True  # 是否同时使用BM25关键词检索，与向量检索结果做倒数排名融合（RRF）
+HYBRID_CANDIDATES = 20  # 融合前向量检索和关键词检索各取的候选数量（不少于k）
+RERANK_ENABLED = False  # 是否用交叉编码器对检索候选重排（需要 pip install sentence-transformers）
+RERANK_MODEL_NAME = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"  # 重排模型（多语言小型交叉编码器，CPU推理）
+RERANK_CANDIDATES = 20  # 重排前检索的候选数量（不少于k），重排后取前k个放入提示
+RERANK_BUDGET_MS = 300  # 单次请求检索+重排的时间预算（毫秒），预计或实际超出时跳过重排，按检索顺序取前k个
+RERANK_BATCH_SIZE = 16  # 重排模型每批打分的（问题, 文本块）对数量
+PROMPT_TOKENIZER_NAME = "Qwen/Qwen3-4B"  # 计算提示token数的分词器（与LLM_MODEL_NAME对应，需要 pip install tokenizers），None表示估算
+CONTEXT_TOKEN_BUDGET = 1536  # 放入提示的检索结果token上限，按排名装入，0表示不限制
+HISTORY_TOKEN_BUDGET = 512  # 放入问题的对话历史token上限，从最近一轮向前保留，0表示不限制
+TABLE_QUERY_ENABLED = True  # 是否把每个工作表保存为Parquet列式表，统计/筛选类问题在整张表上精确计算
+EXCEL_SNAPSHOT_ENABLED = True  # 是否按文件哈希保存工作簿的Parquet解析快照，文件未变化时重建、调整切分参数不再解析Excel
+EMBEDDING_BATCH_SIZE = 64  # 嵌入模型每次前向计算的文本块数量
+EMBEDDING_THREADS = os.cpu_count() or 1  # torch 算子内并行线程数（CPU推理）
+EMBEDDING_NORMALIZE = False  # 是否对嵌入向量做L2归一化（修改后需要重建向量库）
+EMBEDDING_CACHE_ENABLED = True  # 是否启用按内容寻址的嵌入缓存（存放在向量库目录下）
+EMBEDDING_CACHE_MAX_ENTRIES = 500_000  # 嵌入缓存条目上限，超出后淘汰最久未使用的条目
+QUERY_CACHE_MAX_ENTRIES = 1024  # 查询向量LRU缓存的问题数量上限，设为0则不缓存
+ANSWER_CACHE_ENABLED = True  # 是否缓存生成的答案（问题、检索结果、索引版本和模型都相同时直接复用）
+ANSWER_CACHE_TTL_SECONDS = 600  # 答案缓存有效期（秒），0表示永不过期
+ANSWER_CACHE_MAX_ENTRIES = 512  # 答案缓存条目上限，超出后淘汰最久未使用的答案
+ANSWER_CACHE_PERSIST = False  # 是否将答案缓存写入向量库目录下的SQLite，重启后继续有效
+ANSWER_CACHE_REPLAY_CHARS = 32  # 流式接口回放缓存答案时每个内容块的字符数
+QUERY_EXECUTOR_WORKERS = 8  # 执行检索等阻塞操作的线程数，限制同时占用CPU的查询数量
+STREAM_QUEUE_MAXSIZE = 32  # 线程向异步流转发token时的队列上限，消费方过慢时生产线程会等待
+STREAM_SHARED_WINDOW = 32  # 共享的流式生成最多领先最慢客户端的内容块数量，超出时暂停读取Ollama
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")  # Ollama服务地址
+OLLAMA_MAX_CONNECTIONS = 16  # 到Ollama的HTTP连接池大小
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = 8  # 连接池中保持空闲的长连接数量
+OLLAMA_KEEPALIVE_EXPIRY = 60.0  # 空闲长连接的保留时间（秒）
+OLLAMA_CONNECT_TIMEOUT = 5.0  # 连接Ollama的超时时间（秒）
+OLLAMA_READ_TIMEOUT = 300.0  # 等待Ollama响应（包括首个token）的超时时间（秒）
+OLLAMA_KEEP_ALIVE = "30m"  # 请求结束后模型在Ollama中保持加载的时间，避免每次请求重新加载模型
+LLM_MAX_CONCURRENT_GENERATIONS = 1  # 同时发给Ollama的生成数量，应与 OLLAMA_NUM_PARALLEL 一致
+KB_SCAN_INTERVAL = 30  # 后台扫描知识库变化的间隔（秒）
+KB_WATCH_ENABLED = True  # 是否使用watchdog监听知识库目录的文件事件
+KB_WATCH_QUIET_SECONDS = 2.0  # 文件事件静默窗口（秒），窗口内的连续事件合并为一次更新
 API_HOST = "0.0.0.0"
 API_PORT = 8000
 
@@ -77,7 +140,7 @@ class ChatCompletionResponse(BaseModel):
     created: int = Field(..., description="创建时间戳")
     model: str = Field(..., description="使用的模型")
     choices: List[Dict[str, Any]] = Field(..., description="响应选择列表")
-    usage: Dict[str, int] = Field(..., description="使用统计")
+    usage: Dict[str, Any] = Field(..., description="使用统计：Ollama返回的token数与各阶段耗时")
 
 class FileUploadResponse(BaseModel):
     """文件上传响应模型"""
@@ -87,6 +150,84 @@ class FileUploadResponse(BaseModel):
     message: str = Field(..., description="响应消息")
     file_hash: str = Field(..., description="文件哈希值")
 
+# --- 提示模板 ---
+RAG_PROMPT = ChatPromptTemplate.from_template(
+    """
+    请你扮演一个有用的助手。请根据下面提供的背景信息来回答用户的问题。
+    如果背景信息中没有足够的内容来回答问题，请明确说明你无法从提供的信息中找到答案，不要编造。
+    请使用中文回答。
+
+    背景信息:
+    {context}
+
+    用户问题:
+    {question}
+
+    回答:
+    """
+)
+
+# --- 异步工具 ---
+_STREAM_END = object()
+
+
+async def iterate_in_thread(iterable: Iterable[Any], executor: ThreadPoolExecutor,
+                            maxsize: int = STREAM_QUEUE_MAXSIZE):
+    """
+    在线程中迭代同步可迭代对象，并通过有界 asyncio.Queue 将元素交给异步消费方
+
+    @remarks 队列满时生产线程阻塞等待，慢速消费方不会导致内存堆积；
+             消费方提前退出（如客户端断开）时生产线程在当前元素之后停止，并关闭源迭代器
+    @param iterable - 同步可迭代对象（如同步的流式生成器）
+    @param executor - 执行迭代的线程池
+    @param maxsize - 队列上限
+    @returns 异步生成器，依次产生 iterable 中的元素
+    @example
+    ```python
+    async for token in iterate_in_thread(llm.stream(prompt), executor):
+        ...
+    ```
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        # 消费方已退出时不再放入，避免在没有人读取的满队列上永久阻塞
+        if not stopped.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                put(item)
+                if stopped.is_set():
+                    return
+            put(_STREAM_END)
+        except BaseException as e:
+            put(e)
+        finally:
+            # 关闭源迭代器（如同步生成器、HTTP 流式响应），及时释放它持有的连接
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # 生产线程可能正等待放入队列：清空队列后它最多再放入一个元素就会看到停止标记
+        stopped.set()
+        while not queue.empty():
+            queue.get_nowait()
+
 # --- 增强的RAG系统 ---
 class EnhancedRAGSystem:
     """
@@ -94,7 +235,7 @@ class EnhancedRAGSystem:
 
     @remarks 相比原版增加了以下功能：
              1. 文件变化监控
-             2. 向量库缓存和增量更新
+             2. 向量库缓存和增量更新（按文件记录向量ID，只重新嵌入变化的文件）
              3. 工具调用模拟
              4. 文件级别的查询支持
     """
@@ -118,28 +259,101 @@ class EnhancedRAGSystem:
 
         # 初始化模型
         print(f"正在初始化增强RAG系统...")
+        self._configure_torch_threads(EMBEDDING_THREADS)
         self.embeddings = HuggingFaceEmbeddings(
             model_name=embedding_model_name,
-            model_kwargs={'device': 'cpu'}
-        )
-        self.llm = Ollama(model=llm_model_name)
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE,
-            chunk_overlap=CHUNK_OVERLAP,
-            length_function=len,
-            is_separator_regex=False,
+            model_kwargs={'device': 'cpu'},
+            encode_kwargs={
+                'batch_size': EMBEDDING_BATCH_SIZE,
+                'normalize_embeddings': EMBEDDING_NORMALIZE
+            }
         )
+        self.llm = Ollama(model=llm_model_name, base_url=OLLAMA_HOST, keep_alive=OLLAMA_KEEP_ALIVE)
+
+        # Ollama客户端：整个系统共享，按需创建；异步客户端与事件循环绑定
+        self._ollama_client = None
+        self._ollama_async_client = None
+        self._ollama_async_loop = None
+        self._ollama_client_lock = threading.Lock()
+
+        # 生成调度器：限制并发、交互请求优先、合并相同的进行中生成
+        self.generation_scheduler = GenerationScheduler(LLM_MAX_CONCURRENT_GENERATIONS, STREAM_SHARED_WINDOW)
+        # LLM用量：Ollama返回的真实token数与耗时，累计后在 /metrics 中查看
+        self.usage_stats = UsageStats()
+
+        # 列式表：摄取时把每个工作表写为Parquet（同时是按文件哈希保存的解析快照），
+        # 统计/筛选类问题由表格查询工具精确计算
+        self.table_store = None
+        self.table_engine = None
+        if TABLE_QUERY_ENABLED or EXCEL_SNAPSHOT_ENABLED:
+            self.table_store = TableStore(self.vector_store_dir / "tables")
+        if TABLE_QUERY_ENABLED:
+            self.table_engine = TableQueryEngine(self.table_store)
+        self._table_backfill_attempted = set()  # 已尝试补建列式表的 (文件, 哈希)
 
         # 向量数据库和文件哈希缓存
         self.vector_store = None
-        self.file_hashes = {}  # 文件哈希缓存，用于检测文件变化
+        self.keyword_index = None  # BM25关键词索引，与向量库使用相同的文本块ID
+        self.file_manifest = {}  # 文件清单：size/mtime/inode/hash，stat不变时跳过哈希计算
+        self.file_chunk_ids = {}  # 文件 -> 向量ID列表，用于按文件增量更新
         self.last_update_time = None
 
+        # 嵌入统计，用于观察吞吐（文本块/秒）
+        self.embedding_stats = {"chunks": 0, "seconds": 0.0}
+
+        # 嵌入缓存：键包含模型名和归一化设置，内容未变的文本块不再重新计算
+        self.embedding_model_key = f"{embedding_model_name}|normalize={EMBEDDING_NORMALIZE}"
+        self.embedding_cache = None
+        if EMBEDDING_CACHE_ENABLED:
+            self.embedding_cache = EmbeddingCache(
+                self.vector_store_dir / "embedding_cache.sqlite3",
+                self.embedding_model_key,
+                max_entries=EMBEDDING_CACHE_MAX_ENTRIES
+            )
+        # 查询向量缓存：重复的问题跳过模型编码，嵌入模型变化时失效
+        self.query_cache = QueryEmbeddingCache(QUERY_CACHE_MAX_ENTRIES)
+        # 交叉编码器重排：模型在首次查询时加载
+        self.reranker = CrossEncoderReranker(RERANK_MODEL_NAME, batch_size=RERANK_BATCH_SIZE) if RERANK_ENABLED else None
+        # 目标模型的token计数器，用于在预算内组装上下文；启动时加载分词器，不在请求中加载
+        self.token_counter = TokenCounter(PROMPT_TOKENIZER_NAME)
+        print(f"提示token计数方式: {self.token_counter.name}")
+
+        # 答案缓存：键包含检索到的文本块ID和索引版本，索引每次变化都会生成新版本
+        self.index_version = uuid.uuid4().hex
+        self.answer_cache = None
+        if ANSWER_CACHE_ENABLED:
+            self.answer_cache = AnswerCache(
+                ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                db_path=self.vector_store_dir / "answer_cache.sqlite3" if ANSWER_CACHE_PERSIST else None
+            )
+
+        # 向量库修改锁：嵌入计算在锁外进行，只有写入/检索索引时持有
+        self._index_lock = threading.RLock()
+        # 更新锁：保证同一时间只有一个更新/重建任务在运行
+        self._update_lock = threading.RLock()
+        # 查询线程池：异步接口中的阻塞操作在这里执行，不占用事件循环
+        self._query_executor = ThreadPoolExecutor(max_workers=QUERY_EXECUTOR_WORKERS, thread_name_prefix="rag-query")
+
         # 加载现有的向量数据库（如果存在）
         self._load_existing_vector_store()
 
         print(f"增强RAG系统初始化完成。")
 
+    @staticmethod
+    def _configure_torch_threads(num_threads: int):
+        """
+        设置torch在CPU上的算子内并行线程数
+
+        @param num_threads - 线程数
+        @returns 无返回值
+        """
+        try:
+            import torch
+            torch.set_num_threads(num_threads)
+        except ImportError:
+            pass
+
     def _calculate_file_hash(self, file_path: Path) -> str:
         """
         计算文件的MD5哈希值
@@ -150,7 +364,7 @@ class EnhancedRAGSystem:
         hash_md5 = hashlib.md5()
         try:
             with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
                     hash_md5.update(chunk)
             return hash_md5.hexdigest()
         except Exception as e:
@@ -163,77 +377,240 @@ class EnhancedRAGSystem:
 
         @returns 无返回值
         """
-        vector_store_path = self.vector_store_dir / "faiss_index"
+        vector_store_path = self.vector_store_dir / "chunk_store"
+        if not vector_store_path.exists() and (self.vector_store_dir / "faiss_index").exists():
+            # 旧版本使用pickle保存docstore，不再加载；不读取文件清单，首次更新时全量重建
+            print("检测到旧格式（pickle）的向量库，将在首次更新时重建。")
+            return
+
         if vector_store_path.exists():
             try:
                 print("正在加载现有的向量数据库...")
-                self.vector_store = FAISS.load_local(
-                    str(vector_store_path),
-                    self.embeddings,
-                    allow_dangerous_deserialization=True
-                )
+                self.vector_store = ChunkVectorStore.load(vector_store_path)
+                self.vector_store.configure_search(nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH,
+                                                   rerank_factor=VECTOR_RERANK_FACTOR)
+                self._load_keyword_index()
 
-                # 加载文件哈希缓存
+                # 加载文件清单；旧版本只有 file_hashes.json，缺少stat信息的文件会在下次扫描时重新哈希一次
+                manifest_path = self.vector_store_dir / "file_manifest.json"
                 hash_cache_path = self.vector_store_dir / "file_hashes.json"
-                if hash_cache_path.exists():
+                if manifest_path.exists():
+                    with open(manifest_path, 'r', encoding='utf-8') as f:
+                        self.file_manifest = json.load(f)
+                elif hash_cache_path.exists():
                     with open(hash_cache_path, 'r', encoding='utf-8') as f:
-                        self.file_hashes = json.load(f)
+                        self.file_manifest = {
+                            file_key: {"hash": file_hash}
+                            for file_key, file_hash in json.load(f).items()
+                        }
+
+                # 加载文件与向量ID的映射（旧版本向量库没有该文件，首次更新时会全量重建）
+                chunk_ids_path = self.vector_store_dir / "file_chunk_ids.json"
+                if chunk_ids_path.exists():
+                    with open(chunk_ids_path, 'r', encoding='utf-8') as f:
+                        self.file_chunk_ids = json.load(f)
+
+                # 加载索引版本（旧版本向量库没有该文件，沿用初始化时生成的新版本）
+                version_path = self.vector_store_dir / "index_version.txt"
+                if version_path.exists():
+                    self.index_version = version_path.read_text(encoding='utf-8').strip() or self.index_version
 
-                print(f"成功加载现有向量数据库，包含 {self.vector_store.index.ntotal} 个向量。")
+                print(f"成功加载现有向量数据库，包含 {self.vector_store.ntotal} 个向量。")
                 self.last_update_time = datetime.now()
             except Exception as e:
                 print(f"加载现有向量数据库失败: {e}")
+                # 清空文件清单，首次更新时全量重建
                 self.vector_store = None
+                self.keyword_index = None
+                self.file_manifest = {}
+                self.file_chunk_ids = {}
+
+    def _load_keyword_index(self):
+        """
+        加载关键词索引；不存在（旧版本向量库）或分词方式已变化时从向量库的文本重建
+
+        @returns 无返回值
+        """
+        if not HYBRID_SEARCH_ENABLED or self.vector_store is None:
+            return
+        self.keyword_index = KeywordIndex.load(self.vector_store_dir / "keyword_index")
+        if self.keyword_index is None:
+            print("正在从向量库重建关键词索引...")
+            self.keyword_index = KeywordIndex()
+            texts = self.vector_store.iter_texts()
+            while True:
+                batch = list(islice(texts, INDEX_ADD_BATCH))
+                if not batch:
+                    break
+                self.keyword_index.add([chunk_id for chunk_id, _ in batch], [text for _, text in batch])
+            self.keyword_index.save(self.vector_store_dir / "keyword_index")
+        print(f"关键词索引包含 {len(self.keyword_index)} 个文本块。")
 
     def _save_vector_store(self):
         """
         保存向量数据库到磁盘
 
+        @remarks 只有修改内存结构的步骤（训练缓存的向量、切换到新写入的段）持有 _index_lock，
+                 写文件在锁外进行，保存期间检索不被阻塞。所有增删都在 _update_lock 下串行执行，
+                 这里同样持有 _update_lock，保证写文件期间索引内容不变；调用方不能持有 _index_lock
         @returns 无返回值
         """
-        if self.vector_store is not None:
+        vector_store_path = self.vector_store_dir / "chunk_store"
+        keyword_index_path = self.vector_store_dir / "keyword_index"
+        with self._update_lock:
             try:
-                vector_store_path = self.vector_store_dir / "faiss_index"
-                self.vector_store.save_local(str(vector_store_path))
-
-                # 保存文件哈希缓存
-                hash_cache_path = self.vector_store_dir / "file_hashes.json"
-                with open(hash_cache_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.file_hashes, f, ensure_ascii=False, indent=2)
+                with self._index_lock:
+                    vector_store, keyword_index = self.vector_store, self.keyword_index
+                    if vector_store is not None:
+                        vector_store.finalize()
+                    file_manifest = dict(self.file_manifest)
+                    file_chunk_ids = dict(self.file_chunk_ids)
+                    index_version = self.index_version
+
+                if vector_store is not None:
+                    vector_written = vector_store.write_files(vector_store_path)
+                elif vector_store_path.exists():
+                    # 所有文件都被删除后，移除磁盘上过期的索引，避免重启后重新加载
+                    shutil.rmtree(vector_store_path, ignore_errors=True)
+
+                # 保存关键词索引（与向量库使用相同的文本块ID）
+                if keyword_index is not None:
+                    keyword_written = keyword_index.write_files(keyword_index_path)
+                elif keyword_index_path.exists():
+                    shutil.rmtree(keyword_index_path, ignore_errors=True)
+
+                with self._index_lock:
+                    if vector_store is not None:
+                        vector_store.apply_saved_files(vector_store_path, vector_written)
+                    if keyword_index is not None:
+                        keyword_index.apply_saved_files(keyword_index_path, keyword_written)
+
+                # 移除旧格式（pickle）的向量库
+                legacy_path = self.vector_store_dir / "faiss_index"
+                if legacy_path.exists():
+                    shutil.rmtree(legacy_path, ignore_errors=True)
+
+                # 保存文件清单
+                self._save_file_manifest(file_manifest)
+
+                # 保存文件与向量ID的映射
+                chunk_ids_path = self.vector_store_dir / "file_chunk_ids.json"
+                with open(chunk_ids_path, 'w', encoding='utf-8') as f:
+                    json.dump(file_chunk_ids, f, ensure_ascii=False)
+
+                # 保存索引版本，重启后持久化的答案缓存仍可命中
+                (self.vector_store_dir / "index_version.txt").write_text(index_version, encoding='utf-8')
 
                 print("向量数据库已保存到磁盘。")
             except Exception as e:
                 print(f"保存向量数据库失败: {e}")
 
-    def check_files_changed(self) -> bool:
+    def _mark_index_changed(self):
         """
-        检查知识库文件是否有变化
+        索引内容变化后生成新的索引版本，使旧的答案缓存失效（调用方需持有 _index_lock）
 
-        @returns 如果有文件变化返回True，否则返回False
+        @returns 无返回值
+        """
+        self.index_version = uuid.uuid4().hex
+
+    def _list_excel_files(self) -> List[Path]:
         """
-        current_hashes = {}
-        files_changed = False
+        列出知识库目录中的所有Excel文件（同时支持 .xlsx 和 .xls）
 
-        # 检查所有Excel文件（同时支持 .xlsx 和 .xls）
+        @returns Excel文件路径列表
+        """
+        excel_files = []
         for pattern in ["*.xlsx", "*.xls"]:
-            for file_path in self.knowledge_base_dir.glob(pattern):
-                current_hash = self._calculate_file_hash(file_path)
-                file_key = str(file_path.relative_to(self.knowledge_base_dir))
-                current_hashes[file_key] = current_hash
+            excel_files.extend(list(self.knowledge_base_dir.glob(pattern)))
+        return excel_files
+
+    def _scan_manifest(self) -> Dict[str, Dict[str, Any]]:
+        """
+        扫描知识库目录，生成当前的文件清单
+
+        @remarks 只有 size/mtime/inode 与缓存不一致的文件才会重新计算MD5，
+                 未变化的文件直接复用缓存中的哈希，避免每次扫描都读取全部文件
+        @returns 文件清单，键为相对文件名，值包含 size/mtime_ns/inode/hash
+        """
+        current_manifest = {}
+        for file_path in self._list_excel_files():
+            file_key = str(file_path.relative_to(self.knowledge_base_dir))
+            try:
+                file_stat = file_path.stat()
+            except OSError as e:
+                print(f"读取文件信息时出错 {file_path}: {e}")
+                continue
+
+            entry = {
+                "size": file_stat.st_size,
+                "mtime_ns": file_stat.st_mtime_ns,
+                "inode": file_stat.st_ino,
+            }
+            cached = self.file_manifest.get(file_key, {})
+            if cached.get("hash") and all(cached.get(name) == value for name, value in entry.items()):
+                entry["hash"] = cached["hash"]
+            else:
+                entry["hash"] = self._calculate_file_hash(file_path)
+            current_manifest[file_key] = entry
+        return current_manifest
+
+    def detect_file_changes(self) -> Tuple[List[str], List[str], Dict[str, Dict[str, Any]]]:
+        """
+        对比当前文件清单与缓存，找出新增/修改和删除的文件
+
+        @returns (新增或修改的文件列表, 删除的文件列表, 当前文件清单)
+        """
+        current_manifest = self._scan_manifest()
 
-                # 检查是否是新文件或文件已修改
-                if file_key not in self.file_hashes or self.file_hashes[file_key] != current_hash:
-                    files_changed = True
-                    print(f"检测到文件变化: {file_key}")
+        changed_files = []
+        for file_key, entry in current_manifest.items():
+            # 检查是否是新文件或文件内容已修改（只touch文件时哈希不变，不会触发更新）
+            cached_hash = self.file_manifest.get(file_key, {}).get("hash")
+            if cached_hash != entry["hash"]:
+                changed_files.append(file_key)
+                print(f"检测到文件变化: {file_key}")
 
         # 检查是否有文件被删除
-        for file_key in self.file_hashes:
-            if file_key not in current_hashes:
-                files_changed = True
+        deleted_files = []
+        for file_key in self.file_manifest:
+            if file_key not in current_manifest:
+                deleted_files.append(file_key)
                 print(f"检测到文件删除: {file_key}")
 
-        self.file_hashes = current_hashes
-        return files_changed
+        return changed_files, deleted_files, current_manifest
+
+    def _save_file_manifest(self, file_manifest: Optional[Dict[str, Dict[str, Any]]] = None):
+        """
+        保存文件清单到磁盘
+
+        @param file_manifest - 要保存的清单，None表示当前清单
+        @returns 无返回值
+        """
+        manifest_path = self.vector_store_dir / "file_manifest.json"
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(self.file_manifest if file_manifest is None else file_manifest, f, ensure_ascii=False, indent=2)
+
+    def check_files_changed(self) -> bool:
+        """
+        检查知识库文件是否有变化
+
+        @returns 如果有文件变化返回True，否则返回False
+        """
+        changed_files, deleted_files, _ = self.detect_file_changes()
+        return bool(changed_files or deleted_files)
+
+    def _load_file_documents(self, file_path: Path) -> List[Document]:
+        """
+        加载单个Excel文件，每个非空工作表按整行分组切分为多个Document
+
+        @param file_path - Excel文件路径
+        @returns Document对象列表（元数据含 row_start/row_end），读取失败时返回空列表
+        """
+        table_dir = self.table_store.table_root if self.table_store is not None else None
+        try:
+            return load_workbook_chunks(file_path, CHUNK_TOKEN_BUDGET, CHUNK_SIZE, CHUNK_OVERLAP, table_dir)
+        except Exception:
+            return []
 
     def _load_excel_documents(self) -> List[Document]:
         """
@@ -242,144 +619,530 @@ class EnhancedRAGSystem:
         @returns Document对象列表
         """
         print(f"正在从知识库目录加载Excel文件...")
-        all_docs = []
-
-        # 收集所有Excel文件（同时支持 .xlsx 和 .xls）
-        excel_files = []
-        for pattern in ["*.xlsx", "*.xls"]:
-            excel_files.extend(list(self.knowledge_base_dir.glob(pattern)))
-
+        excel_files = self._list_excel_files()
         if not excel_files:
             print(f"警告：在知识库目录中未找到任何Excel文件。")
             return []
 
-        for file_path in excel_files:
-            print(f"  正在处理文件: {file_path.name}")
+        all_docs = []
+        for file_path, chunks in self._iter_workbooks(excel_files):
             try:
-                # 根据文件扩展名选择合适的引擎
-                file_extension = file_path.suffix.lower()
-                if file_extension == '.xls':
-                    # 对于 .xls 文件，尝试使用 xlrd 引擎
-                    try:
-                        xls = pd.read_excel(file_path, sheet_name=None, engine='xlrd')
-                    except ImportError:
-                        print(f"    警告：缺少 xlrd 依赖，无法读取 .xls 文件 {file_path.name}")
-                        print(f"    请运行: pip install xlrd")
-                        continue
-                    except Exception as e:
-                        print(f"    使用 xlrd 引擎读取 .xls 文件失败，尝试默认引擎: {e}")
-                        try:
-                            xls = pd.read_excel(file_path, sheet_name=None)
-                        except Exception as e2:
-                            print(f"    使用默认引擎也失败: {e2}")
-                            continue
-                else:
-                    # 对于 .xlsx 文件，使用默认引擎（openpyxl）
-                    xls = pd.read_excel(file_path, sheet_name=None)
-
-                for sheet_name, df in xls.items():
-                    if not df.empty:
-                        sheet_content = ""
-                        for index, row in df.iterrows():
-                            row_texts = []
-                            for col_name, cell_value in row.items():
-                                cell_text = str(cell_value).strip()
-                                if cell_text and cell_text != 'nan':
-                                    row_texts.append(f"{str(col_name).strip()}: {cell_text}")
-                            if row_texts:
-                                sheet_content += ", ".join(row_texts) + "\n"
-
-                        if sheet_content.strip():
-                            doc = Document(
-                                page_content=sheet_content.strip(),
-                                metadata={
-                                    "source_file": file_path.name,
-                                    "sheet_name": sheet_name,
-                                    "file_path": str(file_path)
-                                }
-                            )
-                            all_docs.append(doc)
+                all_docs.extend(list(chunks))
             except Exception as e:
-                print(f"    处理文件 {file_path.name} 时发生错误: {e}")
-                if "xlrd" in str(e).lower():
-                    print(f"    提示：这是一个 .xls 文件，需要安装 xlrd 依赖")
-                    print(f"    请运行: pip install xlrd")
+                print(f"跳过读取失败的文件 {file_path.name}: {e}")
 
         print(f"Excel文件加载完毕，共加载了 {len(all_docs)} 个文档。")
         return all_docs
 
+    def _iter_workbooks(self, file_paths: Iterable[Path]) -> Iterator[Tuple[Path, Iterable[Document]]]:
+        """
+        用进程池并行解析并切分多个文件，大文件以流式迭代器返回
+
+        @remarks 启用表格查询或解析快照时，解析的同时把每个工作表写为Parquet列式表；
+                 内容未变化（哈希与快照一致）的文件直接从快照切分，全量重建和修改切分参数后重建都不必重新解析Excel
+        @param file_paths - Excel文件路径列表
+        @returns 按解析完成顺序生成 (文件路径, 文本块列表或惰性迭代器) 的迭代器
+        """
+        table_dir = self.table_store.table_root if self.table_store is not None else None
+        return iter_workbook_chunks(file_paths, CHUNK_TOKEN_BUDGET, CHUNK_SIZE, CHUNK_OVERLAP,
+                                    INGEST_WORKERS, EXCEL_STREAM_MIN_BYTES, EXCEL_STREAM_BATCH_ROWS, table_dir)
+
+    def _iter_file_chunk_batches(self, file_paths: Iterable[Path]) -> Iterator[Tuple[str, Iterator[List[Document]]]]:
+        """
+        按文件产出分批的文本块，并为每个文本块分配唯一的向量ID
+
+        @remarks 每批最多 INDEX_ADD_BATCH 个文本块，调用方逐批嵌入并写入向量库，
+                 流式读取的大文件因此不会在内存中积累全部文本块
+        @param file_paths - Excel文件路径列表
+        @returns 生成 (相对文件名, 文本块批次迭代器) 的迭代器
+        """
+        for file_path, text_chunks in self._iter_workbooks(file_paths):
+            yield str(file_path.relative_to(self.knowledge_base_dir)), self._batch_chunks(text_chunks)
+
+    @staticmethod
+    def _batch_chunks(text_chunks: Iterable[Document]) -> Iterator[List[Document]]:
+        """
+        把文本块按 INDEX_ADD_BATCH 分批（chunk_id 在写入向量库时分配）
+
+        @param text_chunks - 文本块列表或惰性迭代器
+        @returns 文本块批次迭代器
+        """
+        chunk_iter = iter(text_chunks)
+        while True:
+            batch = list(islice(chunk_iter, INDEX_ADD_BATCH))
+            if not batch:
+                return
+            yield batch
+
+    def _embed_chunks(self, text_chunks: List[Document]) -> List[List[float]]:
+        """
+        计算文本块的嵌入向量
+
+        @param text_chunks - 文本块列表
+        @returns 与文本块一一对应的嵌入向量
+        """
+        if not text_chunks:
+            return []
+        return self._embed_texts([chunk.page_content for chunk in text_chunks])
+
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """
+        分批计算文本的嵌入向量
+
+        @remarks 先查嵌入缓存，只对未命中的文本计算；未命中的文本按长度排序再分批，
+                 同一批内的文本长度接近，填充（padding）最少；
+                 结果按原顺序返回，并累计吞吐统计
+        @param texts - 文本列表
+        @returns 与文本一一对应的嵌入向量
+        """
+        start_time = time.perf_counter()
+        vectors = [None] * len(texts)
+        if self.embedding_cache is not None:
+            for i, vector in self.embedding_cache.get_many(texts).items():
+                vectors[i] = vector
+
+        # 未命中的文本去重后再计算
+        pending = {}
+        for i, text in enumerate(texts):
+            if vectors[i] is None:
+                pending.setdefault(text, []).append(i)
+        pending_texts = sorted(pending, key=len, reverse=True)
+
+        computed = []
+        for batch_start in range(0, len(pending_texts), EMBEDDING_BATCH_SIZE):
+            batch_texts = pending_texts[batch_start:batch_start + EMBEDDING_BATCH_SIZE]
+            computed.extend(self.embeddings.embed_documents(batch_texts))
+        for text, vector in zip(pending_texts, computed):
+            for i in pending[text]:
+                vectors[i] = vector
+        if self.embedding_cache is not None and pending_texts:
+            self.embedding_cache.put_many(pending_texts, computed)
+
+        elapsed = time.perf_counter() - start_time
+        self.embedding_stats["chunks"] += len(pending_texts)
+        self.embedding_stats["seconds"] += elapsed
+        cached = len(texts) - sum(len(indices) for indices in pending.values())
+        print(f"  已嵌入 {len(pending_texts)} 个文本块（缓存命中 {cached} 个），耗时 {elapsed:.2f} 秒"
+              f"（{len(pending_texts) / max(elapsed, 1e-9):.1f} 块/秒）")
+        return vectors
+
+    def get_embedding_stats(self) -> Dict[str, Any]:
+        """
+        获取嵌入阶段的配置与累计吞吐
+
+        @returns 嵌入统计信息
+        """
+        chunks = self.embedding_stats["chunks"]
+        seconds = self.embedding_stats["seconds"]
+        return {
+            "batch_size": EMBEDDING_BATCH_SIZE,
+            "threads": EMBEDDING_THREADS,
+            "normalize": EMBEDDING_NORMALIZE,
+            "embedded_chunks": chunks,
+            "chunks_per_sec": round(chunks / seconds, 1) if seconds > 0 else None,
+            "cache": self.embedding_cache.stats() if self.embedding_cache is not None else None,
+            "query_cache": self.query_cache.stats()
+        }
+
+    def _remove_file_vectors(self, file_key: str) -> int:
+        """
+        从向量库中删除某个文件的全部向量（调用方需持有 _index_lock）
+
+        @param file_key - 相对于知识库目录的文件名
+        @returns 删除的向量数量
+        """
+        chunk_ids = self.file_chunk_ids.pop(file_key, [])
+        if not chunk_ids or self.vector_store is None:
+            return 0
+        self.vector_store.delete(chunk_ids)
+        if self.keyword_index is not None:
+            self.keyword_index.delete(chunk_ids)
+        return len(chunk_ids)
+
+    def _append_chunks(self, store: Optional[ChunkVectorStore], text_chunks: List[Document],
+                       vectors: List[List[float]]) -> Optional[ChunkVectorStore]:
+        """
+        把已嵌入的文本块写入指定的向量库，向量库不存在时新建
+
+        @param store - 目标向量库，None表示新建
+        @param text_chunks - 文本块列表，写入后元数据中带有分配的 chunk_id
+        @param vectors - 与文本块一一对应的嵌入向量
+        @returns 写入后的向量库
+        """
+        if not text_chunks:
+            return store
+
+        if store is None:
+            # 以当前向量库的规模作为预计规模，首次构建时由向量库攒够样本后再确定
+            expected_vectors = self.vector_store.ntotal if self.vector_store is not None else 0
+            store = ChunkVectorStore(len(vectors[0]), index_spec=VECTOR_INDEX_TYPE, expected_vectors=expected_vectors,
+                                     quantization=VECTOR_QUANTIZATION)
+            store.configure_search(nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH, rerank_factor=VECTOR_RERANK_FACTOR)
+        store.add(text_chunks, vectors)
+        return store
+
+    @staticmethod
+    def _append_keywords(keyword_index: Optional[KeywordIndex], text_chunks: List[Document]) -> Optional[KeywordIndex]:
+        """
+        把已分配ID的文本块写入关键词索引，索引不存在时新建
+
+        @param keyword_index - 目标关键词索引，None表示新建
+        @param text_chunks - 已写入向量库（元数据中带有 chunk_id）的文本块
+        @returns 写入后的关键词索引，未启用混合检索时返回None
+        """
+        if not HYBRID_SEARCH_ENABLED or not text_chunks:
+            return keyword_index
+        if keyword_index is None:
+            keyword_index = KeywordIndex()
+        keyword_index.add([chunk.metadata["chunk_id"] for chunk in text_chunks],
+                          [chunk.page_content for chunk in text_chunks])
+        return keyword_index
+
     def rebuild_vector_store(self) -> bool:
         """
         重新构建向量数据库
 
         @returns 构建成功返回True，否则返回False
         """
-        print("正在重新构建向量数据库...")
+        with self._update_lock:
+            return self._rebuild_vector_store()
 
-        # 1. 加载文档
-        documents = self._load_excel_documents()
-        if not documents:
-            print("没有找到文档，无法构建向量数据库。")
-            return False
+    def _rebuild_vector_store(self, current_manifest: Optional[Dict[str, Dict[str, Any]]] = None) -> bool:
+        """
+        重新构建向量数据库的具体实现（调用方需持有 _update_lock）
 
-        # 2. 分割文档
-        text_chunks = self.text_splitter.split_documents(documents)
-        if not text_chunks:
-            print("文档分割失败，无法构建向量数据库。")
-            return False
+        @remarks 单个文件处理失败时撤销该文件已写入的文本块，并且不把它记入文件清单，
+                 其他文件照常提交；失败的文件在下一次扫描时作为新增文件重试
+        @param current_manifest - 已扫描好的文件清单，None表示重新扫描
+        @returns 构建成功返回True，否则返回False
+        """
+        print("正在重新构建向量数据库...")
 
-        print(f"文档分割完成，共得到 {len(text_chunks)} 个文本块。")
+        # 1. 并行解析并按行切分文档，每个文件解析完成后立即嵌入，解析与嵌入流水线执行
+        # 先记录文件清单，重建期间被修改的文件会在下一次扫描时再次更新
+        if current_manifest is None:
+            current_manifest = self._scan_manifest()
+        excel_files = self._list_excel_files()
 
-        # 3. 构建向量数据库
         try:
-            self.vector_store = FAISS.from_documents(documents=text_chunks, embedding=self.embeddings)
-            self.last_update_time = datetime.now()
+            new_store = None
+            new_keyword_index = None
+            new_chunk_ids = {}
+            total_chunks = 0
+            current_manifest = dict(current_manifest)
+            for file_key, chunk_batches in self._iter_file_chunk_batches(excel_files):
+                file_chunk_ids = []
+                try:
+                    for text_chunks in chunk_batches:
+                        # 2. 分批嵌入并写入新的向量库（旧向量库在重建完成前仍可用于检索）
+                        new_store = self._append_chunks(new_store, text_chunks, self._embed_chunks(text_chunks))
+                        new_keyword_index = self._append_keywords(new_keyword_index, text_chunks)
+                        file_chunk_ids.extend(chunk.metadata["chunk_id"] for chunk in text_chunks)
+                except Exception as e:
+                    # 撤销该文件已写入的部分文本块，不记入清单，下一次扫描时重试
+                    if file_chunk_ids:
+                        new_store.delete(file_chunk_ids)
+                        if new_keyword_index is not None:
+                            new_keyword_index.delete(file_chunk_ids)
+                    current_manifest.pop(file_key, None)
+                    print(f"文件 {file_key} 处理失败，已跳过，下次扫描时重试: {e}")
+                    continue
+                new_chunk_ids[file_key] = file_chunk_ids
+                total_chunks += len(file_chunk_ids)
+
+            if new_store is not None and new_store.ntotal == 0:
+                # 写入过文本块的文件全部失败
+                new_store = None
+                new_keyword_index = None
+
+            if new_store is None:
+                print("没有找到文档，无法构建向量数据库。")
+                if not excel_files:
+                    # 知识库已清空，同步清理向量库，避免继续检索已删除文件的内容
+                    with self._index_lock:
+                        self.vector_store = None
+                        self.keyword_index = None
+                        self.file_manifest = {}
+                        self.file_chunk_ids = {}
+                        self._retain_tables([])
+                        self._mark_index_changed()
+                    self._save_vector_store()
+                return False
+
+            print(f"文档切分完成，共得到 {total_chunks} 个文本块。")
+            # 在锁外完成索引训练，切换时不阻塞检索
+            new_store.finalize()
+
+            with self._index_lock:
+                self.vector_store = new_store
+                self.keyword_index = new_keyword_index
+                self.file_chunk_ids = new_chunk_ids
+                self.file_manifest = current_manifest
+                self._retain_tables(new_chunk_ids)
+                self.last_update_time = datetime.now()
+                self._mark_index_changed()
 
-            # 保存到磁盘
+            # 保存到磁盘（写文件在锁外进行，不阻塞检索）
             self._save_vector_store()
 
-            print(f"向量数据库重建完成，包含 {self.vector_store.index.ntotal} 个向量。")
+            print(f"向量数据库重建完成，包含 {new_store.ntotal} 个向量。")
             return True
         except Exception as e:
             print(f"构建向量数据库时发生错误: {e}")
             return False
 
+    def apply_incremental_update(self, changed_files: List[str], deleted_files: List[str],
+                                 current_manifest: Dict[str, Dict[str, Any]]) -> bool:
+        """
+        按文件增量更新向量数据库：删除文件只移除其向量，新增/修改文件只重新嵌入该文件
+
+        @param changed_files - 新增或修改的文件列表
+        @param deleted_files - 已删除的文件列表
+        @param current_manifest - 当前文件清单
+        @returns 更新成功返回True，否则返回False
+        """
+        try:
+            with self._index_lock:
+                for file_key in deleted_files:
+                    removed = self._remove_file_vectors(file_key)
+                    self.file_manifest.pop(file_key, None)
+                    if self.table_store is not None:
+                        self.table_store.remove(file_key)
+                    print(f"已移除文件 {file_key} 的 {removed} 个向量。")
+
+            changed_paths = [self.knowledge_base_dir / file_key for file_key in changed_files]
+            for file_key, chunk_batches in self._iter_file_chunk_batches(changed_paths):
+                new_chunk_ids = []
+                try:
+                    for text_chunks in chunk_batches:
+                        # 嵌入计算耗时较长，在锁外完成，避免阻塞检索
+                        vectors = self._embed_chunks(text_chunks)
+                        with self._index_lock:
+                            self.vector_store = self._append_chunks(self.vector_store, text_chunks, vectors)
+                            self.keyword_index = self._append_keywords(self.keyword_index, text_chunks)
+                        new_chunk_ids.extend(chunk.metadata["chunk_id"] for chunk in text_chunks)
+                except Exception as e:
+                    # 撤销该文件已写入的部分向量，避免留下无人管理的向量；原来的向量和清单保持不变，
+                    # 下一次扫描时该文件仍被视为已变化并重试
+                    with self._index_lock:
+                        if new_chunk_ids and self.vector_store is not None:
+                            self.vector_store.delete(new_chunk_ids)
+                        if new_chunk_ids and self.keyword_index is not None:
+                            self.keyword_index.delete(new_chunk_ids)
+                    print(f"文件 {file_key} 更新失败，已保留原来的向量，下次扫描时重试: {e}")
+                    continue
+
+                # 新向量全部写入后再移除旧向量，更新期间检索不会出现该文件内容缺失
+                with self._index_lock:
+                    removed = self._remove_file_vectors(file_key)
+                    self.file_chunk_ids[file_key] = new_chunk_ids
+                    self.file_manifest[file_key] = current_manifest[file_key]
+                print(f"文件 {file_key} 已更新：移除 {removed} 个旧向量，新增 {len(new_chunk_ids)} 个向量。")
+
+            with self._index_lock:
+                # 同步未变化文件的最新stat信息
+                for file_key, entry in current_manifest.items():
+                    if file_key not in changed_files:
+                        self.file_manifest[file_key] = entry
+                if self.vector_store is not None and self.vector_store.ntotal == 0:
+                    self.vector_store = None
+                    self.keyword_index = None
+                if self.table_store is not None:
+                    # 解析时已写入新表，这里重新读取清单
+                    self.table_store.refresh()
+                self.last_update_time = datetime.now()
+                self._mark_index_changed()
+            self._save_vector_store()
+            return True
+        except Exception as e:
+            print(f"增量更新向量数据库时发生错误: {e}")
+            return False
+
+    def _retain_tables(self, file_keys: Iterable[str]):
+        """
+        只保留给定文件的列式表（全量重建后清理已删除文件的表）
+
+        @param file_keys - 需要保留的文件列表
+        @returns 无返回值
+        """
+        if self.table_store is not None:
+            self.table_store.retain(file_keys)
+
+    def _backfill_tables(self) -> bool:
+        """
+        为已入库但还没有列式表的文件补建表（旧版本向量库、启用表格查询之前入库的文件）
+
+        @returns 补建了表返回True
+        """
+        if self.table_engine is None:
+            return False
+        missing = [(file_key, entry.get("hash")) for file_key, entry in self.file_manifest.items()
+                   if not self.table_store.has(file_key) and (file_key, entry.get("hash")) not in self._table_backfill_attempted
+                   and (self.knowledge_base_dir / file_key).exists()]
+        written = 0
+        for file_key, file_hash in missing:
+            # 读取失败的文件不在每次扫描时重试，文件内容变化后会随增量更新重新写表
+            self._table_backfill_attempted.add((file_key, file_hash))
+            print(f"正在为文件 {file_key} 补建列式表...")
+            if write_workbook_tables(self.knowledge_base_dir / file_key, self.table_store.table_root,
+                                     EXCEL_STREAM_MIN_BYTES, EXCEL_STREAM_BATCH_ROWS):
+                written += 1
+        if not written:
+            return False
+        with self._index_lock:
+            self.table_store.refresh()
+            # 统计类问题的答案会变化，使旧的答案缓存失效
+            self._mark_index_changed()
+            (self.vector_store_dir / "index_version.txt").write_text(self.index_version, encoding='utf-8')
+        return True
+
     def update_if_needed(self) -> bool:
         """
         如果文件有变化，则更新向量数据库
 
         @returns 如果进行了更新返回True，否则返回False
         """
-        if self.check_files_changed():
-            print("检测到文件变化，正在更新向量数据库...")
-            return self.rebuild_vector_store()
-        return False
+        with self._update_lock:
+            self._backfill_tables()
+            changed_files, deleted_files, current_manifest = self.detect_file_changes()
+            if not changed_files and not deleted_files:
+                # 内容未变但stat变化（如touch、复制覆盖相同内容），只刷新清单，下次扫描不必再哈希
+                if current_manifest != self.file_manifest:
+                    with self._index_lock:
+                        self.file_manifest = current_manifest
+                        self._save_file_manifest()
+                return False
+
+            # 旧版本向量库没有记录文件与向量ID的映射，无法按文件删除，只能全量重建一次
+            legacy_store = any(file_key not in self.file_chunk_ids for file_key in self.file_manifest)
+            if self.vector_store is None or legacy_store:
+                print("向量库不存在或缺少文件与向量ID的映射，正在全量重建...")
+                return self._rebuild_vector_store(current_manifest)
+
+            print("检测到文件变化，正在增量更新向量数据库...")
+            return self.apply_incremental_update(changed_files, deleted_files, current_manifest)
+
+    def _embed_query(self, user_question: str) -> List[float]:
+        """
+        计算问题的查询向量，优先使用LRU缓存
 
-    def query_with_tools(self, user_question: str, specific_files: Optional[List[str]] = None, k: int = 3) -> Dict[str, Any]:
+        @param user_question - 用户问题
+        @returns 查询向量
+        """
+        if QUERY_CACHE_MAX_ENTRIES <= 0:
+            return self.embeddings.embed_query(user_question)
+        return self.query_cache.get_or_compute(self.embedding_model_key, user_question,
+                                               self.embeddings.embed_query)
+
+    def _similarity_search(self, user_question: str, k: int,
+                           metadata_filter: Optional[Dict[str, Any]] = None) -> List[Document]:
         """
-        使用工具进行查询，返回包含工具调用信息的结果
+        检索与问题最相似的文本块；查询向量在锁外计算，只在访问索引时持有锁
+
+        @remarks 启用混合检索时，向量检索和BM25关键词检索各取 HYBRID_CANDIDATES 个候选，
+                 按倒数排名融合（RRF）后取前k个：人名、工号等精确查找由关键词检索补足
+        @param user_question - 用户问题
+        @param k - 检索的文档数量
+        @param metadata_filter - 元数据过滤条件，如 {"source_file": ["a.xlsx"]}，None表示不过滤
+        @returns 检索到的Document列表
+        """
+        query_vector = self._embed_query(user_question)
+        with self._index_lock:
+            if self.vector_store is None:
+                return []
+            if self.keyword_index is None:
+                return self.vector_store.similarity_search_by_vector(query_vector, k=k, metadata_filter=metadata_filter)
+
+            candidates = max(k, HYBRID_CANDIDATES)
+            vector_docs = self.vector_store.similarity_search_by_vector(query_vector, k=candidates,
+                                                                        metadata_filter=metadata_filter)
+            allowed_ids = self.vector_store.matching_ids(metadata_filter) if metadata_filter else None
+            keyword_hits = self.keyword_index.search(user_question, k=candidates, allowed_ids=allowed_ids)
+            documents = {doc.metadata["chunk_id"]: doc for doc in vector_docs}
+            fused_ids = reciprocal_rank_fusion([list(documents), [chunk_id for chunk_id, _ in keyword_hits]], k)
+            fused_docs = []
+            for chunk_id in fused_ids:
+                doc = documents.get(chunk_id) or self.vector_store.get_document(chunk_id)
+                if doc is not None:
+                    fused_docs.append(doc)
+            return fused_docs
+
+    def _answer_cache_key(self, user_question: str, retrieved_docs: List[Document]) -> Optional[str]:
+        """
+        计算答案缓存的键：规范化的问题、检索到的文本块ID、索引版本和模型
+
+        @param user_question - 用户问题
+        @param retrieved_docs - 检索到的文档（顺序即上下文顺序）
+        @returns 缓存键，未启用答案缓存时返回None
+        """
+        if self.answer_cache is None:
+            return None
+        chunk_ids = [doc.metadata.get("chunk_id", "") for doc in retrieved_docs]
+        return answer_cache_key(user_question, chunk_ids, self.index_version, LLM_MODEL_NAME)
+
+    def get_answer_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """
+        获取答案缓存的命中统计
+
+        @returns 统计信息，未启用答案缓存时返回None
+        """
+        return self.answer_cache.stats() if self.answer_cache is not None else None
+
+    def _retrieve_documents(self, user_question: str, specific_files: Optional[List[str]], k: int) -> List[Document]:
+        """
+        检索与问题相关的文本块，指定文件时只在这些文件的文本块中检索
 
         @param user_question - 用户问题
         @param specific_files - 指定查询的文件列表，None表示查询所有文件
         @param k - 检索的文档数量
-        @returns 包含答案和工具调用信息的字典
+        @returns 检索到的Document列表
         """
-        # 确保向量数据库是最新的
-        self.update_if_needed()
+        if not specific_files:
+            return self._similarity_search(user_question, k=k)
+        return self._similarity_search(user_question, k=k, metadata_filter={"source_file": list(specific_files)})
 
-        if self.vector_store is None:
-            return {
-                "answer": "错误：向量数据库未初始化。请先上传一些Excel文件。",
-                "tool_calls": [],
-                "sources": []
-            }
+    @staticmethod
+    def _build_sources(retrieved_docs: List[Document]) -> List[Dict[str, Any]]:
+        """
+        收集检索结果的来源信息
 
-        # 模拟工具调用
-        tool_calls = []
+        @param retrieved_docs - 检索到的文档
+        @returns 来源信息列表
+        """
         sources = []
+        for doc in retrieved_docs:
+            sources.append({
+                "file": doc.metadata.get("source_file", "unknown"),
+                "sheet": doc.metadata.get("sheet_name", "unknown"),
+                "content_preview": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
+            })
+        return sources
+
+    def _build_context(self, retrieved_docs: List[Document]) -> Tuple[str, List[Document], Dict[str, Any]]:
+        """
+        在 CONTEXT_TOKEN_BUDGET 内按排名拼接检索结果作为背景信息
+
+        @remarks 同一工作表只保留一次表头，去掉重复的行和 CHUNK_OVERLAP 留下的重叠文本
+        @param retrieved_docs - 检索到的文档（按相关度排列）
+        @returns (背景信息文本, 实际装入的文档, 统计信息)
+        """
+        context_text, used_docs, info = build_context(retrieved_docs, CONTEXT_TOKEN_BUDGET,
+                                                      self.token_counter.count, overlap_chars=CHUNK_OVERLAP)
+        if not used_docs:
+            context_text = "未在指定的Excel文件中找到相关信息。"
+        return context_text, used_docs, info
+
+    @staticmethod
+    def _search_tool_call(user_question: str, specific_files: Optional[List[str]], k: int) -> Dict[str, Any]:
+        """
+        构建Excel搜索工具调用信息
 
-        # 1. Excel搜索工具
-        search_tool_call = {
+        @param user_question - 用户问题
+        @param specific_files - 指定查询的文件列表
+        @param k - 检索的文档数量
+        @returns 工具调用信息
+        """
+        return {
             "id": f"call_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
             "type": "function",
             "function": {
@@ -391,107 +1154,383 @@ class EnhancedRAGSystem:
                 }
             }
         }
-        tool_calls.append(search_tool_call)
-
-        try:
-            # 执行检索
-            if specific_files:
-                # 如果指定了文件，则过滤检索结果
-                retrieved_docs = self.vector_store.similarity_search(user_question, k=k*2)  # 多检索一些，然后过滤
-                filtered_docs = []
-                for doc in retrieved_docs:
-                    if doc.metadata.get("source_file") in specific_files:
-                        filtered_docs.append(doc)
-                        if len(filtered_docs) >= k:
-                            break
-                retrieved_docs = filtered_docs
-            else:
-                retrieved_docs = self.vector_store.similarity_search(user_question, k=k)
-
-            # 收集来源信息
-            for doc in retrieved_docs:
-                source_info = {
-                    "file": doc.metadata.get("source_file", "unknown"),
-                    "sheet": doc.metadata.get("sheet_name", "unknown"),
-                    "content_preview": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
-                }
-                sources.append(source_info)
 
-            if not retrieved_docs:
-                context_text = "未在指定的Excel文件中找到相关信息。"
-            else:
-                context_text = "\n\n---\n\n".join([doc.page_content for doc in retrieved_docs])
+    @staticmethod
+    def _llm_tool_call(user_question: str, context_text: str, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        构建LLM生成工具调用信息
 
-            # 2. LLM生成工具
-            llm_tool_call = {
-                "id": f"call_{datetime.now().strftime('%Y%m%d_%H%M%S')}_llm",
-                "type": "function",
-                "function": {
-                    "name": "llm_generate",
-                    "arguments": {
-                        # "context": context_text[:500] + "..." if len(context_text) > 500 else context_text,
-                        "context": context_text,
-                        "question": user_question,
-                        "model": LLM_MODEL_NAME
-                    }
+        @param user_question - 用户问题
+        @param context_text - 背景信息
+        @param metadata - 附加信息（如提示token数），None表示不附加
+        @returns 工具调用信息
+        """
+        tool_call = {
+            "id": f"call_{datetime.now().strftime('%Y%m%d_%H%M%S')}_llm",
+            "type": "function",
+            "function": {
+                "name": "llm_generate",
+                "arguments": {
+                    "context": context_text,
+                    "question": user_question,
+                    "model": LLM_MODEL_NAME
                 }
             }
-            tool_calls.append(llm_tool_call)
+        }
+        if metadata:
+            tool_call["metadata"] = metadata
+        return tool_call
 
-            # 输出一下 context
-            print(f"context: {context_text}")
+    @staticmethod
+    def _table_tool_call(table_result: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        构建表格查询工具调用信息
 
-            # 构建提示并生成答案
-            prompt_template = ChatPromptTemplate.from_template(
-                """
-                请你扮演一个有用的助手。请根据下面提供的背景信息来回答用户的问题。
-                如果背景信息中没有足够的内容来回答问题，请明确说明你无法从提供的信息中找到答案，不要编造。
-                请使用中文回答。
+        @param table_result - 表格查询结果
+        @returns 工具调用信息，metadata 中包含计算结果与耗时
+        """
+        arguments = {name: table_result[name] for name in ("operation", "column", "filters", "group_by")}
+        arguments.update({"file": table_result["source_file"], "sheet": table_result["sheet_name"]})
+        metadata = {name: value for name, value in table_result.items() if name not in arguments}
+        metadata.pop("source_file", None)
+        metadata.pop("sheet_name", None)
+        return {
+            "id": f"call_{datetime.now().strftime('%Y%m%d_%H%M%S')}_table",
+            "type": "function",
+            "function": {
+                "name": "table_query",
+                "arguments": arguments
+            },
+            "metadata": metadata
+        }
 
-                背景信息:
-                {context}
+    def _prepare_query(self, user_question: str, specific_files: Optional[List[str]], k: int) -> Dict[str, Any]:
+        """
+        执行检索并准备生成所需的全部信息（阻塞操作：查询嵌入、向量检索、缓存读取）
 
-                用户问题:
-                {question}
+        @remarks 启用重排时先检索 RERANK_CANDIDATES 个候选，在 RERANK_BUDGET_MS 的剩余时间内
+                 用交叉编码器重排后取前k个；各阶段耗时放在 retrieval_metadata 中。
+                 背景信息在 CONTEXT_TOKEN_BUDGET 内组装，提示token数放在LLM工具调用的 metadata 中。
+                 统计/筛选类问题同时交给表格查询工具在整张表上计算，精确结果放在背景信息的最前面
+        @param user_question - 用户问题
+        @param specific_files - 指定查询的文件列表
+        @param k - 检索的文档数量
+        @returns 包含 retrieved_docs、sources、context、prompt_tokens、tool_calls、table_tool_call、retrieval_metadata、
+                 cache_key、cached_answer 的字典
+        """
+        start_time = time.perf_counter()
+        candidates = max(k, RERANK_CANDIDATES) if self.reranker is not None else k
+        retrieved_docs = self._retrieve_documents(user_question, specific_files, candidates)
+        retrieval_seconds = time.perf_counter() - start_time
+        retrieval_metadata = {"candidates": len(retrieved_docs), "retrieval_ms": round(retrieval_seconds * 1000, 1)}
+        if self.reranker is not None:
+            budget_seconds = RERANK_BUDGET_MS / 1000 - retrieval_seconds if RERANK_BUDGET_MS > 0 else None
+            retrieved_docs, retrieval_metadata["rerank"] = self.reranker.rerank(
+                user_question, retrieved_docs, k, budget_seconds
+            )
+        retrieval_metadata["total_ms"] = round((time.perf_counter() - start_time) * 1000, 1)
+        context_text, retrieved_docs, context_info = self._build_context(retrieved_docs)
+        table_result = None
+        if self.table_engine is not None:
+            # 带对话历史的问题只解析当前问题，避免历史中的关键词影响表格查询
+            current_question = user_question.rsplit("当前问题: ", 1)[-1]
+            table_result = self.table_engine.answer(current_question, specific_files)
+            if table_result is not None:
+                context_text = describe_result(table_result) + "\n\n---\n\n" + context_text
+        prompt_tokens = self.token_counter.count(RAG_PROMPT.format(context=context_text, question=user_question))
+        context_info.update({"prompt_tokens": prompt_tokens, "tokenizer": self.token_counter.name})
+        print(f"context: {context_text}")
+        print(f"提示token数: {prompt_tokens}（背景信息 {context_info['context_tokens']}/{CONTEXT_TOKEN_BUDGET}，"
+              f"装入 {context_info['chunks_used']}/{context_info['candidates']} 个文本块）")
+
+        # 相同问题、相同检索结果、相同索引版本和模型的答案直接复用
+        cache_key = self._answer_cache_key(user_question, retrieved_docs)
+        return {
+            "retrieved_docs": retrieved_docs,
+            "sources": self._build_sources(retrieved_docs),
+            "context": context_text,
+            "prompt_tokens": prompt_tokens,
+            "table_tool_call": self._table_tool_call(table_result) if table_result is not None else None,
+            "llm_tool_call": self._llm_tool_call(user_question, context_text, context_info),
+            "retrieval_metadata": retrieval_metadata,
+            "cache_key": cache_key,
+            "cached_answer": self.answer_cache.get(cache_key) if cache_key else None
+        }
 
-                回答:
-                """
+    def _store_answer(self, cache_key: Optional[str], answer: str):
+        """
+        将生成的答案写入答案缓存
+
+        @param cache_key - 缓存键，None表示不缓存
+        @param answer - 生成的答案
+        @returns 无返回值
+        """
+        if cache_key and answer:
+            self.answer_cache.put(cache_key, answer)
+
+    @staticmethod
+    def _ollama_client_options() -> Dict[str, Any]:
+        """
+        构建Ollama客户端（httpx）的连接池与超时参数
+
+        @returns 传给 ollama.Client / ollama.AsyncClient 的关键字参数
+        """
+        import httpx
+        return {
+            "host": OLLAMA_HOST,
+            "timeout": httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+            "limits": httpx.Limits(
+                max_connections=OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY
             )
+        }
 
-            # 使用同步方式生成答案（非流式）
-            try:
-                # 尝试使用Ollama客户端的同步生成
+    def _get_ollama_client(self):
+        """
+        获取共享的同步Ollama客户端，首次调用时创建
+
+        @returns ollama.Client 实例
+        """
+        with self._ollama_client_lock:
+            if self._ollama_client is None:
                 import ollama
-                client = ollama.Client()
+                self._ollama_client = ollama.Client(**self._ollama_client_options())
+            return self._ollama_client
 
-                # 构建完整的提示
-                formatted_prompt = prompt_template.format(context=context_text, question=user_question)
+    def _get_ollama_async_client(self):
+        """
+        获取当前事件循环共享的异步Ollama客户端
 
-                # 同步生成响应
-                response = client.generate(
-                    model=LLM_MODEL_NAME,
-                    prompt=formatted_prompt,
-                    stream=False
-                )
+        @remarks httpx.AsyncClient 的连接只能在创建它们的事件循环中使用，
+                 事件循环变化（如测试中多次 asyncio.run）时重新创建
+        @returns ollama.AsyncClient 实例
+        """
+        loop = asyncio.get_running_loop()
+        if self._ollama_async_client is None or self._ollama_async_loop is not loop:
+            import ollama
+            self._ollama_async_client = ollama.AsyncClient(**self._ollama_client_options())
+            self._ollama_async_loop = loop
+        return self._ollama_async_client
+
+    async def aclose(self):
+        """
+        关闭共享的Ollama客户端和查询线程池
 
-                answer = response.get('response', '')
+        @returns 无返回值
+        """
+        if self._ollama_async_client is not None:
+            await self._ollama_async_client.close()
+            self._ollama_async_client = None
+        with self._ollama_client_lock:
+            if self._ollama_client is not None:
+                self._ollama_client.close()
+                self._ollama_client = None
+        self._query_executor.shutdown(wait=False)
+
+    async def _run_blocking(self, func, *args):
+        """
+        在有界线程池中执行阻塞操作，避免卡住事件循环
+
+        @param func - 阻塞函数
+        @param args - 函数参数
+        @returns 函数返回值
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._query_executor, functools.partial(func, *args))
+
+    def query_with_tools(self, user_question: str, specific_files: Optional[List[str]] = None, k: int = 3) -> Dict[str, Any]:
+        """
+        使用工具进行查询，返回包含工具调用信息的结果（同步版本）
 
+        @remarks 知识库变化由后台更新器（IndexUpdater）检测，查询路径不再扫描文件；
+                 在API中请使用 aquery_with_tools()，避免阻塞事件循环
+        @param user_question - 用户问题
+        @param specific_files - 指定查询的文件列表，None表示查询所有文件
+        @param k - 检索的文档数量
+        @returns 包含答案和工具调用信息的字典
+        """
+        if self.vector_store is None:
+            return {
+                "answer": "错误：向量数据库未初始化。请先上传一些Excel文件。",
+                "tool_calls": [],
+                "sources": []
+            }
+
+        tool_calls = [self._search_tool_call(user_question, specific_files, k)]
+        try:
+            prepared = self._prepare_query(user_question, specific_files, k)
+            tool_calls[0]["metadata"] = prepared["retrieval_metadata"]
+            if prepared["table_tool_call"] is not None:
+                tool_calls.append(prepared["table_tool_call"])
+            tool_calls.append(prepared["llm_tool_call"])
+            if prepared["cached_answer"] is not None:
+                print("答案缓存命中，跳过LLM生成。")
+                return {
+                    "answer": prepared["cached_answer"],
+                    "tool_calls": tool_calls,
+                    "sources": prepared["sources"],
+                    "usage": cached_usage(),
+                    "cached": True
+                }
+
+            formatted_prompt = RAG_PROMPT.format(context=prepared["context"], question=user_question)
+            try:
+                # 使用共享的Ollama客户端同步生成（连接池复用TCP连接）
+                response = self._get_ollama_client().generate(
+                    model=LLM_MODEL_NAME, prompt=formatted_prompt, stream=False, keep_alive=OLLAMA_KEEP_ALIVE
+                )
+                answer = response.get('response', '')
+                usage = usage_from_response(response, prepared["prompt_tokens"])
             except Exception as e:
                 print(f"Ollama客户端调用失败，回退到langchain: {e}")
-                # 回退到原来的langchain方式
-                rag_chain = prompt_template | self.llm | StrOutputParser()
-                answer = rag_chain.invoke({"context": context_text, "question": user_question})
+                rag_chain = RAG_PROMPT | self.llm | StrOutputParser()
+                answer = rag_chain.invoke({"context": prepared["context"], "question": user_question})
+                usage = None
+            usage = usage or estimated_usage(prepared["prompt_tokens"], self.token_counter.count(answer))
+            self.usage_stats.record(usage)
 
+            self._store_answer(prepared["cache_key"], answer)
             return {
                 "answer": answer,
                 "tool_calls": tool_calls,
-                "sources": sources
+                "sources": prepared["sources"],
+                "usage": usage
             }
 
         except Exception as e:
-            error_msg = f"查询过程中发生错误: {e}"
             return {
-                "answer": error_msg,
+                "answer": f"查询过程中发生错误: {e}",
+                "tool_calls": tool_calls,
+                "sources": []
+            }
+
+    def _generation_key(self, formatted_prompt: str) -> str:
+        """
+        计算生成请求的标识，用于合并相同的进行中生成
+
+        @param formatted_prompt - 完整提示
+        @returns 十六进制摘要
+        """
+        return hashlib.sha256(f"{LLM_MODEL_NAME}\0{formatted_prompt}".encode("utf-8")).hexdigest()
+
+    async def _agenerate_answer(self, formatted_prompt: str, prompt_tokens: int) -> Tuple[str, Dict[str, Any]]:
+        """
+        调用Ollama异步生成完整答案，失败时回退到langchain
+
+        @param formatted_prompt - 完整提示
+        @param prompt_tokens - 本地计数的提示token数，Ollama未返回提示token数时使用
+        @returns (生成的答案, 用量)
+        """
+        try:
+            response = await self._get_ollama_async_client().generate(
+                model=LLM_MODEL_NAME, prompt=formatted_prompt, stream=False, keep_alive=OLLAMA_KEEP_ALIVE
+            )
+            answer = response.get('response', '')
+            usage = usage_from_response(response, prompt_tokens)
+        except Exception as e:
+            print(f"Ollama客户端调用失败，回退到langchain: {e}")
+            answer = await self._run_blocking(self.llm.invoke, formatted_prompt)
+            usage = None
+        usage = usage or estimated_usage(prompt_tokens, self.token_counter.count(answer))
+        self.usage_stats.record(usage)
+        return answer, usage
+
+    async def _astream_answer(self, formatted_prompt: str, prompt_tokens: int):
+        """
+        调用Ollama异步流式生成答案，失败时回退到langchain的流式接口
+
+        @remarks 最后产生一个用量字典（取自Ollama最后一块中的 prompt_eval_count / eval_count 和耗时），
+                 经调度器合并的请求共享同一次生成，也共享这一用量
+        @param formatted_prompt - 完整提示
+        @param prompt_tokens - 本地计数的提示token数，Ollama未返回提示token数时使用
+        @returns 异步生成器，产生答案的内容块（str），最后产生用量（dict）
+        """
+        started = False
+        answer = ""
+        usage = None
+        try:
+            # 真正的异步流式生成
+            stream = await self._get_ollama_async_client().generate(
+                model=LLM_MODEL_NAME, prompt=formatted_prompt, stream=True, keep_alive=OLLAMA_KEEP_ALIVE
+            )
+            async for chunk in stream:
+                content = chunk.get('response')
+                if content:
+                    started = True
+                    answer += content
+                    yield content
+                if chunk.get('done'):
+                    usage = usage_from_response(chunk, prompt_tokens)
+        except Exception as stream_error:
+            if started:
+                # 已经向客户端发送了部分内容，不能再用另一个模型从头生成
+                raise
+            print(f"流式生成失败，回退到langchain: {stream_error}")
+            # 回退到langchain的同步流式接口，在线程中读取并通过有界队列传回
+            async for content in iterate_in_thread(self.llm.stream(formatted_prompt), self._query_executor):
+                answer += content
+                yield content
+        usage = usage or estimated_usage(prompt_tokens, self.token_counter.count(answer))
+        self.usage_stats.record(usage)
+        yield usage
+
+    async def aquery_with_tools(self, user_question: str, specific_files: Optional[List[str]] = None, k: int = 3,
+                                priority: int = PRIORITY_BATCH) -> Dict[str, Any]:
+        """
+        使用工具进行查询的异步版本，返回包含工具调用信息的结果
+
+        @remarks 查询嵌入、向量检索等CPU/磁盘操作在有界线程池中执行，
+                 LLM生成使用 ollama.AsyncClient，等待期间事件循环可以服务其他请求；
+                 生成经过 GenerationScheduler 排队，相同提示正在生成时共享结果
+        @param user_question - 用户问题
+        @param specific_files - 指定查询的文件列表，None表示查询所有文件
+        @param k - 检索的文档数量
+        @param priority - 生成的排队优先级
+        @returns 包含答案和工具调用信息的字典
+        """
+        if self.vector_store is None:
+            return {
+                "answer": "错误：向量数据库未初始化。请先上传一些Excel文件。",
+                "tool_calls": [],
+                "sources": []
+            }
+
+        tool_calls = [self._search_tool_call(user_question, specific_files, k)]
+        try:
+            prepared = await self._run_blocking(self._prepare_query, user_question, specific_files, k)
+            tool_calls[0]["metadata"] = prepared["retrieval_metadata"]
+            if prepared["table_tool_call"] is not None:
+                tool_calls.append(prepared["table_tool_call"])
+            tool_calls.append(prepared["llm_tool_call"])
+            if prepared["cached_answer"] is not None:
+                print("答案缓存命中，跳过LLM生成。")
+                return {
+                    "answer": prepared["cached_answer"],
+                    "tool_calls": tool_calls,
+                    "sources": prepared["sources"],
+                    "usage": cached_usage(),
+                    "cached": True
+                }
+
+            formatted_prompt = RAG_PROMPT.format(context=prepared["context"], question=user_question)
+            answer, usage = await self.generation_scheduler.generate(
+                self._generation_key(formatted_prompt),
+                lambda: self._agenerate_answer(formatted_prompt, prepared["prompt_tokens"]),
+                priority
+            )
+
+            await self._run_blocking(self._store_answer, prepared["cache_key"], answer)
+            return {
+                "answer": answer,
+                "tool_calls": tool_calls,
+                "sources": prepared["sources"],
+                "usage": usage
+            }
+
+        except Exception as e:
+            return {
+                "answer": f"查询过程中发生错误: {e}",
                 "tool_calls": tool_calls,
                 "sources": []
             }
@@ -500,14 +1539,15 @@ class EnhancedRAGSystem:
         """
         使用工具进行流式查询，返回异步生成器
 
+        @remarks 检索在有界线程池中执行；生成使用 ollama.AsyncClient 逐token读取，
+                 不再人为sleep。相同提示的请求共享一次生成，生成最多领先最慢的客户端
+                 STREAM_SHARED_WINDOW 个内容块，之后暂停读取，慢速的SSE客户端会通过TCP流控反压到Ollama。
+                 已生成的内容块保留在共享缓冲中（供后加入的请求回放），内存占用随答案长度增长
         @param user_question - 用户问题
         @param specific_files - 指定查询的文件列表，None表示查询所有文件
         @param k - 检索的文档数量
         @returns 异步生成器，产生流式响应数据
         """
-        # 确保向量数据库是最新的
-        self.update_if_needed()
-
         if self.vector_store is None:
             yield {
                 "error": "向量数据库未初始化。请先上传一些Excel文件。",
@@ -516,173 +1556,95 @@ class EnhancedRAGSystem:
             }
             return
 
-        # 模拟工具调用
-        tool_calls = []
-        sources = []
-
-        # 1. Excel搜索工具
-        search_tool_call = {
-            "id": f"call_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
-            "type": "function",
-            "function": {
-                "name": "excel_search",
-                "arguments": {
-                    "query": user_question,
-                    "files": specific_files or "all",
-                    "top_k": k
-                }
-            }
-        }
-        tool_calls.append(search_tool_call)
-
-        # 先发送工具调用信息
+        # 1. Excel搜索工具，先发送工具调用信息
+        search_tool_call = self._search_tool_call(user_question, specific_files, k)
+        tool_calls = [search_tool_call]
         yield {
             "type": "tool_call",
             "tool_call": search_tool_call
         }
 
         try:
-            # 执行检索
-            if specific_files:
-                retrieved_docs = self.vector_store.similarity_search(user_question, k=k*2)
-                filtered_docs = []
-                for doc in retrieved_docs:
-                    if doc.metadata.get("source_file") in specific_files:
-                        filtered_docs.append(doc)
-                        if len(filtered_docs) >= k:
-                            break
-                retrieved_docs = filtered_docs
-            else:
-                retrieved_docs = self.vector_store.similarity_search(user_question, k=k)
-
-            # 收集来源信息
-            for doc in retrieved_docs:
-                source_info = {
-                    "file": doc.metadata.get("source_file", "unknown"),
-                    "sheet": doc.metadata.get("sheet_name", "unknown"),
-                    "content_preview": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
-                }
-                sources.append(source_info)
+            prepared = await self._run_blocking(self._prepare_query, user_question, specific_files, k)
+            sources = prepared["sources"]
+            # 搜索工具调用在检索前已经发送，耗时随检索结果一起发送
+            search_tool_call["metadata"] = prepared["retrieval_metadata"]
 
             # 发送检索结果
             yield {
                 "type": "retrieval_result",
                 "sources": sources,
-                "retrieved_count": len(retrieved_docs)
+                "retrieved_count": len(prepared["retrieved_docs"]),
+                "metadata": prepared["retrieval_metadata"]
             }
 
-            if not retrieved_docs:
-                context_text = "未在指定的Excel文件中找到相关信息。"
-            else:
-                context_text = "\n\n---\n\n".join([doc.page_content for doc in retrieved_docs])
-
-            # 2. LLM生成工具
-            llm_tool_call = {
-                "id": f"call_{datetime.now().strftime('%Y%m%d_%H%M%S')}_llm",
-                "type": "function",
-                "function": {
-                    "name": "llm_generate",
-                    "arguments": {
-                        # "context": context_text[:500] + "..." if len(context_text) > 500 else context_text,
-                        "context": context_text,
-                        "question": user_question,
-                        "model": LLM_MODEL_NAME
-                    }
+            # 统计/筛选类问题：表格查询工具的精确计算结果
+            if prepared["table_tool_call"] is not None:
+                tool_calls.append(prepared["table_tool_call"])
+                yield {
+                    "type": "tool_call",
+                    "tool_call": prepared["table_tool_call"]
                 }
-            }
-            tool_calls.append(llm_tool_call)
 
-            # 发送LLM工具调用
+            # 2. LLM生成工具
+            tool_calls.append(prepared["llm_tool_call"])
             yield {
                 "type": "tool_call",
-                "tool_call": llm_tool_call
+                "tool_call": prepared["llm_tool_call"]
             }
 
-            # 构建提示并生成答案
-            prompt_template = ChatPromptTemplate.from_template(
-                """
-                请你扮演一个有用的助手。请根据下面提供的背景信息来回答用户的问题。
-                如果背景信息中没有足够的内容来回答问题，请明确说明你无法从提供的信息中找到答案，不要编造。
-                请使用中文回答。
-
-                背景信息:
-                {context}
-
-                用户问题:
-                {question}
-
-                回答:
-                """
-            )
-
             # 开始生成答案
             yield {
                 "type": "generation_start"
             }
 
-            # 真正的流式生成 - 使用Ollama的流式功能
-            try:
-                # 构建完整的提示
-                formatted_prompt = prompt_template.format(context=context_text, question=user_question)
-
-                # 使用Ollama客户端进行流式生成
-                import ollama
-                client = ollama.Client()
-
-                # 流式生成响应
-                stream = client.generate(
-                    model=LLM_MODEL_NAME,
-                    prompt=formatted_prompt,
-                    stream=True
-                )
-
-                full_answer = ""
-                for chunk in stream:
-                    if 'response' in chunk:
-                        content = chunk['response']
-                        full_answer += content
-
-                        # 发送内容块
-                        yield {
-                            "type": "content_chunk",
-                            "content": content
-                        }
-
-                        # 小延迟以避免过快发送
-                        await asyncio.sleep(0.01)
-
-                # 保存完整答案用于后续处理
-                answer = full_answer
-
-            except Exception as stream_error:
-                print(f"流式生成失败，回退到同步模式: {stream_error}")
-                # 回退到原来的同步方式
-                rag_chain = prompt_template | self.llm | StrOutputParser()
-                answer = rag_chain.invoke({"context": context_text, "question": user_question})
-
-                # 将答案分块发送（模拟流式）
-                words = answer.split()
-                chunk_size = 3  # 每次发送3个词
-
-                for i in range(0, len(words), chunk_size):
-                    chunk = " ".join(words[i:i + chunk_size])
-                    if i + chunk_size < len(words):
-                        chunk += " "
-
+            # 答案缓存命中时按块回放，不再调用LLM
+            if prepared["cached_answer"] is not None:
+                print("答案缓存命中，回放缓存的答案。")
+                for content in iter_replay_chunks(prepared["cached_answer"], ANSWER_CACHE_REPLAY_CHARS):
                     yield {
                         "type": "content_chunk",
-                        "content": chunk
+                        "content": content
                     }
+                yield {
+                    "type": "generation_complete",
+                    "full_answer": prepared["cached_answer"],
+                    "tool_calls": tool_calls,
+                    "sources": sources,
+                    "usage": cached_usage(),
+                    "cached": True
+                }
+                return
+
+            formatted_prompt = RAG_PROMPT.format(context=prepared["context"], question=user_question)
+            answer = ""
+            usage = None
+            # 经调度器排队（交互优先）；相同提示正在生成时共享同一次生成
+            token_stream = self.generation_scheduler.stream(
+                self._generation_key(formatted_prompt),
+                lambda: self._astream_answer(formatted_prompt, prepared["prompt_tokens"]),
+                PRIORITY_INTERACTIVE
+            )
+            async for content in token_stream:
+                if isinstance(content, dict):
+                    # 生成结束时的用量
+                    usage = content
+                    continue
+                answer += content
+                yield {
+                    "type": "content_chunk",
+                    "content": content
+                }
 
-                    # 模拟生成延迟
-                    await asyncio.sleep(0.1)
+            await self._run_blocking(self._store_answer, prepared["cache_key"], answer)
 
             # 发送完成信息
             yield {
                 "type": "generation_complete",
                 "full_answer": answer,
                 "tool_calls": tool_calls,
-                "sources": sources
+                "sources": sources,
+                "usage": usage
             }
 
         except Exception as e:
@@ -693,8 +1655,171 @@ class EnhancedRAGSystem:
                 "sources": []
             }
 
+# --- 后台索引更新 ---
+class KnowledgeBaseEventHandler(FileSystemEventHandler):
+    """
+    知识库目录的文件事件处理器，把Excel文件的创建/修改/删除/移动事件转发给后台更新器
+    """
+
+    def __init__(self, updater: "IndexUpdater"):
+        """
+        初始化文件事件处理器
+
+        @param updater - 接收事件通知的后台索引更新器
+        """
+        super().__init__()
+        self.updater = updater
+
+    @staticmethod
+    def _is_excel_path(path: str) -> bool:
+        """
+        判断路径是否为需要索引的Excel文件（忽略Office生成的 ~$ 临时锁文件）
+
+        @param path - 文件路径
+        @returns 是Excel文件返回True
+        """
+        name = os.path.basename(path)
+        return name.lower().endswith(('.xlsx', '.xls')) and not name.startswith('~$')
+
+    def on_any_event(self, event):
+        """
+        处理任意文件事件
+
+        @param event - watchdog文件事件
+        @returns 无返回值
+        """
+        if event.is_directory or event.event_type not in ("created", "modified", "deleted", "moved"):
+            return
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        if any(path and self._is_excel_path(str(path)) for path in paths):
+            self.updater.notify()
+
+
+class IndexUpdater:
+    """
+    后台索引更新器，在独立线程中检测知识库变化并更新向量数据库
+
+    @remarks watchdog文件事件经过静默窗口合并后唤醒更新，批量复制N个文件只触发一次索引更新；
+             定期扫描作为兜底，上传/删除文件后通过 trigger() 立即唤醒；
+             所有更新都在同一个线程中串行执行，聊天请求不再承担文件扫描的开销
+    """
+
+    def __init__(self, rag: EnhancedRAGSystem, scan_interval: float = KB_SCAN_INTERVAL,
+                 quiet_seconds: float = KB_WATCH_QUIET_SECONDS):
+        """
+        初始化后台索引更新器
+
+        @param rag - 需要维护的RAG系统实例
+        @param scan_interval - 定期扫描间隔（秒）
+        @param quiet_seconds - 文件事件静默窗口（秒）
+        """
+        self.rag = rag
+        self.scan_interval = scan_interval
+        self.quiet_seconds = quiet_seconds
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._last_event_time = 0.0
+        self._thread = None
+        self._observer = None
+
+    def start(self):
+        """
+        启动后台更新线程
+
+        @returns 无返回值
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="index-updater", daemon=True)
+        self._thread.start()
+
+    def start_watching(self):
+        """
+        启动watchdog观察者监听知识库目录；失败时仅依赖定期扫描
+
+        @returns 无返回值
+        """
+        if self._observer is not None:
+            return
+        try:
+            observer = Observer()
+            observer.schedule(KnowledgeBaseEventHandler(self), str(self.rag.knowledge_base_dir), recursive=False)
+            observer.daemon = True
+            observer.start()
+            self._observer = observer
+            print(f"👀 已开始监听知识库目录变化（静默窗口 {self.quiet_seconds} 秒）")
+        except Exception as e:
+            print(f"启动文件监听失败，仅使用定期扫描: {e}")
+
+    def stop(self, timeout: float = 5.0):
+        """
+        停止后台更新线程
+
+        @param timeout - 等待线程退出的最长时间（秒）
+        @returns 无返回值
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=timeout)
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def trigger(self):
+        """
+        请求尽快执行一次更新检查（多次调用会合并为一次）
+
+        @returns 无返回值
+        """
+        self._wakeup.set()
+
+    def notify(self):
+        """
+        记录一次文件事件；更新会在事件停止 quiet_seconds 秒后执行
+
+        @returns 无返回值
+        """
+        self._last_event_time = time.monotonic()
+        self._wakeup.set()
+
+    def _wait_for_quiet(self):
+        """
+        等待文件事件静默，窗口内的新事件会顺延等待时间
+
+        @returns 无返回值
+        """
+        while not self._stopped.is_set():
+            remaining = self._last_event_time + self.quiet_seconds - time.monotonic()
+            if remaining <= 0:
+                return
+            self._stopped.wait(remaining)
+
+    def _run(self):
+        """
+        后台线程主循环
+
+        @returns 无返回值
+        """
+        while not self._stopped.is_set():
+            self._wakeup.wait(timeout=self.scan_interval)
+            self._wait_for_quiet()
+            # 在开始更新前清除唤醒标记，更新期间到达的事件会触发下一轮
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                if self.rag.update_if_needed():
+                    print("后台向量数据库更新完成。")
+            except Exception as e:
+                print(f"后台更新向量数据库失败: {e}")
+
 # --- 全局RAG系统实例 ---
 rag_system = None
+index_updater = None
 
 def get_rag_system() -> EnhancedRAGSystem:
     """
@@ -712,6 +1837,17 @@ def get_rag_system() -> EnhancedRAGSystem:
         )
     return rag_system
 
+def get_index_updater() -> IndexUpdater:
+    """
+    获取全局后台索引更新器实例
+
+    @returns IndexUpdater实例
+    """
+    global index_updater
+    if index_updater is None:
+        index_updater = IndexUpdater(get_rag_system())
+    return index_updater
+
 # --- FastAPI应用初始化 ---
 app = FastAPI(
     title="RAG Excel API",
@@ -757,7 +1893,8 @@ async def root():
         "endpoints": {
             "chat": "/v1/chat/completions",
             "upload": "/v1/files/upload",
-            "health": "/health"
+            "health": "/health",
+            "metrics": "/metrics"
         }
     }
 
@@ -789,7 +1926,39 @@ async def health_check():
         "timestamp": datetime.now().isoformat(),
         "vector_store_ready": rag.vector_store is not None,
         "last_update": rag.last_update_time.isoformat() if rag.last_update_time else None,
-        "knowledge_base_files": excel_files_count
+        "knowledge_base_files": excel_files_count,
+        "embedding": rag.get_embedding_stats()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """运行指标端点：嵌入吞吐、各级缓存的命中率、生成队列深度与等待时间、LLM的token用量与生成速度"""
+    rag = get_rag_system()
+
+    def collect_index_stats():
+        # 索引更新期间 _index_lock 可能被长时间持有，在线程池中等待锁，避免阻塞事件循环
+        with rag._index_lock:
+            vector_count = rag.vector_store.ntotal if rag.vector_store is not None else 0
+            vector_store_stats = rag.vector_store.stats() if rag.vector_store is not None else None
+            keyword_index_stats = rag.keyword_index.stats() if rag.keyword_index is not None else None
+        table_stats = rag.table_store.stats() if rag.table_store is not None else None
+        return vector_count, vector_store_stats, keyword_index_stats, table_stats
+
+    # 使用独立于查询线程池的线程池，查询排满时指标端点仍可响应
+    vector_count, vector_store_stats, keyword_index_stats, table_stats = await run_in_threadpool(collect_index_stats)
+
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "vector_count": vector_count,
+        "vector_store": vector_store_stats,
+        "keyword_index": keyword_index_stats,
+        "tables": table_stats,
+        "reranker": rag.reranker.stats() if rag.reranker is not None else None,
+        "index_version": rag.index_version,
+        "embedding": rag.get_embedding_stats(),
+        "answer_cache": rag.get_answer_cache_stats(),
+        "generation": rag.generation_scheduler.stats(),
+        "llm_usage": rag.usage_stats.stats()
     }
 
 @app.post("/v1/files/upload", response_model=FileUploadResponse)
@@ -847,12 +2016,10 @@ async def upload_file(
 
 async def update_vector_store_background():
     """
-    后台任务：更新向量数据库
+    后台任务：唤醒后台索引更新器检查知识库变化
     """
     try:
-        rag = get_rag_system()
-        rag.update_if_needed()
-        print("后台向量数据库更新完成。")
+        get_index_updater().trigger()
     except Exception as e:
         print(f"后台更新向量数据库失败: {e}")
 
@@ -878,17 +2045,15 @@ async def chat_completions(request: ChatCompletionRequest):
 
     # 非流式响应（原有逻辑）
     try:
-        # 构建完整的对话历史上下文
-        conversation_context = ""
+        # 收集所有对话历史
+        turns = []
         user_message = None
-
-        # 收集所有对话历史，构建上下文
         for msg in request.messages:
             if msg.role == "user":
-                conversation_context += f"用户: {msg.content}\n"
+                turns.append(("用户", msg.content))
                 user_message = msg.content  # 保存最后一条用户消息
             elif msg.role == "assistant":
-                conversation_context += f"助手: {msg.content}\n"
+                turns.append(("助手", msg.content))
 
         if not user_message:
             raise HTTPException(
@@ -900,15 +2065,17 @@ async def chat_completions(request: ChatCompletionRequest):
         query_text = user_message
         if len(request.messages) > 1:
             # 有对话历史时，将当前问题与历史上下文结合
+            # 历史过长会拉长预填充时间，只保留 HISTORY_TOKEN_BUDGET 内最近的几轮
+            conversation_context = fit_history(turns, HISTORY_TOKEN_BUDGET, get_rag_system().token_counter.count)
             query_text = f"对话历史:\n{conversation_context}\n当前问题: {user_message}"
 
         # 检查是否指定了特定文件（从消息中解析）
         specific_files = None
         # 这里可以添加解析逻辑，比如检查消息中是否包含 "在文件X中" 这样的指令
 
-        # 使用RAG系统查询
+        # 使用RAG系统查询（异步，检索和生成期间不阻塞其他请求）
         rag = get_rag_system()
-        result = rag.query_with_tools(query_text, specific_files)
+        result = await rag.aquery_with_tools(query_text, specific_files)
 
         # 构建响应
         response_id = f"chatcmpl-{datetime.now().strftime('%Y%m%d%H%M%S')}"
@@ -918,14 +2085,18 @@ async def chat_completions(request: ChatCompletionRequest):
         tool_calls_data = []
         if result.get("tool_calls"):
             for tool_call in result["tool_calls"]:
-                tool_calls_data.append({
+                tool_call_data = {
                     "id": tool_call["id"],
                     "type": tool_call["type"],
                     "function": {
                         "name": tool_call["function"]["name"],
                         "arguments": json.dumps(tool_call["function"]["arguments"], ensure_ascii=False)
                     }
-                })
+                }
+                if tool_call.get("metadata"):
+                    # 检索/重排耗时等附加信息
+                    tool_call_data["metadata"] = tool_call["metadata"]
+                tool_calls_data.append(tool_call_data)
 
         # 构建消息内容
         message_content = result["answer"]
@@ -955,11 +2126,8 @@ async def chat_completions(request: ChatCompletionRequest):
             created=created_timestamp,
             model=request.model,
             choices=[choice],
-            usage={
-                "prompt_tokens": len(user_message.split()),  # 简单估算
-                "completion_tokens": len(result["answer"].split()),  # 简单估算
-                "total_tokens": len(user_message.split()) + len(result["answer"].split())
-            }
+            # 查询失败时没有调用LLM，用量为0
+            usage=result.get("usage") or estimated_usage(0, 0)
         )
 
     except Exception as e:
@@ -976,17 +2144,15 @@ async def generate_stream_response(request: ChatCompletionRequest):
     @returns 异步生成器，产生SSE格式的数据
     """
     try:
-        # 构建完整的对话历史上下文
-        conversation_context = ""
+        # 收集所有对话历史
+        turns = []
         user_message = None
-
-        # 收集所有对话历史，构建上下文
         for msg in request.messages:
             if msg.role == "user":
-                conversation_context += f"用户: {msg.content}\n"
+                turns.append(("用户", msg.content))
                 user_message = msg.content  # 保存最后一条用户消息
             elif msg.role == "assistant":
-                conversation_context += f"助手: {msg.content}\n"
+                turns.append(("助手", msg.content))
 
         if not user_message:
             yield f"data: {json.dumps({'error': '未找到用户消息'}, ensure_ascii=False)}\n\n"
@@ -996,6 +2162,8 @@ async def generate_stream_response(request: ChatCompletionRequest):
         query_text = user_message
         if len(request.messages) > 1:
             # 有对话历史时，将当前问题与历史上下文结合
+            # 历史过长会拉长预填充时间，只保留 HISTORY_TOKEN_BUDGET 内最近的几轮
+            conversation_context = fit_history(turns, HISTORY_TOKEN_BUDGET, get_rag_system().token_counter.count)
             query_text = f"对话历史:\n{conversation_context}\n当前问题: {user_message}"
 
         # 检查是否指定了特定文件
@@ -1150,6 +2318,9 @@ async def generate_stream_response(request: ChatCompletionRequest):
                         "finish_reason": "stop"
                     }]
                 }
+                if chunk.get("usage"):
+                    # 与OpenAI的 stream_options.include_usage 一致，用量放在最后一块
+                    final_chunk["usage"] = chunk["usage"]
                 yield f"data: {json.dumps(final_chunk, ensure_ascii=False)}\n\n"
 
             elif chunk_type == "error":
@@ -1195,18 +2366,26 @@ async def list_files():
     try:
         knowledge_base_path = Path(KNOWLEDGE_BASE_DIR)
         files = []
+        file_manifest = get_rag_system().file_manifest
 
         # 同时支持 xlsx 和 xls 文件
         for pattern in ["*.xlsx", "*.xls"]:
             for file_path in knowledge_base_path.glob(pattern):
                 file_stat = file_path.stat()
-                file_hash = ""
-                try:
-                    with open(file_path, "rb") as f:
-                        content = f.read()
-                        file_hash = hashlib.md5(content).hexdigest()
-                except Exception:
-                    pass
+                # 优先复用文件清单中的哈希（stat一致时），避免每次列表请求都读取整个文件
+                cached = file_manifest.get(file_path.name, {})
+                if cached.get("size") == file_stat.st_size and cached.get("mtime_ns") == file_stat.st_mtime_ns:
+                    file_hash = cached.get("hash", "")
+                else:
+                    file_hash = ""
+                    try:
+                        hash_md5 = hashlib.md5()
+                        with open(file_path, "rb") as f:
+                            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                                hash_md5.update(chunk)
+                        file_hash = hash_md5.hexdigest()
+                    except Exception:
+                        pass
 
                 files.append({
                     "filename": file_path.name,
@@ -1293,9 +2472,11 @@ async def rebuild_vector_store(background_tasks: BackgroundTasks):
             detail=f"启动重建任务失败: {str(e)}"
         )
 
-async def rebuild_vector_store_background():
+def rebuild_vector_store_background():
     """
     后台任务：强制重建向量数据库
+
+    @remarks 重建是阻塞操作，定义为普通函数，由BackgroundTasks在线程池中执行，不占用事件循环
     """
     try:
         rag = get_rag_system()
@@ -1333,6 +2514,13 @@ async def startup_event():
         print("检测到知识库文件但向量数据库不存在，正在构建...")
         rag.rebuild_vector_store()
 
+    # 启动后台索引更新器，并立即检查服务停止期间发生的文件变化
+    updater = get_index_updater()
+    updater.start()
+    if KB_WATCH_ENABLED:
+        updater.start_watching()
+    updater.trigger()
+
     print("✅ RAG Excel API服务启动完成！")
     print(f"📁 知识库目录: {Path(KNOWLEDGE_BASE_DIR).absolute()}")
     print(f"🗄️ 向量库目录: {Path(VECTOR_STORE_DIR).absolute()}")
@@ -1346,12 +2534,19 @@ async def shutdown_event():
     """
     print("🛑 RAG Excel API服务正在关闭...")
 
+    # 停止后台索引更新器
+    if index_updater is not None:
+        index_updater.stop()
+
     # 保存向量数据库
     rag = get_rag_system()
     if rag.vector_store is not None:
         rag._save_vector_store()
         print("💾 向量数据库已保存")
 
+    # 关闭Ollama连接池和查询线程池
+    await rag.aclose()
+
     print("✅ RAG Excel API服务已安全关闭")
 
 # --- 主程序入口 ---
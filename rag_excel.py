@@ -22,6 +22,8 @@ from langchain_core.prompts import ChatPromptTemplate           # 用于创建
 from langchain_core.output_parsers import StrOutputParser       # 用于解析模型输出
 from langchain_core.documents import Document                   # Langchain中文档对象的基本单元
 
+from excel_ingest import serialize_sheet                        # 按列向量化地把工作表转换为文本
+
 # --- 全局配置 ---
 # Excel文件所在的目录路径
 EXCEL_FILES_DIRECTORY = "./data/"
@@ -139,16 +141,8 @@ class ExcelRAGSystem:
                         # 将整个工作表转换为一个字符串，每行数据用换行符分隔
                         # 并且在前面加上列名，使内容更易理解
                         # 示例："列名1: 值A, 列名2: 值B\n列名1: 值C, 列名2: 值D"
-                        sheet_content = ""
-                        for index, row in df.iterrows():  # 遍历DataFrame的每一行
-                            row_texts = []
-                            for col_name, cell_value in row.items():  # 遍历当前行的每个单元格
-                                # 确保单元格内容是字符串，并去除首尾空格
-                                cell_text = str(cell_value).strip()
-                                if cell_text:  # 如果单元格内容不为空
-                                    row_texts.append(f"{str(col_name).strip()}: {cell_text}")
-                            if row_texts:  # 如果当前行有内容
-                                sheet_content += ", ".join(row_texts) + "\n"
+                        # 按列向量化处理，空单元格被跳过（空值保留为 'nan'，与逐行遍历的结果一致）
+                        sheet_content = serialize_sheet(df, skip_nan=False)
 
                         if sheet_content.strip():  # 如果工作表内容不为空
                             # 创建Langchain的Document对象
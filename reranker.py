@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+交叉编码器重排模块 - 在检索候选中挑出与问题最相关的少数文本块
+
+@remarks 双塔嵌入（bi-encoder）分别编码问题和文本块，排序较粗；直接把前3个结果交给LLM
+         常常漏掉真正相关的行，而增大k又会让提示变长、生成变慢。这里先检索更多候选，
+         再用小型交叉编码器（问题与文本块一起编码）批量打分，只把得分最高的几个放入提示。
+         重排有单次请求的时间预算：按历史耗时预估超出预算，或打分过程中超时，都退回原始检索顺序
+@author AI Assistant
+@version 1.0
+"""
+
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+# 估算每对（问题, 文本块）打分耗时的指数滑动平均系数
+_COST_SMOOTHING = 0.2
+
+
+class CrossEncoderReranker:
+    """
+    基于 sentence-transformers CrossEncoder 的重排器，模型在首次使用时加载
+
+    @remarks 模型加载失败（未安装 sentence-transformers、无法下载模型）时记录错误并停用重排，
+             检索仍按原始顺序返回。rerank() 是线程安全的
+    @example
+    ```python
+    reranker = CrossEncoderReranker("cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+    docs, info = reranker.rerank("张三在哪个部门", candidates, top_k=3, budget_seconds=0.3)
+    ```
+    """
+
+    def __init__(self, model_name: str, batch_size: int = 16, max_length: int = 512):
+        """
+        初始化重排器（不立即加载模型）
+
+        @param model_name - CrossEncoder模型名称或路径
+        @param batch_size - 每批打分的（问题, 文本块）对数量
+        @param max_length - 输入的最大token数，超出部分截断
+        """
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self._model = None
+        self._load_error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._pair_seconds: Optional[float] = None  # 每对打分耗时的滑动平均
+        self._stats = {"reranked": 0, "skipped_budget": 0, "aborted_budget": 0, "seconds": 0.0}
+
+    def _get_model(self):
+        """
+        获取（必要时加载）CrossEncoder模型
+
+        @returns 模型对象，加载失败时返回None
+        """
+        with self._lock:
+            if self._model is None and self._load_error is None:
+                try:
+                    from sentence_transformers import CrossEncoder
+                    print(f"正在加载重排模型: {self.model_name}...")
+                    self._model = CrossEncoder(self.model_name, max_length=self.max_length, device="cpu")
+                except Exception as e:
+                    self._load_error = str(e)
+                    print(f"加载重排模型失败，停用重排: {e}")
+            return self._model
+
+    def rerank(self, query: str, documents: List[Document], top_k: int,
+               budget_seconds: Optional[float] = None) -> Tuple[List[Document], Dict[str, Any]]:
+        """
+        对候选文本块重新打分并取前 top_k 个
+
+        @param query - 用户问题
+        @param documents - 按检索顺序排列的候选文本块
+        @param top_k - 返回的数量
+        @param budget_seconds - 本次重排可用的时间（秒），None表示不限制
+        @returns (文本块列表, 重排信息)；未重排时按原始顺序返回前 top_k 个
+        """
+        info = {"model": self.model_name, "candidates": len(documents), "reranked": False}
+        if len(documents) <= 1:
+            return documents[:top_k], info
+
+        if budget_seconds is not None:
+            if budget_seconds <= 0:
+                info["skipped"] = "budget_exhausted"
+                self._stats["skipped_budget"] += 1
+                return documents[:top_k], info
+            if self._pair_seconds is not None and self._pair_seconds * len(documents) > budget_seconds:
+                # 按历史耗时预估会超出预算，直接跳过，不占用CPU；预估逐次衰减，负载下降后会重新尝试
+                info["skipped"] = "budget_estimate"
+                info["estimated_ms"] = round(self._pair_seconds * len(documents) * 1000, 1)
+                self._pair_seconds *= 1 - _COST_SMOOTHING
+                self._stats["skipped_budget"] += 1
+                return documents[:top_k], info
+
+        model = self._get_model()
+        if model is None:
+            info["skipped"] = "model_unavailable"
+            return documents[:top_k], info
+
+        start_time = time.perf_counter()
+        scores = []
+        for start in range(0, len(documents), self.batch_size):
+            batch = documents[start:start + self.batch_size]
+            scores.extend(float(score) for score in model.predict(
+                [(query, doc.page_content) for doc in batch], batch_size=self.batch_size, show_progress_bar=False
+            ))
+            elapsed = time.perf_counter() - start_time
+            if budget_seconds is not None and elapsed > budget_seconds and len(scores) < len(documents):
+                self._record_cost(elapsed, len(scores))
+                info["skipped"] = "budget_exceeded"
+                info["rerank_ms"] = round(elapsed * 1000, 1)
+                self._stats["aborted_budget"] += 1
+                return documents[:top_k], info
+
+        elapsed = time.perf_counter() - start_time
+        self._record_cost(elapsed, len(documents))
+        order = sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)[:top_k]
+        reranked = []
+        for i in order:
+            doc = Document(page_content=documents[i].page_content,
+                           metadata={**documents[i].metadata, "rerank_score": round(scores[i], 4)})
+            reranked.append(doc)
+        info.update({"reranked": True, "rerank_ms": round(elapsed * 1000, 1)})
+        self._stats["reranked"] += 1
+        self._stats["seconds"] += elapsed
+        return reranked, info
+
+    def _record_cost(self, elapsed: float, pairs: int):
+        """
+        更新每对打分耗时的滑动平均
+
+        @param elapsed - 本次打分耗时（秒）
+        @param pairs - 本次打分的对数
+        @returns 无返回值
+        """
+        if pairs <= 0:
+            return
+        cost = elapsed / pairs
+        with self._lock:
+            if self._pair_seconds is None:
+                self._pair_seconds = cost
+            else:
+                self._pair_seconds += _COST_SMOOTHING * (cost - self._pair_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取重排统计
+
+        @returns 包含重排次数、因预算跳过/中止次数和平均耗时的字典
+        """
+        reranked = self._stats["reranked"]
+        return {
+            "model": self.model_name,
+            "loaded": self._model is not None,
+            "load_error": self._load_error,
+            "reranked": reranked,
+            "skipped_budget": self._stats["skipped_budget"],
+            "aborted_budget": self._stats["aborted_budget"],
+            "avg_rerank_ms": round(self._stats["seconds"] / reranked * 1000, 1) if reranked else None,
+            "pair_ms": round(self._pair_seconds * 1000, 2) if self._pair_seconds is not None else None
+        }
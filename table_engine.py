@@ -0,0 +1,922 @@
+# -*- coding: utf-8 -*-
+"""
+表格查询模块 - 把工作表保存为带类型的Parquet列式表，对统计/筛选类问题在整张表上精确计算
+
+@remarks "市场部平均薪资是多少" 这类问题靠检索3个文本块再让LLM心算，既不完整也不准确。
+         这里在摄取时把每个工作表按列推断类型（数值/日期/文本）后写成Parquet：
+         1. 每个工作簿一个目录（VECTOR_STORE_DIR/tables/<文件名摘要>/），每个工作表一个 .parquet 文件，
+            清单 manifest.json 记录列名与列类型，写入临时目录后整体替换，读取方不会看到写了一半的表；
+         2. 问题解析是基于规则的：识别聚合意图（平均/总和/最高/最低/中位数/计数）、问题中出现的列名、
+            文本列的取值（如 "市场部" 属于 "部门" 列）、数值条件（"薪资大于1万"）和分组（"各部门"）；
+         3. 列名和文本列的取值词表在写入时记入清单，解析问题只用清单中的词表为各工作表打分，
+            只读取得分最高的一张表，用pandas对整列做向量化的布尔筛选和聚合，结果精确且通常在毫秒级。
+         无法可靠解析的问题返回None，调用方照常走文本检索。
+         同一目录同时是工作簿的解析快照：清单记录文件哈希，每个工作表另存一份按行序列化的文本
+         （<序号>.rows.parquet）。文件未变化时重建、调整切分参数都直接读快照，不再用openpyxl重新解析
+@author AI Assistant
+@version 1.0
+"""
+
+import hashlib
+import json
+import re
+import shutil
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+TABLE_FORMAT_VERSION = 3  # 2: 清单记录文件哈希和表头，每个工作表附带行文本快照；3: 清单记录文本列的取值词表
+MANIFEST_NAME = "manifest.json"
+# 文本列的不同取值不超过该数量时，才把取值用于匹配问题中的筛选条件（如姓名、部门）
+VALUE_INDEX_MAX_DISTINCT = 20_000
+# 参与匹配的取值/列名的最大长度（字符）
+MAX_MATCH_CHARS = 32
+# 内存中缓存的表数据总大小上限（字节），按LRU淘汰；规划查询只用清单中的词表，不占用该缓存
+TABLE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# 分组结果和明细行的返回上限
+RESULT_MAX_GROUPS = 50
+RESULT_MAX_ROWS = 5
+
+# 列类型
+KIND_NUMBER = "number"
+KIND_DATETIME = "datetime"
+KIND_STRING = "string"
+
+# 聚合意图关键词（按优先级排列）
+_AGGREGATE_KEYWORDS = [
+    ("mean", ("平均", "均值", "average", "mean")),
+    ("median", ("中位数", "median")),
+    ("sum", ("总和", "合计", "总计", "总额", "总共", "一共", "加起来", "sum", "total")),
+    ("max", ("最高", "最大", "最多", "最贵", "最长", "最晚", "highest", "max")),
+    ("min", ("最低", "最小", "最少", "最便宜", "最短", "最早", "lowest", "min")),
+    ("count", ("多少人", "多少个", "多少条", "多少名", "多少位", "多少家", "多少行", "几个", "几人", "几位",
+               "几名", "几条", "几家", "人数", "数量", "个数", "总数", "count", "how many")),
+]
+# 问的是"哪一行"而不是"多少"
+_WHICH_PATTERN = re.compile(r"谁|哪个|哪位|哪些|哪一|哪家|哪条|什么人|which|who")
+_COMPARATORS = [
+    (">=", ("大于等于", "大于或等于", "不低于", "不少于", "不小于", "至少", ">=")),
+    ("<=", ("小于等于", "小于或等于", "不高于", "不超过", "不大于", "至多", "<=")),
+    (">", ("大于", "高于", "超过", "多于", "高过", ">")),
+    ("<", ("小于", "低于", "少于", "不到", "<")),
+    ("==", ("等于", "==", "=", "为", "是")),
+]
+_COMPARATOR_WORDS = {word: op for op, words in _COMPARATORS for word in words}
+_NUMBER = r"(-?\d+(?:\.\d+)?)\s*(万|千|k|w)?"
+_COMPARE_PATTERN = re.compile(
+    r"\s*(?:的)?\s*(" + "|".join(re.escape(word) for word in sorted(_COMPARATOR_WORDS, key=len, reverse=True))
+    + r")\s*" + _NUMBER
+)
+_RANGE_PATTERN = re.compile(r"\s*(?:在)?\s*" + _NUMBER + r"\s*(?:及)?(以上|以下)")
+_UNIT_SCALE = {"万": 10_000, "w": 10_000, "千": 1_000, "k": 1_000}
+_GROUP_PREFIXES = ("各个", "每一个", "每个", "按照", "各", "每", "按", "分", "哪个", "哪些")
+_OP_NAMES = {"mean": "平均值", "median": "中位数", "sum": "总和", "max": "最大值", "min": "最小值", "count": "行数"}
+# 列名中的单位说明，如 "薪资(元)"
+_UNIT_SUFFIX_PATTERN = re.compile(r"[（(][^）)]*[）)]$")
+
+
+def table_dir_name(source_file: str) -> str:
+    """
+    工作簿对应的表目录名（文件名可能包含不适合做目录名的字符，使用摘要）
+
+    @param source_file - 工作簿文件名
+    @returns 目录名
+    """
+    return hashlib.sha1(source_file.encode("utf-8")).hexdigest()[:16]
+
+
+def _normalize(text: str) -> str:
+    """
+    规范化用于匹配的文本：全角转半角、统一大小写
+
+    @param text - 原始文本
+    @returns 规范化后的文本
+    """
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def _is_number(value: Any) -> bool:
+    """
+    判断是否为数字（布尔值除外）
+
+    @param value - 单元格值
+    @returns 是数字返回True
+    """
+    return isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_))
+
+
+def infer_column_kind(series: pd.Series) -> str:
+    """
+    推断列类型：全部非空值都是数字（或数字文本）为数值列，全部是日期为日期列，否则为文本列
+
+    @param series - 列数据
+    @returns KIND_NUMBER / KIND_DATETIME / KIND_STRING
+    """
+    if series.dtype.kind in "iuf":
+        return KIND_NUMBER
+    if series.dtype.kind == "M":
+        return KIND_DATETIME
+    values = series.dropna()
+    if isinstance(series.dtype, np.dtype) and series.dtype.kind == "O":
+        values = values[values.map(lambda value: not (isinstance(value, str) and value.strip() == ""))]
+    if values.empty or series.dtype.kind == "b":
+        return KIND_STRING
+    if values.map(lambda value: isinstance(value, (datetime, date, pd.Timestamp))).all():
+        return KIND_DATETIME
+    if values.map(_is_number).all():
+        return KIND_NUMBER
+    converted = pd.to_numeric(values.astype(str).str.strip().str.replace(",", "", regex=False), errors="coerce")
+    return KIND_NUMBER if converted.notna().all() else KIND_STRING
+
+
+def coerce_column(series: pd.Series, kind: str) -> pd.Series:
+    """
+    按列类型转换列数据，无法转换的值变为空值
+
+    @param series - 列数据
+    @param kind - 列类型
+    @returns 转换后的列
+    """
+    if kind == KIND_NUMBER:
+        if series.dtype.kind in "iuf":
+            return series
+        text = series.map(lambda value: value if value is None or _is_number(value) else str(value).strip().replace(",", ""))
+        return pd.to_numeric(text, errors="coerce")
+    if kind == KIND_DATETIME:
+        return pd.to_datetime(series, errors="coerce")
+    return series.map(lambda value: None if value is None or (isinstance(value, float) and np.isnan(value))
+                      else (str(value).strip() or None)).astype(object)
+
+
+def coerce_table(df: pd.DataFrame, kinds: Optional[Dict[str, str]] = None) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    """
+    把工作表转换为带类型的列式表
+
+    @param df - 工作表数据（列名会去除首尾空格）
+    @param kinds - 已确定的列类型（流式写入后续批次时沿用第一批的类型），None表示逐列推断
+    @returns (转换后的表, 列名到列类型的字典)
+    """
+    columns = {}
+    resolved = {}
+    for position, name in enumerate(df.columns):
+        column_name = str(name).strip() or f"Unnamed: {position}"
+        if column_name in columns:
+            column_name = f"{column_name}.{position}"
+        series = df.iloc[:, position]
+        kind = (kinds or {}).get(column_name) or infer_column_kind(series)
+        columns[column_name] = coerce_column(series, kind).reset_index(drop=True)
+        resolved[column_name] = kind
+    return pd.DataFrame(columns), resolved
+
+
+def _row_texts_schema():
+    """
+    行文本快照的Arrow schema（行号、行文本两列）
+
+    @returns pyarrow.Schema
+    """
+    import pyarrow as pa
+    return pa.schema([("row", pa.int64()), ("text", pa.string())])
+
+
+def _row_texts_table(row_texts: pd.Series):
+    """
+    把行文本转换为Arrow表
+
+    @param row_texts - 以行号（从0开始，不含表头）为索引的行文本Series，见 excel_ingest.sheet_row_texts
+    @returns pyarrow.Table
+    """
+    import pyarrow as pa
+    return pa.Table.from_arrays([pa.array(row_texts.index.to_numpy(dtype=np.int64), type=pa.int64()),
+                                 pa.array(row_texts.tolist(), type=pa.string())], schema=_row_texts_schema())
+
+
+def _distinct_values(table: pd.DataFrame, kinds: Dict[str, str]) -> Dict[str, set]:
+    """
+    收集文本列的不同取值（超过 VALUE_INDEX_MAX_DISTINCT 的列不收集）
+
+    @param table - coerce_table() 转换后的表
+    @param kinds - 列类型
+    @returns 列名到取值集合的字典
+    """
+    values = {}
+    for name, kind in kinds.items():
+        if kind != KIND_STRING or name not in table:
+            continue
+        distinct = table[name].dropna().unique()
+        if len(distinct) <= VALUE_INDEX_MAX_DISTINCT:
+            values[name] = set(distinct.tolist())
+    return values
+
+
+def _arrow_schema(kinds: Dict[str, str]):
+    """
+    根据列类型生成固定的Arrow schema（流式写入时各批次必须一致）
+
+    @param kinds - 列名到列类型的字典
+    @returns pyarrow.Schema
+    """
+    import pyarrow as pa
+    types = {KIND_NUMBER: pa.float64(), KIND_DATETIME: pa.timestamp("ns"), KIND_STRING: pa.string()}
+    return pa.schema([(name, types[kind]) for name, kind in kinds.items()])
+
+
+class TableWriter:
+    """
+    把一个工作簿的各工作表写为Parquet表和行文本快照；全部写完后 commit() 整体替换旧目录
+
+    @remarks 摄取进程（包括解析工作簿的子进程）在读取工作表时顺便写入，不需要再次解析Excel
+    @example
+    ```python
+    writer = TableWriter(Path("./vector_store/tables"), "员工.xlsx", file_hash)
+    writer.write_sheet("员工信息", df, sheet_row_texts(df))
+    writer.commit()
+    ```
+    """
+
+    def __init__(self, table_root: Path, source_file: str, file_hash: Optional[str] = None):
+        """
+        初始化写入器，在临时目录中写入
+
+        @param table_root - 所有表的根目录
+        @param source_file - 工作簿文件名
+        @param file_hash - 工作簿文件的哈希，None表示不作为解析快照使用（只用于表格查询）
+        """
+        self.table_root = Path(table_root)
+        self.source_file = source_file
+        self.file_hash = file_hash
+        self._final_dir = self.table_root / table_dir_name(source_file)
+        self._tmp_dir = self.table_root / f".{self._final_dir.name}.{uuid.uuid4().hex}.tmp"
+        self._tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._sheets: List[Dict[str, Any]] = []
+        self._streams: Dict[str, Tuple[Any, Any, Dict[str, str], Dict[str, Any]]] = {}
+
+    def _entry(self, sheet_name: str, kinds: Dict[str, str], header_columns: List[str]) -> Dict[str, Any]:
+        """
+        登记新的工作表
+
+        @param sheet_name - 工作表名
+        @param kinds - 列类型
+        @param header_columns - 原始列名（生成文本块表头用，与 kinds 中去重后的列名可能不同）
+        @returns 清单中该工作表的条目
+        """
+        position = len(self._sheets)
+        entry = {"sheet_name": sheet_name, "file": f"{position}.parquet", "rows_file": f"{position}.rows.parquet",
+                 "columns": kinds, "header_columns": header_columns, "rows": 0, "text_rows": 0, "values": {}}
+        self._sheets.append(entry)
+        return entry
+
+    def write_sheet(self, sheet_name: str, df: pd.DataFrame, row_texts: pd.Series):
+        """
+        写入整个工作表
+
+        @param sheet_name - 工作表名
+        @param df - 工作表数据
+        @param row_texts - 工作表的行文本（excel_ingest.sheet_row_texts 的结果）
+        @returns 无返回值
+        """
+        import pyarrow.parquet as pq
+
+        table, kinds = coerce_table(df)
+        entry = self._entry(sheet_name, kinds, [str(column) for column in df.columns])
+        table.to_parquet(self._tmp_dir / entry["file"], index=False)
+        pq.write_table(_row_texts_table(row_texts), self._tmp_dir / entry["rows_file"])
+        entry["values"] = {name: sorted(values) for name, values in _distinct_values(table, kinds).items()}
+        entry["rows"] = len(table)
+        entry["text_rows"] = len(row_texts)
+
+    def append_rows(self, sheet_name: str, df: pd.DataFrame, row_texts: pd.Series):
+        """
+        追加工作表的一批行（流式读取大文件时使用），列类型和表头由该工作表的第一批决定
+
+        @remarks 后续批次中无法转换为第一批列类型的值写为空值；取值词表跨批次累计，
+                 某列的不同取值超过 VALUE_INDEX_MAX_DISTINCT 时不再收集该列
+        @param sheet_name - 工作表名
+        @param df - 一批行数据
+        @param row_texts - 这一批的行文本，索引为工作表内的行号（已加上批次偏移）
+        @returns 无返回值
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if sheet_name not in self._streams:
+            _, kinds = coerce_table(df)
+            entry = self._entry(sheet_name, kinds, [str(column) for column in df.columns])
+            # 流式写入期间 values 为 列名 -> 取值集合，None表示取值过多，_close_streams() 时转换为列表
+            entry["values"] = {name: set() for name, kind in kinds.items() if kind == KIND_STRING}
+            self._streams[sheet_name] = (pq.ParquetWriter(self._tmp_dir / entry["file"], _arrow_schema(kinds)),
+                                         pq.ParquetWriter(self._tmp_dir / entry["rows_file"], _row_texts_schema()),
+                                         kinds, entry)
+        writer, rows_writer, kinds, entry = self._streams[sheet_name]
+        table, _ = coerce_table(df, kinds)
+        writer.write_table(pa.Table.from_pandas(table, schema=writer.schema, preserve_index=False))
+        rows_writer.write_table(_row_texts_table(row_texts))
+        batch_values = _distinct_values(table, kinds)
+        for name, values in entry["values"].items():
+            if values is None:
+                continue
+            if name in batch_values:
+                values |= batch_values[name]
+            if name not in batch_values or len(values) > VALUE_INDEX_MAX_DISTINCT:
+                entry["values"][name] = None
+        entry["rows"] += len(table)
+        entry["text_rows"] += len(row_texts)
+
+    def _close_streams(self):
+        """
+        关闭流式写入的Parquet文件
+
+        @returns 无返回值
+        """
+        streams = list(self._streams.values())
+        self._streams.clear()
+        for writer, rows_writer, _, entry in streams:
+            writer.close()
+            rows_writer.close()
+            entry["values"] = {name: sorted(values) for name, values in entry["values"].items() if values is not None}
+
+    def commit(self):
+        """
+        写入清单并替换该工作簿原来的表目录
+
+        @returns 无返回值
+        """
+        self._close_streams()
+        manifest = {
+            "format_version": TABLE_FORMAT_VERSION,
+            "source_file": self.source_file,
+            "file_hash": self.file_hash,
+            "token": uuid.uuid4().hex,
+            "sheets": self._sheets
+        }
+        with open(self._tmp_dir / MANIFEST_NAME, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+
+        old_dir = None
+        if self._final_dir.exists():
+            old_dir = self.table_root / f".{self._final_dir.name}.{uuid.uuid4().hex}.old"
+            self._final_dir.rename(old_dir)
+        self._tmp_dir.rename(self._final_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    def abort(self):
+        """
+        放弃写入，删除临时目录（原来的表保持不变）
+
+        @returns 无返回值
+        """
+        try:
+            self._close_streams()
+        except Exception:
+            pass
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+def read_snapshot(table_root: Path, source_file: str, file_hash: str) -> Optional[Dict[str, Any]]:
+    """
+    读取与文件内容一致的解析快照清单
+
+    @param table_root - 所有表的根目录
+    @param source_file - 工作簿文件名
+    @param file_hash - 工作簿文件当前的哈希
+    @returns 清单（sheets 中每项含 sheet_name、header_columns、rows_file 等），
+             快照不存在、格式版本不同或文件哈希不一致时返回None
+    """
+    snapshot_dir = Path(table_root) / table_dir_name(source_file)
+    try:
+        with open(snapshot_dir / MANIFEST_NAME, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (manifest.get("format_version") != TABLE_FORMAT_VERSION or manifest.get("source_file") != source_file
+            or not file_hash or manifest.get("file_hash") != file_hash):
+        return None
+    manifest["dir"] = str(snapshot_dir)
+    return manifest
+
+
+def remove_tables(table_root: Path, source_file: str):
+    """
+    删除工作簿的全部表
+
+    @param table_root - 所有表的根目录
+    @param source_file - 工作簿文件名
+    @returns 无返回值
+    """
+    shutil.rmtree(Path(table_root) / table_dir_name(source_file), ignore_errors=True)
+
+
+class _SheetIndex:
+    """
+    一张工作表的匹配索引（列名、文本列取值），由清单中的列类型和取值词表建立，不需要读取表数据
+    """
+
+    def __init__(self, kinds: Dict[str, str], values: Dict[str, List[str]]):
+        """
+        建立列名和文本列取值的匹配索引
+
+        @param kinds - 列类型
+        @param values - 清单中记录的文本列取值词表
+        """
+        self.kinds = kinds
+        # 规范化的列名（含去掉单位说明的别名） -> 列名
+        self.column_names: Dict[str, str] = {}
+        for name in kinds:
+            normalized = _normalize(name)
+            self.column_names.setdefault(normalized, name)
+            alias = _UNIT_SUFFIX_PATTERN.sub("", normalized).strip()
+            if alias:
+                self.column_names.setdefault(alias, name)
+        # 规范化的取值 -> [(列名, 原始取值)]
+        self.values: Dict[str, List[Tuple[str, str]]] = {}
+        for name, distinct in values.items():
+            for value in distinct:
+                normalized = _normalize(value)
+                if len(normalized) > MAX_MATCH_CHARS or normalized.replace(".", "").isdigit():
+                    continue
+                if len(normalized) == 1 and normalized.isascii():
+                    continue
+                self.values.setdefault(normalized, []).append((name, value))
+
+
+class TableStore:
+    """
+    读取摄取时写入的Parquet表，表数据按总大小在内存中LRU缓存
+
+    @remarks refresh() 重新读取各工作簿的清单；清单令牌变化（表被重写）的缓存自动失效。
+             index() 只用清单建立匹配索引，选择工作表时不读取任何表数据。线程安全
+    """
+
+    def __init__(self, table_root: Path, cache_max_bytes: int = TABLE_CACHE_MAX_BYTES):
+        """
+        初始化表存储
+
+        @param table_root - 所有表的根目录
+        @param cache_max_bytes - 内存中缓存的表数据总大小上限（字节）
+        """
+        self.table_root = Path(table_root)
+        self.cache_max_bytes = cache_max_bytes
+        self._lock = threading.Lock()
+        self._manifests: Dict[str, Dict[str, Any]] = {}
+        self._indexes: Dict[Tuple[str, str, str], _SheetIndex] = {}
+        self._cache: "OrderedDict[Tuple[str, str, str], Tuple[pd.DataFrame, int]]" = OrderedDict()
+        self._cached_bytes = 0
+        self.refresh()
+
+    def refresh(self):
+        """
+        重新读取所有工作簿的清单
+
+        @returns 无返回值
+        """
+        manifests = {}
+        if self.table_root.exists():
+            for manifest_path in self.table_root.glob(f"*/{MANIFEST_NAME}"):
+                try:
+                    with open(manifest_path, "r", encoding="utf-8") as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if manifest.get("format_version") == TABLE_FORMAT_VERSION:
+                    manifest["dir"] = manifest_path.parent.name
+                    manifests[manifest["source_file"]] = manifest
+        with self._lock:
+            self._manifests = manifests
+            tokens = {manifest["token"] for manifest in manifests.values()}
+            for key in [key for key in self._indexes if key[1] not in tokens]:
+                del self._indexes[key]
+            for key in [key for key in self._cache if key[1] not in tokens]:
+                self._cached_bytes -= self._cache.pop(key)[1]
+
+    def has(self, source_file: str) -> bool:
+        """
+        是否已有该工作簿的表
+
+        @param source_file - 工作簿文件名
+        @returns 存在返回True
+        """
+        return source_file in self._manifests
+
+    def remove(self, source_file: str):
+        """
+        删除工作簿的全部表
+
+        @param source_file - 工作簿文件名
+        @returns 无返回值
+        """
+        remove_tables(self.table_root, source_file)
+        with self._lock:
+            self._manifests.pop(source_file, None)
+
+    def retain(self, source_files: Iterable[str]):
+        """
+        只保留给定工作簿的表，删除其余的表（以及中断的写入留下的临时目录）
+
+        @param source_files - 需要保留的工作簿文件名
+        @returns 无返回值
+        """
+        keep = {table_dir_name(source_file) for source_file in source_files}
+        if self.table_root.exists():
+            for path in self.table_root.iterdir():
+                if path.is_dir() and path.name not in keep:
+                    shutil.rmtree(path, ignore_errors=True)
+        self.refresh()
+
+    def sheets(self, source_files: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """
+        列出工作表
+
+        @param source_files - 只列出这些工作簿的工作表，None表示全部
+        @returns 工作表信息列表（含 source_file、sheet_name、columns、rows 等）
+        """
+        wanted = set(source_files) if source_files else None
+        with self._lock:
+            manifests = list(self._manifests.values())
+        sheets = []
+        for manifest in manifests:
+            if wanted is not None and manifest["source_file"] not in wanted:
+                continue
+            for sheet in manifest["sheets"]:
+                sheets.append({**sheet, "source_file": manifest["source_file"],
+                               "dir": manifest["dir"], "token": manifest["token"]})
+        return sheets
+
+    def index(self, sheet: Dict[str, Any]) -> _SheetIndex:
+        """
+        获取工作表的匹配索引（由清单建立，不读取表数据）
+
+        @param sheet - sheets() 返回的工作表信息
+        @returns 匹配索引
+        """
+        key = (sheet["dir"], sheet["token"], sheet["file"])
+        with self._lock:
+            index = self._indexes.get(key)
+        if index is None:
+            index = _SheetIndex(sheet["columns"], sheet.get("values", {}))
+            with self._lock:
+                self._indexes[key] = index
+        return index
+
+    def load(self, sheet: Dict[str, Any]) -> pd.DataFrame:
+        """
+        读取工作表（使用内存映射读取Parquet）
+
+        @param sheet - sheets() 返回的工作表信息（或含 dir、token、file 的查询计划）
+        @returns 表数据
+        """
+        key = (sheet["dir"], sheet["token"], sheet["file"])
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached[0]
+        df = pd.read_parquet(self.table_root / sheet["dir"] / sheet["file"], memory_map=True)
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = (df, size)
+                self._cached_bytes += size
+            # 至少保留刚读取的表
+            while self._cached_bytes > self.cache_max_bytes and len(self._cache) > 1:
+                self._cached_bytes -= self._cache.popitem(last=False)[1][1]
+        return df
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取表存储统计
+
+        @returns 包含工作簿数、工作表数、总行数、磁盘占用和缓存占用的字典
+        """
+        sheets = self.sheets()
+        disk_bytes = 0
+        for sheet in sheets:
+            for name in (sheet["file"], sheet["rows_file"]):
+                try:
+                    disk_bytes += (self.table_root / sheet["dir"] / name).stat().st_size
+                except OSError:
+                    pass
+        return {
+            "workbooks": len(self._manifests),
+            "sheets": len(sheets),
+            "rows": sum(sheet["rows"] for sheet in sheets),
+            "disk_bytes": disk_bytes,
+            "cached_tables": len(self._cache),
+            "cached_bytes": self._cached_bytes
+        }
+
+
+def _find_spans(text: str, lookup: Dict[str, Any]) -> List[Tuple[int, int, str]]:
+    """
+    找出文本中出现的所有词典项（按长度从长到短，不重叠）
+
+    @param text - 规范化后的问题
+    @param lookup - 规范化的词 -> 任意值
+    @returns (起始位置, 结束位置, 词) 列表，按起始位置排序
+    """
+    found = []
+    for start in range(len(text)):
+        for end in range(min(len(text), start + MAX_MATCH_CHARS), start, -1):
+            if text[start:end] in lookup:
+                found.append((start, end, text[start:end]))
+    found.sort(key=lambda span: (-(span[1] - span[0]), span[0]))
+    chosen = []
+    for span in found:
+        if all(span[1] <= other[0] or span[0] >= other[1] for other in chosen):
+            chosen.append(span)
+    return sorted(chosen)
+
+
+def _overlaps(span: Tuple[int, int, str], spans: List[Tuple[int, int, str]]) -> bool:
+    """
+    判断区间是否与任一已有区间重叠
+
+    @param span - 待判断的区间
+    @param spans - 已有区间
+    @returns 重叠返回True
+    """
+    return any(not (span[1] <= other[0] or span[0] >= other[1]) for other in spans)
+
+
+def _to_python(value: Any) -> Any:
+    """
+    转换为可JSON序列化的Python值
+
+    @param value - numpy/pandas标量
+    @returns Python标量，空值返回None
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else round(value, 4)
+    return value
+
+
+class TableQueryEngine:
+    """
+    把统计/筛选类问题解析为表格查询并在整张表上执行
+
+    @example
+    ```python
+    engine = TableQueryEngine(TableStore(Path("./vector_store/tables")))
+    result = engine.answer("市场部平均薪资是多少")
+    print(describe_result(result))
+    ```
+    """
+
+    def __init__(self, store: TableStore):
+        """
+        初始化查询引擎
+
+        @param store - 表存储
+        """
+        self.store = store
+
+    def plan(self, question: str, source_files: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """
+        解析问题，选出最匹配的工作表并生成查询计划
+
+        @param question - 用户问题
+        @param source_files - 只在这些工作簿中查找，None表示全部
+        @returns 查询计划（工作表、筛选条件、分组、聚合方式、目标列），不是统计/筛选类问题时返回None
+        """
+        text = _normalize(question)
+        operations = [op for op, words in _AGGREGATE_KEYWORDS if any(word in text for word in words)]
+        if not operations:
+            return None
+
+        # 只用清单中的列名和取值词表为各工作表打分，execute() 时才读取选中的一张表
+        sheets = self.store.sheets(source_files)
+        best = None
+        for sheet in sheets:
+            candidate = self._plan_for_table(text, operations, sheet, self.store.index(sheet))
+            if candidate is not None and (best is None or candidate["score"] > best["score"]):
+                best = candidate
+        if best is None or (best["score"] <= 0 and len(sheets) > 1):
+            return None
+        return best
+
+    @staticmethod
+    def _plan_for_table(text: str, operations: List[str], sheet: Dict[str, Any],
+                        table: _SheetIndex) -> Optional[Dict[str, Any]]:
+        """
+        针对一张表生成查询计划并打分
+
+        @param text - 规范化后的问题
+        @param operations - 问题中出现的聚合意图
+        @param sheet - 工作表信息
+        @param table - 工作表的匹配索引
+        @returns 查询计划，这张表无法回答时返回None
+        """
+        value_spans = _find_spans(text, table.values)
+        column_spans = [span for span in _find_spans(text, table.column_names) if not _overlaps(span, value_spans)]
+        mentioned = [(span, table.column_names[span[2]]) for span in column_spans]
+
+        # 数值条件："薪资大于1万"、"年龄30以上"
+        numeric_filters = []
+        compared_columns = set()
+        for span, column in mentioned:
+            if table.kinds[column] != KIND_NUMBER:
+                continue
+            following = text[span[1]:]
+            match = _COMPARE_PATTERN.match(following)
+            if match:
+                op = _COMPARATOR_WORDS[match.group(1)]
+                number, unit = match.group(2), match.group(3)
+            else:
+                match = _RANGE_PATTERN.match(following)
+                if not match:
+                    continue
+                number, unit = match.group(1), match.group(2)
+                op = ">=" if match.group(3) == "以上" else "<="
+            value = float(number) * _UNIT_SCALE.get(unit, 1)
+            numeric_filters.append({"column": column, "op": op, "value": _to_python(value)})
+            compared_columns.add(column)
+
+        # 分组："各部门"、"按部门"、"哪个部门"
+        group_by = None
+        for span, column in mentioned:
+            if table.kinds[column] == KIND_STRING and text[:span[0]].endswith(_GROUP_PREFIXES):
+                group_by = column
+                break
+
+        # 文本取值条件：同一列的多个取值为"或"
+        value_filters: Dict[str, List[str]] = {}
+        for _, _, normalized in value_spans:
+            column, value = table.values[normalized][0]
+            if column != group_by:
+                value_filters.setdefault(column, [])
+                if value not in value_filters[column]:
+                    value_filters[column].append(value)
+
+        targets = [column for _, column in mentioned
+                   if table.kinds[column] in (KIND_NUMBER, KIND_DATETIME) and column not in compared_columns]
+        if not targets:
+            # "薪资大于1万的平均薪资"：只出现在条件中的列也可以作为聚合目标
+            targets = [column for _, column in mentioned if column in compared_columns]
+        target = targets[0] if targets else None
+        wants_row = bool(_WHICH_PATTERN.search(text)) and group_by is None
+
+        operation = None
+        order = None
+        if target is not None:
+            for op in ("mean", "median", "sum", "max", "min"):
+                if op in operations and (op in ("max", "min") or table.kinds[target] == KIND_NUMBER):
+                    operation = op
+                    break
+            if operation in ("max", "min") and wants_row:
+                operation = "argmax" if operation == "max" else "argmin"
+        if operation is None and "count" in operations:
+            operation = "count"
+            target = None
+        if operation is None:
+            return None
+        if group_by is not None:
+            # "哪个部门平均薪资最高"：分组后按值排序
+            if operation not in ("max", "min") and ("max" in operations or "min" in operations):
+                order = "desc" if "max" in operations else "asc"
+            else:
+                order = "desc"
+
+        score = 3 * len(value_spans) + 2 * len(column_spans)
+        for name in (sheet["sheet_name"], Path(sheet["source_file"]).stem):
+            if _normalize(str(name)) in text:
+                score += 2
+        return {
+            "source_file": sheet["source_file"],
+            "sheet_name": sheet["sheet_name"],
+            "dir": sheet["dir"],
+            "token": sheet["token"],
+            "file": sheet["file"],
+            "columns": sheet["columns"],
+            "operation": operation,
+            "column": target,
+            "filters": [{"column": column, "op": "in", "value": values} for column, values in value_filters.items()]
+                       + numeric_filters,
+            "group_by": group_by,
+            "order": order,
+            "score": score
+        }
+
+    def execute(self, plan: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        在整张表上执行查询计划（向量化筛选与聚合）
+
+        @param plan - plan() 返回的查询计划
+        @returns 查询结果，包含 value（单个值）、groups（分组结果）或 rows（明细行）之一
+        """
+        table = self.store.load(plan)
+        mask = np.ones(len(table), dtype=bool)
+        for condition in plan["filters"]:
+            column = table[condition["column"]]
+            if condition["op"] == "in":
+                mask &= column.isin(condition["value"]).to_numpy()
+            else:
+                compare = {">": np.greater, ">=": np.greater_equal, "<": np.less, "<=": np.less_equal,
+                           "==": np.equal}[condition["op"]]
+                mask &= compare(column.to_numpy(dtype=float, na_value=np.nan), condition["value"])
+        selected = table[mask]
+
+        result = {key: plan[key] for key in ("source_file", "sheet_name", "operation", "column", "filters", "group_by")}
+        result["total_rows"] = len(table)
+        result["rows_matched"] = int(mask.sum())
+        operation, column = plan["operation"], plan["column"]
+
+        if plan["group_by"] is not None:
+            grouped = selected.groupby(plan["group_by"], sort=False)
+            values = grouped.size() if operation == "count" else grouped[column].agg(operation)
+            values = values.dropna().sort_values(ascending=plan["order"] == "asc", kind="stable")
+            result["groups"] = [{"group": _to_python(group), "value": _to_python(value)}
+                                for group, value in values.head(RESULT_MAX_GROUPS).items()]
+            result["group_count"] = len(values)
+        elif operation == "count":
+            result["value"] = result["rows_matched"]
+        elif operation in ("argmax", "argmin"):
+            series = selected[column].dropna()
+            if not series.empty:
+                best = series.max() if operation == "argmax" else series.min()
+                rows = selected.loc[series.index[series == best]].head(RESULT_MAX_ROWS)
+                result["value"] = _to_python(best)
+                result["rows"] = [{name: _to_python(value) for name, value in row.items()}
+                                  for row in rows.to_dict("records")]
+        else:
+            series = selected[column].dropna()
+            result["value"] = _to_python(series.agg(operation)) if not series.empty else None
+            result["values_counted"] = len(series)
+        return result
+
+    def answer(self, question: str, source_files: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """
+        解析并执行问题
+
+        @param question - 用户问题
+        @param source_files - 只在这些工作簿中查找，None表示全部
+        @returns 查询结果（含 elapsed_ms），不是统计/筛选类问题或执行失败时返回None
+        """
+        start_time = time.perf_counter()
+        try:
+            plan = self.plan(question, source_files)
+            if plan is None:
+                return None
+            result = self.execute(plan)
+        except Exception as e:
+            print(f"表格查询失败，改用文本检索: {e}")
+            return None
+        result["elapsed_ms"] = round((time.perf_counter() - start_time) * 1000, 2)
+        return result
+
+
+def _describe_filter(condition: Dict[str, Any]) -> str:
+    """
+    把筛选条件写成文字
+
+    @param condition - 筛选条件
+    @returns 描述文本
+    """
+    if condition["op"] == "in":
+        return f"{condition['column']} 为 {' 或 '.join(str(value) for value in condition['value'])}"
+    return f"{condition['column']} {condition['op']} {condition['value']}"
+
+
+def describe_result(result: Dict[str, Any]) -> str:
+    """
+    把查询结果写成放入提示的文字
+
+    @param result - execute() / answer() 返回的结果
+    @returns 描述文本
+    """
+    lines = [f"表格精确计算结果（基于 {result['source_file']} / {result['sheet_name']} 全部 {result['total_rows']} 行，"
+             f"请以此为准）:"]
+    if result["filters"]:
+        conditions = "，".join(_describe_filter(condition) for condition in result["filters"])
+        lines.append(f"筛选条件: {conditions}（匹配 {result['rows_matched']} 行）")
+    operation, column = result["operation"], result["column"]
+    if "groups" in result:
+        measure = "行数" if operation == "count" else f"{column} 的{_OP_NAMES[operation]}"
+        lines.append(f"按 {result['group_by']} 分组的{measure}（共 {result['group_count']} 组）:")
+        lines.extend(f"  {group['group']}: {group['value']}" for group in result["groups"])
+    elif operation == "count":
+        lines.append(f"行数: {result['value']}")
+    elif operation in ("argmax", "argmin"):
+        label = "最大" if operation == "argmax" else "最小"
+        if result.get("rows"):
+            lines.append(f"{column} {label}的记录（{column} = {result['value']}）:")
+            for row in result["rows"]:
+                lines.append("  " + ", ".join(f"{name}: {value}" for name, value in row.items() if value is not None))
+        else:
+            lines.append(f"没有 {column} 的有效值")
+    else:
+        lines.append(f"{column} 的{_OP_NAMES[operation]}: {result['value']}（共 {result['values_counted']} 个有效值）")
+    return "\n".join(lines)
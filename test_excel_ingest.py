@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试Excel摄取模块的脚本
+
+@remarks 验证向量化序列化与原来的逐行实现输出一致，按行切分的文本块不会拆开整行，
+         以及从解析快照切分的结果与直接解析Excel一致
+@author AI Assistant
+@version 1.0
+"""
+
+import json
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+import excel_ingest
+from benchmark_serialization import create_sample_sheet, legacy_serialize_sheet
+from excel_ingest import (build_sheet_header, estimate_tokens, iter_row_chunks, iter_sheet_rows,
+                          iter_streaming_workbook_chunks, load_workbook_chunks, serialize_sheet)
+
+
+def test_serialization_matches_iterrows():
+    """
+    测试向量化序列化与 iterrows 实现逐字节一致
+    """
+    print("\n=== 测试向量化序列化 ===")
+    frames = {
+        "混合类型": create_sample_sheet(500),
+        "全数值": pd.DataFrame({'a': [1, 2, None], 'b': [0.1, 1e16, np.nan]}),
+        "空白与nan文本": pd.DataFrame({' 列 ': [' x ', None, 'nan', ''], 'n': [1, 2, 3, 4]}),
+        "全空": pd.DataFrame({'a': [None, None], 'b': [np.nan, np.nan]}),
+        "float32": pd.DataFrame({'s': ['x', 'y', 'z'], 'f': np.array([0.1, 1e16, np.nan], dtype=np.float32)}),
+        "全数值float32": pd.DataFrame({'f': np.array([0.1, 2.5, np.nan], dtype=np.float32), 'i': [1, 2, 3]}),
+        "可空整数": pd.DataFrame({'s': ['x', 'y', None], 'i': pd.array([1, None, None], dtype='Int64'),
+                               'n': [1.5, None, 3]}),
+        "全数值可空整数": pd.DataFrame({'i': pd.array([1, None, 3], dtype='Int64')}),
+        "可空整数与文本": pd.DataFrame({'s': ['x', 'y'], 'i': pd.array([1, None], dtype='Int64'),
+                                  'o': pd.Series([None, 2], dtype=object)}),
+    }
+    for name, df in frames.items():
+        for skip_nan in (True, False):
+            assert serialize_sheet(df, skip_nan) == legacy_serialize_sheet(df, skip_nan), name
+        print(f"  ✅ {name}")
+    return True
+
+
+def test_row_chunks_keep_rows_whole():
+    """
+    测试按行切分：整行不拆分、每块重复表头、行范围连续
+    """
+    print("\n=== 测试按行切分 ===")
+    df = create_sample_sheet(200)
+    header = build_sheet_header("员工表", df.columns)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
+    chunks = list(iter_row_chunks(iter_sheet_rows(df), header, {"sheet_name": "员工表"}, 128, splitter))
+
+    row_texts = serialize_sheet(df).split("\n")
+    rebuilt = []
+    next_row = 0
+    for chunk in chunks:
+        lines = chunk.page_content.split("\n")
+        assert lines[0] == header
+        assert chunk.metadata["row_start"] == next_row
+        assert estimate_tokens(chunk.page_content) <= 128
+        rebuilt.extend(lines[1:])
+        next_row = chunk.metadata["row_end"] + 1
+
+    assert rebuilt == row_texts
+    print(f"  ✅ {len(row_texts)} 行切分为 {len(chunks)} 个文本块")
+    return True
+
+
+def test_snapshot_chunks_match_excel():
+    """
+    测试解析快照：文件未变化时不再解析Excel，任意切分参数下的文本块与直接解析一致，文件变化后快照失效
+    """
+    print("\n=== 测试解析快照 ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = Path(tmp) / "员工.xlsx"
+        table_dir = Path(tmp) / "tables"
+        with pd.ExcelWriter(file_path) as writer:
+            create_sample_sheet(300).to_excel(writer, sheet_name="员工表", index=False)
+            pd.DataFrame({" 编号 ": [1, 2, 3], "备注": ["x" * 900, None, " 空格 "]}).to_excel(
+                writer, sheet_name="备注", index=False)
+
+        def as_tuples(chunks):
+            return [(chunk.page_content, chunk.metadata) for chunk in chunks]
+
+        settings = [(128, 500, 50), (64, 200, 20)]
+        expected = [as_tuples(load_workbook_chunks(file_path, *setting)) for setting in settings]
+        assert as_tuples(load_workbook_chunks(file_path, *settings[0], table_dir)) == expected[0]
+        with mock.patch.object(excel_ingest, "read_workbook", side_effect=AssertionError("不应解析Excel")), \
+                mock.patch.object(excel_ingest, "iter_xlsx_row_batches", side_effect=AssertionError("不应解析Excel")):
+            for setting, chunks in zip(settings, expected):
+                assert as_tuples(load_workbook_chunks(file_path, *setting, table_dir)) == chunks
+                assert as_tuples(iter_streaming_workbook_chunks(file_path, *setting, 100, table_dir)) == chunks
+
+        # 快照不完整：流式读取删除快照并抛出异常（调用方回滚），整体读取删除快照后重新解析
+        def truncate_snapshot():
+            manifest_path = next(table_dir.glob("*/manifest.json"))
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+            manifest["sheets"][0]["text_rows"] += 1
+            manifest_path.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+            return manifest_path
+
+        manifest_path = truncate_snapshot()
+        try:
+            list(iter_streaming_workbook_chunks(file_path, *settings[0], 100, table_dir))
+            raise AssertionError("不完整的快照应抛出异常")
+        except ValueError:
+            pass
+        assert not manifest_path.exists()
+        assert as_tuples(load_workbook_chunks(file_path, *settings[0], table_dir)) == expected[0]
+        truncate_snapshot()
+        assert as_tuples(load_workbook_chunks(file_path, *settings[0], table_dir)) == expected[0]
+        assert as_tuples(load_workbook_chunks(file_path, *settings[0], table_dir)) == expected[0]
+
+        # 文件内容变化后快照失效，重新解析并写入新快照
+        create_sample_sheet(10).to_excel(file_path, sheet_name="员工表", index=False)
+        changed = as_tuples(load_workbook_chunks(file_path, *settings[0]))
+        assert as_tuples(load_workbook_chunks(file_path, *settings[0], table_dir)) == changed != expected[0]
+        print(f"  ✅ 快照切分 {len(expected[0])} 个文本块")
+    return True
+
+
+if __name__ == "__main__":
+    print("🧪 开始测试Excel摄取模块...")
+    results = [test_serialization_matches_iterrows(), test_row_chunks_keep_rows_whole(),
+               test_snapshot_chunks_match_excel()]
+    print("\n🎉 所有测试通过!" if all(results) else "\n❌ 部分测试失败")
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试向量库重建和增量更新的脚本
+
+@remarks 单个文件处理失败时只影响该文件：其他文件照常提交，失败的文件不记入清单，下次扫描时重试。
+         嵌入模型用按文本哈希生成的确定性向量代替，不需要下载模型
+@author AI Assistant
+@version 1.0
+"""
+
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from langchain_core.embeddings import Embeddings
+
+import excel_ingest
+import rag_api_server
+
+
+class HashEmbeddings(Embeddings):
+    """
+    按文本哈希生成确定性向量的嵌入模型
+    """
+
+    def __init__(self, **kwargs):
+        pass
+
+    @staticmethod
+    def _vector(text: str):
+        seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+        return np.random.default_rng(seed).standard_normal(16).astype(np.float32).tolist()
+
+    def embed_documents(self, texts):
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+
+@contextmanager
+def rag_system(knowledge_base: Path, vector_store: Path, stream: bool = True):
+    """
+    创建使用确定性嵌入、在当前进程中解析所有文件的RAG系统
+
+    @param knowledge_base - 知识库目录
+    @param vector_store - 向量库目录
+    @param stream - 是否流式读取所有文件
+    @returns RAG系统
+    """
+    with mock.patch.object(rag_api_server, "HuggingFaceEmbeddings", HashEmbeddings), \
+            mock.patch.object(rag_api_server, "INGEST_WORKERS", 1), \
+            mock.patch.object(rag_api_server, "EXCEL_STREAM_MIN_BYTES", 0 if stream else None), \
+            mock.patch.object(rag_api_server, "EXCEL_STREAM_BATCH_ROWS", 20):
+        yield rag_api_server.EnhancedRAGSystem(str(knowledge_base), str(vector_store), "hash", "test")
+
+
+@contextmanager
+def failing_batches(file_name: str, after_batches: int):
+    """
+    让某个文件的流式读取在产出若干批之后抛出异常
+
+    @param file_name - 出错的文件名
+    @param after_batches - 出错前正常产出的批数
+    """
+    original = excel_ingest.iter_xlsx_row_batches
+
+    def batches(file_path, batch_rows):
+        for position, batch in enumerate(original(file_path, batch_rows)):
+            if Path(file_path).name == file_name and position == after_batches:
+                raise OSError("模拟读取错误")
+            yield batch
+
+    with mock.patch.object(excel_ingest, "iter_xlsx_row_batches", batches):
+        yield
+
+
+@contextmanager
+def failing_reads(file_name: str):
+    """
+    让某个文件的整体读取（非流式）抛出异常，模拟文件仍被Excel占用或只写了一半
+
+    @param file_name - 出错的文件名
+    """
+    original = excel_ingest.read_workbook
+
+    def read(file_path):
+        if Path(file_path).name == file_name:
+            raise PermissionError("模拟文件被占用")
+        return original(file_path)
+
+    with mock.patch.object(excel_ingest, "read_workbook", read):
+        yield
+
+
+def write_workbook(path: Path, rows: int, department: str):
+    """
+    写入测试工作簿
+
+    @param path - 文件路径
+    @param rows - 行数
+    @param department - 部门名称
+    """
+    pd.DataFrame({
+        "姓名": [f"{department}员工{i}" for i in range(rows)],
+        "部门": [department] * rows,
+        "薪资": [10000 + i for i in range(rows)],
+    }).to_excel(path, index=False)
+
+
+def indexed_files(rag) -> set:
+    """
+    向量库中实际存在文本块的文件
+
+    @param rag - RAG系统
+    @returns 文件名集合
+    """
+    files = set()
+    for chunk_ids in rag.file_chunk_ids.values():
+        for chunk_id in chunk_ids:
+            files.add(rag.vector_store.get_document(chunk_id).metadata["source_file"])
+    return files
+
+
+def test_rebuild_skips_failed_file():
+    """
+    测试全量重建时一个文件读到一半出错，其他文件仍然提交，出错的文件下次扫描时重试
+    """
+    print("\n=== 测试重建时的单文件失败 ===")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        knowledge_base = Path(temp_dir) / "kb"
+        knowledge_base.mkdir()
+        write_workbook(knowledge_base / "good.xlsx", 30, "技术部")
+        write_workbook(knowledge_base / "bad.xlsx", 100, "市场部")
+
+        with rag_system(knowledge_base, Path(temp_dir) / "vs") as rag:
+            with failing_batches("bad.xlsx", after_batches=2):
+                assert rag.update_if_needed()
+            assert set(rag.file_chunk_ids) == {"good.xlsx"}
+            assert set(rag.file_manifest) == {"good.xlsx"}
+            assert indexed_files(rag) == {"good.xlsx"}
+            assert rag.vector_store.ntotal == len(rag.file_chunk_ids["good.xlsx"])
+            print("  ✅ 出错的文件已撤销，其他文件已提交")
+
+            # 下一次扫描时作为新增文件重试，不再全量重建
+            with mock.patch.object(rag, "_rebuild_vector_store", side_effect=AssertionError("不应全量重建")):
+                assert rag.update_if_needed()
+            assert set(rag.file_manifest) == {"good.xlsx", "bad.xlsx"}
+            assert indexed_files(rag) == {"good.xlsx", "bad.xlsx"}
+            print("  ✅ 下次扫描时增量重试成功")
+    return True
+
+
+def test_incremental_update_keeps_vectors_of_unreadable_file():
+    """
+    测试增量更新时非流式文件读取失败：保留原来的向量和清单，下次扫描时重试
+    """
+    print("\n=== 测试增量更新时的读取失败 ===")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        knowledge_base = Path(temp_dir) / "kb"
+        knowledge_base.mkdir()
+        write_workbook(knowledge_base / "a.xlsx", 10, "技术部")
+        write_workbook(knowledge_base / "b.xlsx", 10, "市场部")
+
+        with rag_system(knowledge_base, Path(temp_dir) / "vs", stream=False) as rag:
+            assert rag.update_if_needed()
+            old_manifest = dict(rag.file_manifest)
+            old_ids = list(rag.file_chunk_ids["a.xlsx"])
+
+            write_workbook(knowledge_base / "a.xlsx", 12, "财务部")
+            write_workbook(knowledge_base / "c.xlsx", 5, "人事部")
+            with failing_reads("a.xlsx"), failing_reads("c.xlsx"):
+                rag.update_if_needed()
+            assert rag.file_manifest["a.xlsx"] == old_manifest["a.xlsx"]
+            assert "c.xlsx" not in rag.file_manifest
+            assert rag.file_chunk_ids["a.xlsx"] == old_ids
+            assert all(rag.vector_store.get_document(chunk_id) is not None for chunk_id in old_ids)
+            print("  ✅ 读取失败的文件保留原来的向量，清单未变")
+
+            assert rag.check_files_changed()
+            assert rag.update_if_needed()
+            assert rag.file_manifest["a.xlsx"] != old_manifest["a.xlsx"]
+            assert indexed_files(rag) == {"a.xlsx", "b.xlsx", "c.xlsx"}
+            assert all("财务部" in rag.vector_store.get_document(chunk_id).page_content
+                       for chunk_id in rag.file_chunk_ids["a.xlsx"])
+            print("  ✅ 下次扫描时重试成功")
+    return True
+
+
+if __name__ == "__main__":
+    print("🧪 开始测试向量库更新...")
+    results = [test_rebuild_skips_failed_file(), test_incremental_update_keeps_vectors_of_unreadable_file()]
+    print("\n🎉 所有测试通过!" if all(results) else "\n❌ 部分测试失败")
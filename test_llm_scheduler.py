@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试LLM生成调度模块的脚本
+
+@remarks 用假的生成函数验证优先级排队、相同请求合并，以及客户端断开后立即重新发起相同请求的情况
+@author AI Assistant
+@version 1.0
+"""
+
+import asyncio
+
+from llm_scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, GenerationScheduler
+
+
+def test_priority_order():
+    """
+    测试名额释放时交互请求优先于先到的批量请求，同优先级按到达顺序
+    """
+    print("\n=== 测试优先级排队 ===")
+
+    async def scenario():
+        scheduler = GenerationScheduler(max_concurrent=1)
+        release = asyncio.Event()
+        started = []
+
+        def factory(name):
+            async def run():
+                started.append(name)
+                if name == "占用":
+                    await release.wait()
+                return name
+            return run
+
+        # 每个请求在独立的生成任务中排队，稍等片刻保证按顺序进入队列
+        tasks = [asyncio.create_task(scheduler.generate("占用", factory("占用")))]
+        await asyncio.sleep(0.001)
+        for name, priority in (("批量1", PRIORITY_BATCH), ("交互", PRIORITY_INTERACTIVE), ("批量2", PRIORITY_BATCH)):
+            tasks.append(asyncio.create_task(scheduler.generate(name, factory(name), priority)))
+            await asyncio.sleep(0.001)
+        assert scheduler.stats()["queue_depth"] == 3
+        release.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert asyncio.run(scenario()) == ["占用", "交互", "批量1", "批量2"]
+    print("  ✅ 交互 → 批量1 → 批量2")
+    return True
+
+
+def test_deduplication():
+    """
+    测试相同key的非流式和流式请求共享同一次生成，后加入的流式订阅者从头回放
+    """
+    print("\n=== 测试相同请求合并 ===")
+
+    async def scenario():
+        scheduler = GenerationScheduler(max_concurrent=2)
+        calls = []
+
+        async def generate():
+            calls.append("generate")
+            await asyncio.sleep(0.01)
+            return "答案"
+
+        results = await asyncio.gather(scheduler.generate("k", generate), scheduler.generate("k", generate))
+        assert results == ["答案", "答案"]
+
+        async def stream():
+            calls.append("stream")
+            for token in ("一", "二", "三"):
+                await asyncio.sleep(0.005)
+                yield token
+
+        async def collect(delay):
+            await asyncio.sleep(delay)
+            return [token async for token in scheduler.stream("k", stream)]
+
+        outputs = await asyncio.gather(collect(0), collect(0.008))
+        assert outputs == [["一", "二", "三"]] * 2
+        assert calls == ["generate", "stream"]
+        assert scheduler.stats()["deduplicated"] == 2
+
+    asyncio.run(scenario())
+    print("  ✅ 每种请求只生成一次")
+    return True
+
+
+def test_rejoin_after_disconnect():
+    """
+    测试所有订阅者断开后立即到达的相同请求重新生成，而不是加入正在取消的生成
+    """
+    print("\n=== 测试断开后重新请求 ===")
+
+    async def scenario():
+        scheduler = GenerationScheduler(max_concurrent=1)
+        calls = []
+
+        async def stream():
+            calls.append("stream")
+            for token in ("一", "二", "三"):
+                await asyncio.sleep(0.001)
+                yield token
+
+        tokens = scheduler.stream("s", stream)
+        assert await tokens.__anext__() == "一"
+        await tokens.aclose()
+        assert [token async for token in scheduler.stream("s", stream)] == ["一", "二", "三"]
+        assert calls == ["stream", "stream"]
+
+        async def generate():
+            calls.append("generate")
+            await asyncio.sleep(0.01)
+            return "答案"
+
+        first = asyncio.create_task(scheduler.generate("g", generate))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        assert await scheduler.generate("g", generate) == "答案"
+        assert first.cancelled()
+        # 名额已归还，调度器回到空闲状态
+        await asyncio.sleep(0.02)
+        assert scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+    print("  ✅ 断开后的相同请求重新生成")
+    return True
+
+
+def test_cancelled_stream_error_is_exception():
+    """
+    测试生成任务被取消时，仍在读取的订阅者收到普通异常（而不是 CancelledError）
+    """
+    print("\n=== 测试取消后的订阅者 ===")
+
+    async def scenario():
+        scheduler = GenerationScheduler(max_concurrent=1)
+
+        async def stream():
+            yield "一"
+            await asyncio.sleep(10)
+            yield "二"
+
+        tokens = scheduler.stream("s", stream)
+        assert await tokens.__anext__() == "一"
+        scheduler._inflight_streams["s"].task.cancel()
+        try:
+            await tokens.__anext__()
+        except Exception as e:
+            return e
+        return None
+
+    error = asyncio.run(scenario())
+    assert isinstance(error, RuntimeError), error
+    print("  ✅ 订阅者收到 RuntimeError")
+    return True
+
+
+if __name__ == "__main__":
+    print("🧪 开始测试LLM生成调度模块...")
+    results = [
+        test_priority_order(),
+        test_deduplication(),
+        test_rejoin_after_disconnect(),
+        test_cancelled_stream_error_is_exception()
+    ]
+    print("\n🎉 所有测试通过!" if all(results) else "\n❌ 部分测试失败")
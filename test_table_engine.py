@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试表格查询模块的脚本
+
+@remarks 用小的员工表和产品表验证问题解析（聚合意图、数值条件、分组、取值匹配、工作表选择）
+         和在整张表上的执行结果，以及流式写入时跨批次累计的取值词表
+@author AI Assistant
+@version 1.0
+"""
+
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+import pandas as pd
+
+import table_engine
+from excel_ingest import sheet_row_texts
+from table_engine import TableQueryEngine, TableStore, TableWriter, describe_result
+
+EMPLOYEES = pd.DataFrame({
+    "姓名": ["张三", "李四", "王五", "赵六", "钱七", "孙八"],
+    "部门": ["技术部", "市场部", "市场部", "财务部", "技术部", "技术部"],
+    "薪资(元)": [15000, 12000, 8000, 9000, 22000, 18000],
+    "年龄": [30, 28, 35, 41, 33, 26],
+})
+PRODUCTS = pd.DataFrame({
+    "产品": ["手机", "耳机", "冰箱", "洗衣机"],
+    "类别": ["电子", "电子", "家电", "家电"],
+    "销量": [120, 300, 40, 60],
+})
+
+
+def build_engine(table_root: Path) -> TableQueryEngine:
+    """
+    写入员工表和产品表两个工作簿，返回查询引擎
+
+    @param table_root - 表的根目录
+    @returns 查询引擎
+    """
+    for source_file, sheet_name, df in (("员工.xlsx", "员工信息", EMPLOYEES), ("产品.xlsx", "销售", PRODUCTS)):
+        writer = TableWriter(table_root, source_file)
+        writer.write_sheet(sheet_name, df, sheet_row_texts(df))
+        writer.commit()
+    return TableQueryEngine(TableStore(table_root))
+
+
+def test_filter_and_aggregate():
+    """
+    测试文本取值筛选+平均、分组排序、数值条件+计数、最大值所在行
+    """
+    print("\n=== 测试筛选与聚合 ===")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        engine = build_engine(Path(temp_dir))
+
+        result = engine.answer("市场部平均薪资是多少")
+        assert result["operation"] == "mean" and result["column"] == "薪资(元)"
+        assert result["filters"] == [{"column": "部门", "op": "in", "value": ["市场部"]}]
+        assert result["value"] == 10000 and result["rows_matched"] == 2
+        print(f"  ✅ 市场部平均薪资 = {result['value']}")
+
+        result = engine.answer("哪个部门平均薪资最高")
+        assert result["group_by"] == "部门" and result["operation"] == "mean"
+        assert [group["group"] for group in result["groups"]] == ["技术部", "市场部", "财务部"]
+        assert result["groups"][0]["value"] == round(55000 / 3, 4)
+        print(f"  ✅ 平均薪资最高的部门 = {result['groups'][0]['group']}")
+
+        result = engine.answer("薪资大于1万的有多少人")
+        assert result["operation"] == "count" and result["value"] == 4
+        assert result["filters"] == [{"column": "薪资(元)", "op": ">", "value": 10000}]
+        result = engine.answer("年龄30以上的技术部员工有几个")
+        assert result["value"] == 2
+        print("  ✅ 数值条件计数（含 万 单位和 以上）")
+
+        result = engine.answer("薪资最高的是谁")
+        assert result["operation"] == "argmax" and result["value"] == 22000
+        assert [row["姓名"] for row in result["rows"]] == ["钱七"]
+        assert "钱七" in describe_result(result)
+        print("  ✅ 薪资最高的员工 = 钱七")
+    return True
+
+
+def test_non_aggregate_questions():
+    """
+    测试不是统计/筛选类的问题返回None，交给文本检索
+    """
+    print("\n=== 测试非统计类问题 ===")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        engine = build_engine(Path(temp_dir))
+        for question in ("张三在哪个部门", "介绍一下这个表", "李四的年龄"):
+            assert engine.answer(question) is None, question
+    print("  ✅ 返回None")
+    return True
+
+
+def test_sheet_selection():
+    """
+    测试在多个工作簿中选择问题所指的工作表，并可以限定工作簿范围
+    """
+    print("\n=== 测试工作表选择 ===")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        engine = build_engine(Path(temp_dir))
+
+        result = engine.answer("电子类产品销量总和")
+        assert result["source_file"] == "产品.xlsx" and result["value"] == 420
+        # 选择工作表只使用清单中的词表，执行时才读取选中的表
+        assert engine.store.stats()["cached_tables"] == 1
+        result = engine.answer("技术部有多少人")
+        assert result["source_file"] == "员工.xlsx" and result["value"] == 3
+        # 限定到不相关的工作簿时不会给出错误的答案
+        assert engine.answer("技术部平均薪资", source_files=["产品.xlsx"]) is None
+    print("  ✅ 按列名和取值选择工作表")
+    return True
+
+
+def test_streamed_vocabulary():
+    """
+    测试流式写入时取值词表跨批次累计，不同取值超过上限的列不进入词表
+    """
+    print("\n=== 测试流式写入的取值词表 ===")
+    with tempfile.TemporaryDirectory() as temp_dir, mock.patch.object(table_engine, "VALUE_INDEX_MAX_DISTINCT", 4):
+        table_root = Path(temp_dir)
+        writer = TableWriter(table_root, "大表.xlsx")
+        for offset in range(0, len(EMPLOYEES), 2):
+            batch = EMPLOYEES.iloc[offset:offset + 2].reset_index(drop=True)
+            row_texts = sheet_row_texts(batch)
+            row_texts.index = row_texts.index + offset
+            writer.append_rows("员工信息", batch, row_texts)
+        writer.commit()
+
+        store = TableStore(table_root)
+        sheet = store.sheets()[0]
+        assert sheet["rows"] == len(EMPLOYEES)
+        # 姓名有6个不同取值，超过上限；部门只有3个，包含只出现在后面批次中的取值
+        assert sheet["values"] == {"部门": ["市场部", "技术部", "财务部"]}
+
+        engine = TableQueryEngine(store)
+        result = engine.answer("财务部平均薪资")
+        assert result["value"] == 9000 and result["total_rows"] == len(EMPLOYEES)
+        assert engine.answer("张三的平均薪资")["filters"] == []
+    print("  ✅ 词表覆盖所有批次，超过上限的列被跳过")
+    return True
+
+
+if __name__ == "__main__":
+    print("🧪 开始测试表格查询模块...")
+    results = [
+        test_filter_and_aggregate(),
+        test_non_aggregate_questions(),
+        test_sheet_selection(),
+        test_streamed_vocabulary()
+    ]
+    print("\n🎉 所有测试通过!" if all(results) else "\n❌ 部分测试失败")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试向量索引模块的脚本
+
+@remarks 验证配置允许的每种索引类型与向量存储方式组合下，按元数据过滤的检索都能正常返回，
+         并且结果只包含匹配的文本块
+@author AI Assistant
+@version 1.0
+"""
+
+import numpy as np
+from langchain_core.documents import Document
+
+from vector_index import FILTER_BRUTE_FORCE_MAX, INDEX_TYPES, QUANTIZATION_TYPES, ChunkVectorStore
+
+DIM = 16
+MATCHING_CHUNKS = FILTER_BRUTE_FORCE_MAX + 1904  # 超过精确计算的上限，走索引检索
+OTHER_CHUNKS = 4000
+
+
+def _build_store(index_type: str, quantization: str, vectors: np.ndarray) -> ChunkVectorStore:
+    """
+    建立包含两个文件的向量库
+
+    @param index_type - 索引类型
+    @param quantization - 向量存储方式
+    @param vectors - 全部向量，前 MATCHING_CHUNKS 个属于 a.xlsx
+    @returns 向量库
+    """
+    # expected_vectors 取较小值，IVF只需要少量训练样本，保证训练后仍是IVF索引
+    store = ChunkVectorStore(DIM, index_spec=index_type, expected_vectors=16, quantization=quantization)
+    store.configure_search(nprobe=4, ef_search=32, rerank_factor=4)
+    chunks = [Document(page_content=f"行 {i}", metadata={"source_file": "a.xlsx" if i < MATCHING_CHUNKS else "b.xlsx",
+                                                         "row_start": i, "row_end": i})
+              for i in range(len(vectors))]
+    store.add(chunks, vectors)
+    store.finalize()
+    return store
+
+
+def test_filtered_search_all_index_types():
+    """
+    测试每种索引类型 × 向量存储方式的过滤检索（包括不支持 IDSelector 的 IDMap2,PQ）
+    """
+    print("\n=== 测试过滤检索 ===")
+    rng = np.random.default_rng(0)
+    vectors = rng.random((MATCHING_CHUNKS + OTHER_CHUNKS, DIM), dtype=np.float32)
+    query = rng.random(DIM, dtype=np.float32)
+    distances = ((vectors[:MATCHING_CHUNKS] - query) ** 2).sum(axis=1)
+    expected = np.argsort(distances, kind="stable")[:5].tolist()
+
+    for index_type in INDEX_TYPES:
+        for quantization in QUANTIZATION_TYPES:
+            store = _build_store(index_type, quantization, vectors)
+            store.delete([int(expected[-1])])
+            documents = store.similarity_search_by_vector(query, k=5, metadata_filter={"source_file": ["a.xlsx"]})
+            chunk_ids = [doc.metadata["chunk_id"] for doc in documents]
+            assert len(documents) == 5, (index_type, quantization, store.index_spec)
+            assert all(doc.metadata["source_file"] == "a.xlsx" for doc in documents), store.index_spec
+            assert int(expected[-1]) not in chunk_ids, store.index_spec
+            if store.index_spec.startswith("IDMap2,PQ") or store.index_spec == "IDMap2,Flat":
+                # 精确检索：结果与暴力计算一致
+                assert chunk_ids == expected[:4] + chunk_ids[4:], store.index_spec
+            print(f"  ✅ {index_type} × {quantization}（{store.index_spec}）")
+    return True
+
+
+if __name__ == "__main__":
+    print("🧪 开始测试向量索引模块...")
+    results = [test_filtered_search_all_index_types()]
+    print("\n🎉 所有测试通过!" if all(results) else "\n❌ 部分测试失败")
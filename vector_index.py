@@ -0,0 +1,1070 @@
+# -*- coding: utf-8 -*-
+"""
+向量索引模块 - FAISS向量索引 + 内存映射的列式文本块存储
+
+@remarks langchain 的 FAISS.save_local 把整个docstore pickle到 index.pkl，
+         加载时全部文本和元数据都以Python字典常驻内存，并且需要
+         allow_dangerous_deserialization。这里改为：
+         1. FAISS IndexIDMap2 以int64文本块ID存储向量；
+         2. 文本块保存在不可变的段（segment）中：ID列、元数据列（按工作表字典编码的
+            分组号 + 行范围）、偏移量数组和UTF-8文本blob，全部以内存映射方式打开；
+         3. 检索结果按ID惰性地从段中解码为Document；
+         4. 清单（manifest.json）只包含JSON，不使用pickle；
+         5. 索引可以用 fp16/int8/PQ 压缩向量，此时原始float32向量写入段中（内存映射，不常驻内存），
+            检索时对候选结果用原始向量精确重排。
+         文本块ID单调递增，每个段内有序，按ID定位只需二分查找，不需要常驻的ID字典
+@author AI Assistant
+@version 1.0
+"""
+
+import json
+import math
+import os
+import shutil
+import uuid
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+STORE_FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+
+# 按行保存的元数据字段，其余字段（文件名、工作表名等）按分组字典编码
+ROW_KEYS = ("row_start", "row_end")
+MISSING_ROW = -1
+
+# 已删除的行超过该比例时，保存时把所有段合并压缩为一个段
+COMPACT_DEAD_RATIO = 0.3
+# 段数量达到该值时，保存时合并压缩
+MAX_SEGMENTS = 32
+# 按元数据过滤后的候选不超过该数量时，直接对这些向量精确计算距离
+FILTER_BRUTE_FORCE_MAX = 4096
+# 索引不支持 IDSelector 时（如 IndexPQ）分批精确计算距离，每批的向量数量
+FILTER_EXACT_BATCH = 65536
+# 缓存的过滤条件数量（匹配的ID和FAISS选择器），增删文本块时清空
+FILTER_CACHE_MAX = 64
+
+# 索引类型：flat 精确检索；ivf_flat/ivf_pq 倒排聚类（需要训练）；hnsw 图索引；auto 按语料规模选择
+INDEX_TYPES = ("auto", "flat", "ivf_flat", "hnsw", "ivf_pq")
+# 索引中向量的存储方式：none 原始float32；fp16 半精度；sq8 每维int8标量量化；pq 乘积量化
+QUANTIZATION_TYPES = ("none", "fp16", "sq8", "pq")
+FLAT_INDEX_SPEC = "IDMap2,Flat"
+AUTO_FLAT_MAX = 50_000  # auto：不超过该数量时使用精确检索
+AUTO_IVF_FLAT_MAX = 2_000_000  # auto：不超过该数量时使用 IVF-Flat，更大时使用 IVF-PQ
+HNSW_M = 32  # HNSW 每个节点的邻居数
+IVF_TRAIN_POINTS_PER_LIST = 39  # 每个聚类中心至少需要的训练样本数（faiss的建议值）
+IVF_MAX_TRAIN_POINTS_PER_LIST = 256  # 每个聚类中心最多使用的训练样本数
+
+
+def suggest_nlist(expected_vectors: int) -> int:
+    """
+    按语料规模建议IVF聚类中心数量（约 4*sqrt(N)，取2的幂）
+
+    @param expected_vectors - 预计的向量数量
+    @returns 聚类中心数量
+    """
+    target = 4 * np.sqrt(max(expected_vectors, 1))
+    return int(min(max(2 ** round(np.log2(target)), 16), 65536))
+
+
+def _storage_spec(quantization: str, dim: int) -> str:
+    """
+    把向量存储方式转换为 index_factory 中的编码部分
+
+    @param quantization - 存储方式，见 QUANTIZATION_TYPES
+    @param dim - 向量维度
+    @returns 编码描述串
+    """
+    if quantization == "fp16":
+        return "SQfp16"
+    if quantization == "sq8":
+        return "SQ8"
+    if quantization == "pq":
+        # PQ子空间数：不超过 dim/8 的最大约数，每个子空间8位编码
+        m = max(dim // 8, 1)
+        while dim % m:
+            m -= 1
+        return f"PQ{m}"
+    return "Flat"
+
+
+def choose_index_spec(index_type: str, expected_vectors: int, dim: int, quantization: str = "none") -> str:
+    """
+    把索引类型和向量存储方式转换为 faiss.index_factory 描述串
+
+    @param index_type - 索引类型，见 INDEX_TYPES
+    @param expected_vectors - 预计的向量数量，用于 auto 选择类型和确定聚类中心数量
+    @param dim - 向量维度
+    @param quantization - 向量存储方式，见 QUANTIZATION_TYPES（ivf_pq 始终使用PQ）
+    @returns index_factory 描述串
+    @example
+    ```python
+    choose_index_spec("ivf_flat", 1_000_000, 384)  # "IVF4096,Flat"
+    choose_index_spec("hnsw", 1_000_000, 384, "sq8")  # "IDMap2,HNSW32,SQ8"
+    ```
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支持的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+    if quantization not in QUANTIZATION_TYPES:
+        raise ValueError(f"不支持的向量存储方式: {quantization}，可选: {', '.join(QUANTIZATION_TYPES)}")
+    if index_type == "auto":
+        if expected_vectors <= AUTO_FLAT_MAX:
+            index_type = "flat"
+        else:
+            index_type = "ivf_flat" if expected_vectors <= AUTO_IVF_FLAT_MAX else "ivf_pq"
+    if index_type == "ivf_pq":
+        index_type, quantization = "ivf_flat", "pq"
+
+    storage = _storage_spec(quantization, dim)
+    if index_type == "flat":
+        return f"IDMap2,{storage}"
+    if index_type == "hnsw":
+        return f"IDMap2,HNSW{HNSW_M},{storage}"
+    return f"IVF{suggest_nlist(expected_vectors)},{storage}"
+
+
+def is_lossy_spec(index_spec: str) -> bool:
+    """
+    索引是否以有损方式（量化）存储向量
+
+    @param index_spec - index_factory 描述串
+    @returns 使用SQ/PQ编码时返回True
+    """
+    return "SQ" in index_spec or "PQ" in index_spec
+
+
+class _Segment:
+    """
+    一个不可变的文本块段，所有列以内存映射方式打开
+    """
+
+    def __init__(self, directory: Path, name: str):
+        """
+        打开段目录
+
+        @param directory - 存储目录
+        @param name - 段目录名
+        """
+        path = directory / name
+        self.name = name
+        self.ids = np.load(path / "ids.npy", mmap_mode="r")
+        self.groups = np.load(path / "groups.npy", mmap_mode="r")
+        self.row_start = np.load(path / "row_start.npy", mmap_mode="r")
+        self.row_end = np.load(path / "row_end.npy", mmap_mode="r")
+        self.offsets = np.load(path / "offsets.npy", mmap_mode="r")
+        if (path / "text.bin").stat().st_size > 0:
+            self.text = np.memmap(path / "text.bin", dtype=np.uint8, mode="r")
+        else:
+            self.text = np.zeros(0, dtype=np.uint8)
+        # 原始向量（仅量化索引的向量库保存），按行与ID对齐
+        self.vectors = None
+        if (path / "vectors.bin").exists():
+            self.vectors = np.memmap(path / "vectors.bin", dtype=np.float32, mode="r").reshape(len(self.ids), -1)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def find(self, chunk_id: int) -> int:
+        """
+        二分查找文本块ID所在的行
+
+        @param chunk_id - 文本块ID
+        @returns 行号，不存在时返回-1
+        """
+        position = int(np.searchsorted(self.ids, chunk_id))
+        if position < len(self.ids) and self.ids[position] == chunk_id:
+            return position
+        return -1
+
+    def text_bytes(self, position: int) -> bytes:
+        """
+        读取某一行的UTF-8文本
+
+        @param position - 行号
+        @returns 文本字节
+        """
+        return self.text[int(self.offsets[position]):int(self.offsets[position + 1])].tobytes()
+
+    @staticmethod
+    def write(directory: Path, name: str, rows: Iterable[tuple]) -> int:
+        """
+        流式写入一个新的段，文本直接写入文件，不在内存中汇总
+
+        @param directory - 存储目录
+        @param name - 段目录名
+        @param rows - 按ID升序的 (ID, 分组号, 起始行, 结束行, 文本字节, 原始向量或None) 可迭代对象
+        @returns 写入的行数
+        """
+        path = directory / name
+        path.mkdir(parents=True)
+        # 使用紧凑的 array 累积列，合并大量行时不产生逐行的Python对象
+        ids, groups, row_start, row_end = array("q"), array("i"), array("q"), array("q")
+        offsets = array("Q", [0])
+        vector_file = None
+        with open(path / "text.bin", "wb") as f:
+            for chunk_id, group, start, end, text, vector in rows:
+                f.write(text)
+                if vector is not None:
+                    if vector_file is None:
+                        vector_file = open(path / "vectors.bin", "wb")
+                    vector_file.write(np.asarray(vector, dtype=np.float32).tobytes())
+                ids.append(chunk_id)
+                groups.append(group)
+                row_start.append(start)
+                row_end.append(end)
+                offsets.append(offsets[-1] + len(text))
+        if vector_file is not None:
+            vector_file.close()
+        np.save(path / "offsets.npy", np.frombuffer(offsets, dtype=np.uint64))
+        np.save(path / "ids.npy", np.frombuffer(ids, dtype=np.int64))
+        np.save(path / "groups.npy", np.frombuffer(groups, dtype=np.int32))
+        np.save(path / "row_start.npy", np.frombuffer(row_start, dtype=np.int64))
+        np.save(path / "row_end.npy", np.frombuffer(row_end, dtype=np.int64))
+        return len(ids)
+
+
+class ChunkVectorStore:
+    """
+    FAISS向量索引 + 内存映射文本块存储
+
+    @remarks 新增的文本块先保存在内存尾部（tail），save() 时写成新的段；
+             量化索引（SQ/PQ）的原始向量随文本一起写入段，检索时取 k*rerank_factor 个候选再精确重排；
+             删除只从FAISS中移除向量并记录墓碑，已删除的行在压缩时才真正从段中移除。
+             需要训练的索引（IVF、auto）先缓存向量，攒够训练样本后训练并写入；
+             样本始终不足时（小语料）退化为精确检索。HNSW 不支持删除，删除的向量
+             留在图中作为墓碑，检索时通过 IDSelector 排除，墓碑过多时保存时重建图。
+             调用方负责加锁（EnhancedRAGSystem 在 _index_lock 下访问）
+    @example
+    ```python
+    store = ChunkVectorStore(dim=384, index_spec="auto")
+    ids = store.add(chunks, vectors)       # 同时写入 chunk.metadata["chunk_id"]
+    docs = store.similarity_search_by_vector(query_vector, k=3)
+    docs = store.similarity_search_by_vector(query_vector, k=3, metadata_filter={"source_file": ["a.xlsx"]})
+    store.delete(ids[:10])
+    store.save(Path("./vector_store/chunk_store"))
+    store = ChunkVectorStore.load(Path("./vector_store/chunk_store"))
+    ```
+    """
+
+    def __init__(self, dim: int, index: Optional[faiss.Index] = None, segments: Optional[List[_Segment]] = None,
+                 groups: Optional[List[Dict[str, Any]]] = None, deleted: Optional[Iterable[int]] = None,
+                 next_id: int = 0, index_spec: str = FLAT_INDEX_SPEC, expected_vectors: int = 0,
+                 index_tombstones: Optional[Iterable[int]] = None, quantization: str = "none"):
+        """
+        创建向量库（通常使用 ChunkVectorStore(dim, index_spec) 新建，或 load() 加载）
+
+        @param dim - 向量维度
+        @param index - 已有的FAISS索引（加载时传入）
+        @param segments - 已持久化的段
+        @param groups - 元数据分组表
+        @param deleted - 段中已删除的文本块ID
+        @param next_id - 下一个可用的文本块ID
+        @param index_spec - index_factory 描述串，或 INDEX_TYPES 中的索引类型
+        @param expected_vectors - 预计的向量数量；为0时 auto/IVF 先缓存向量，攒够样本后再按规模确定索引
+        @param index_tombstones - 已删除但仍留在索引中的ID（HNSW）
+        @param quantization - index_spec 为索引类型时向量的存储方式，见 QUANTIZATION_TYPES
+        """
+        if index_spec in INDEX_TYPES and (expected_vectors > 0 or index_spec in ("flat", "hnsw")):
+            index_spec = choose_index_spec(index_spec, expected_vectors, dim, quantization)
+        self.dim = dim
+        self.quantization = quantization
+        self.index_spec = index_spec
+        self.expected_vectors = expected_vectors
+        self.index = index
+        if self.index is None and index_spec not in INDEX_TYPES:
+            self.index = faiss.index_factory(dim, index_spec)
+        self._search_params = {"nprobe": None, "ef_search": None, "rerank_factor": 0}
+        self._index_tombstones = set(index_tombstones or [])
+        self._tombstone_selector = None  # (IDSelectorNot, IDSelectorBatch)，墓碑变化时清空
+        self._pending_ids = []
+        self._pending_vectors = []
+        self._pending_count = 0
+        self._filter_cache = OrderedDict()  # 过滤条件 -> (匹配的ID, IDSelectorBatch)
+        self._segments = segments or []
+        self._segment_starts = [int(segment.ids[0]) for segment in self._segments]
+        self._groups = groups or []
+        self._group_codes = {self._group_key(group): code for code, group in enumerate(self._groups)}
+        self._deleted = set(deleted or [])
+        self._next_id = next_id
+        self._reset_tail()
+
+    def _reset_tail(self):
+        """
+        清空内存尾部
+
+        @returns 无返回值
+        """
+        self._tail_ids = []
+        self._tail_groups = []
+        self._tail_row_start = []
+        self._tail_row_end = []
+        self._tail_texts = []
+        self._tail_vectors = []
+        self._tail_positions = {}
+
+    @staticmethod
+    def _group_key(group: Dict[str, Any]) -> str:
+        """
+        计算元数据分组的键
+
+        @param group - 分组元数据
+        @returns JSON字符串
+        """
+        return json.dumps(group, ensure_ascii=False, sort_keys=True, default=str)
+
+    def _group_code(self, metadata: Dict[str, Any]) -> int:
+        """
+        获取元数据（去掉按行字段后）对应的分组号，不存在时新建
+
+        @param metadata - 文本块元数据
+        @returns 分组号
+        """
+        group = {key: value for key, value in metadata.items() if key not in ROW_KEYS and key != "chunk_id"}
+        key = self._group_key(group)
+        code = self._group_codes.get(key)
+        if code is None:
+            code = len(self._groups)
+            self._groups.append(group)
+            self._group_codes[key] = code
+        return code
+
+    @property
+    def ntotal(self) -> int:
+        """当前可检索的向量数量（包括等待训练的向量）"""
+        indexed = self.index.ntotal if self.index is not None else 0
+        return indexed - len(self._index_tombstones) + self._pending_count
+
+    def _needs_training(self) -> bool:
+        """
+        索引是否还未确定或未训练
+
+        @returns 需要先缓存向量时返回True
+        """
+        return self.index is None or not self.index.is_trained
+
+    def _train_size(self) -> int:
+        """
+        开始训练所需的样本数量
+
+        @returns 样本数量
+        """
+        if self.index is None:
+            # 规模未知：超过精确检索的规模上限后才确定索引类型
+            return AUTO_FLAT_MAX + 1
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            return ivf.nlist * IVF_TRAIN_POINTS_PER_LIST
+        # 不带IVF的PQ每个子空间有256个码字；标量量化也使用同样数量的样本估计取值范围
+        return 256 * IVF_TRAIN_POINTS_PER_LIST
+
+    def _train_and_flush(self):
+        """
+        用缓存的向量训练索引并写入；样本不足时退化为不需要训练的索引
+
+        @returns 无返回值
+        """
+        vectors = np.concatenate(self._pending_vectors)
+        ids = np.concatenate(self._pending_ids)
+        if self.index is None:
+            spec = choose_index_spec(self.index_spec, max(self.expected_vectors, len(vectors)), self.dim,
+                                     self.quantization)
+            self.index_spec = spec
+            self.index = faiss.index_factory(self.dim, spec)
+
+        if not self.index.is_trained and len(vectors) < self._train_size():
+            # 样本不足：先退化为不带IVF的同类编码，仍不足时使用精确检索
+            original_spec = self.index_spec
+            self.index_spec = choose_index_spec("flat", len(vectors), self.dim, self.quantization)
+            self.index = faiss.index_factory(self.dim, self.index_spec)
+            if not self.index.is_trained and len(vectors) < self._train_size():
+                self.index_spec = FLAT_INDEX_SPEC
+                self.index = faiss.index_factory(self.dim, FLAT_INDEX_SPEC)
+            print(f"训练样本不足（{len(vectors)} 个向量），索引 {original_spec} 退化为 {self.index_spec}。")
+
+        if not self.index.is_trained:
+            ivf = faiss.try_extract_index_ivf(self.index)
+            max_points = (ivf.nlist if ivf is not None else 256) * IVF_MAX_TRAIN_POINTS_PER_LIST
+            sample = vectors
+            if len(vectors) > max_points:
+                rng = np.random.default_rng(0)
+                sample = vectors[rng.choice(len(vectors), max_points, replace=False)]
+            print(f"正在用 {len(sample)} 个样本训练索引 {self.index_spec}...")
+            self.index.train(sample)
+
+        self.index.add_with_ids(vectors, ids)
+        self._pending_ids, self._pending_vectors, self._pending_count = [], [], 0
+        if not self._keeps_vectors():
+            self._tail_vectors = []
+        self.configure_search(**self._search_params)
+
+    def _keeps_vectors(self) -> bool:
+        """
+        是否需要在段中保存原始向量（索引类型未确定时先保留）
+
+        @returns 索引未确定或使用量化编码时返回True
+        """
+        return self.index is None or is_lossy_spec(self.index_spec)
+
+    def finalize(self):
+        """
+        确保所有缓存的向量都已写入索引（检索和保存前自动调用）
+
+        @returns 无返回值
+        """
+        if self._pending_count:
+            self._train_and_flush()
+
+    def configure_search(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                         rerank_factor: int = 0):
+        """
+        设置检索参数：IVF 的 nprobe、HNSW 的 efSearch、量化索引的精确重排倍数（对其他索引类型无影响）
+
+        @param nprobe - IVF检索时访问的聚类数量，越大召回越高、越慢
+        @param ef_search - HNSW检索时的候选队列长度，越大召回越高、越慢
+        @param rerank_factor - 量化索引取 k*rerank_factor 个候选并用原始向量重排，0表示不重排
+        @returns 无返回值
+        """
+        self._search_params = {"nprobe": nprobe, "ef_search": ef_search, "rerank_factor": rerank_factor}
+        if self.index is None:
+            return
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None and nprobe:
+            ivf.nprobe = nprobe
+        hnsw_index = self._hnsw_index()
+        if hnsw_index is not None and ef_search:
+            hnsw_index.hnsw.efSearch = ef_search
+
+    def _hnsw_index(self):
+        """
+        取出HNSW索引（IDMap2 包装内部）
+
+        @returns faiss.IndexHNSW，不是HNSW索引时返回None
+        """
+        if self.index is None:
+            return None
+        inner = faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap) else self.index
+        return inner if isinstance(inner, faiss.IndexHNSW) else None
+
+    def add(self, text_chunks: List[Document], vectors: Sequence[Sequence[float]]) -> List[int]:
+        """
+        写入已嵌入的文本块，并把分配的ID写入 chunk.metadata["chunk_id"]
+
+        @param text_chunks - 文本块
+        @param vectors - 与文本块一一对应的向量
+        @returns 分配的文本块ID
+        """
+        if not text_chunks:
+            return []
+        ids = np.arange(self._next_id, self._next_id + len(text_chunks), dtype=np.int64)
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if self._needs_training():
+            self._pending_ids.append(ids)
+            self._pending_vectors.append(matrix)
+            self._pending_count += len(ids)
+            if self._pending_count >= self._train_size():
+                self._train_and_flush()
+        else:
+            self.index.add_with_ids(matrix, ids)
+        self._next_id += len(text_chunks)
+
+        if self._keeps_vectors():
+            self._tail_vectors.extend(matrix)
+        self._filter_cache.clear()
+        for chunk_id, chunk in zip(ids.tolist(), text_chunks):
+            chunk.metadata["chunk_id"] = chunk_id
+            self._tail_positions[chunk_id] = len(self._tail_ids)
+            self._tail_ids.append(chunk_id)
+            self._tail_groups.append(self._group_code(chunk.metadata))
+            self._tail_row_start.append(chunk.metadata.get("row_start", MISSING_ROW))
+            self._tail_row_end.append(chunk.metadata.get("row_end", MISSING_ROW))
+            self._tail_texts.append(chunk.page_content.encode("utf-8"))
+        return ids.tolist()
+
+    def delete(self, chunk_ids: Iterable[int]) -> int:
+        """
+        删除文本块
+
+        @param chunk_ids - 文本块ID
+        @returns 实际删除的向量数量
+        """
+        chunk_ids = np.asarray(list(chunk_ids), dtype=np.int64)
+        if len(chunk_ids) == 0:
+            return 0
+        self.finalize()
+        if self._hnsw_index() is not None:
+            # HNSW 图不支持删除节点：记为墓碑，检索时过滤
+            removed = len(set(chunk_ids.tolist()) - self._index_tombstones)
+            self._index_tombstones.update(chunk_ids.tolist())
+            self._tombstone_selector = None
+        else:
+            removed = self.index.remove_ids(chunk_ids)
+        self._deleted.update(chunk_ids.tolist())
+        self._filter_cache.clear()
+        return int(removed)
+
+    def get_document(self, chunk_id: int) -> Optional[Document]:
+        """
+        按ID解码文本块
+
+        @param chunk_id - 文本块ID
+        @returns Document，不存在或已删除时返回None
+        """
+        if chunk_id in self._deleted:
+            return None
+        position = self._tail_positions.get(chunk_id)
+        if position is not None:
+            text = self._tail_texts[position]
+            group, row_start, row_end = (self._tail_groups[position], self._tail_row_start[position],
+                                         self._tail_row_end[position])
+        else:
+            segment_index = int(np.searchsorted(self._segment_starts, chunk_id, side="right")) - 1
+            if segment_index < 0:
+                return None
+            segment = self._segments[segment_index]
+            position = segment.find(chunk_id)
+            if position < 0:
+                return None
+            text = segment.text_bytes(position)
+            group, row_start, row_end = (segment.groups[position], segment.row_start[position],
+                                         segment.row_end[position])
+
+        metadata = dict(self._groups[int(group)])
+        if row_start != MISSING_ROW:
+            metadata["row_start"] = int(row_start)
+        if row_end != MISSING_ROW:
+            metadata["row_end"] = int(row_end)
+        metadata["chunk_id"] = int(chunk_id)
+        return Document(page_content=text.decode("utf-8"), metadata=metadata)
+
+    def similarity_search_by_vector(self, embedding: Sequence[float], k: int = 4,
+                                    metadata_filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """
+        检索与向量最相似的文本块
+
+        @remarks 指定 metadata_filter 时只在匹配的文本块中检索：匹配的文本块较少时直接精确计算距离，
+                 否则通过 IDSelector 让FAISS只对匹配的ID计算距离，结果不会因为其他文件占满前k名而变少
+        @param embedding - 查询向量
+        @param k - 返回的文档数量
+        @param metadata_filter - 元数据过滤条件 {字段: 允许的值或值列表}，如 {"source_file": ["a.xlsx"]}
+        @returns 按相似度排序的Document列表
+        """
+        self.finalize()
+        if self.ntotal <= 0 or k <= 0:
+            return []
+        query = np.asarray([embedding], dtype=np.float32)
+        rerank_factor = self._search_params["rerank_factor"] if is_lossy_spec(self.index_spec) else 0
+        if metadata_filter:
+            candidates, exact = self._filtered_search(query, k, metadata_filter, rerank_factor)
+        else:
+            fetch_k = min(k * max(rerank_factor, 1), self.index.ntotal)
+            _, ids = self.index.search(query, fetch_k, params=self._tombstone_params(fetch_k))
+            candidates = [chunk_id for chunk_id in ids[0].tolist()
+                          if chunk_id >= 0 and chunk_id not in self._index_tombstones]
+            exact = False
+        if rerank_factor > 1 and not exact:
+            candidates = self._rerank(query[0], candidates)
+        documents = []
+        for chunk_id in candidates:
+            document = self.get_document(chunk_id)
+            if document is not None:
+                documents.append(document)
+                if len(documents) >= k:
+                    break
+        return documents
+
+    def _tombstone_params(self, fetch_k: int):
+        """
+        生成排除墓碑的检索参数（墓碑仍在HNSW图中，由选择器在检索时跳过，不需要多取候选）
+
+        @param fetch_k - 本次检索的候选数量
+        @returns faiss.SearchParametersHNSW，没有墓碑时返回None
+        """
+        hnsw_index = self._hnsw_index()
+        if not self._index_tombstones or hnsw_index is None:
+            return None
+        if self._tombstone_selector is None:
+            tombstones = np.fromiter(self._index_tombstones, dtype=np.int64, count=len(self._index_tombstones))
+            batch = faiss.IDSelectorBatch(tombstones)
+            # IDSelectorNot 不持有内部选择器，一起缓存以保证其存活
+            self._tombstone_selector = (faiss.IDSelectorNot(batch), batch)
+        return faiss.SearchParametersHNSW(sel=self._tombstone_selector[0],
+                                          efSearch=max(hnsw_index.hnsw.efSearch, fetch_k))
+
+    def _matching_ids(self, metadata_filter: Dict[str, Any]) -> np.ndarray:
+        """
+        找出元数据满足过滤条件且未删除的文本块ID
+
+        @remarks 过滤字段属于分组元数据，先在（很小的）分组表中找出匹配的分组号，
+                 再在内存映射的分组列上做向量化匹配，不需要解码任何文本块
+        @param metadata_filter - {字段: 允许的值或值列表}
+        @returns 升序的文本块ID数组
+        """
+        allowed = {
+            key: set(values) if isinstance(values, (list, tuple, set)) else {values}
+            for key, values in metadata_filter.items()
+        }
+        codes = np.asarray([
+            code for code, group in enumerate(self._groups)
+            if all(group.get(key) in values for key, values in allowed.items())
+        ], dtype=np.int32)
+        if len(codes) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        parts = [np.asarray(segment.ids[np.isin(segment.groups, codes)]) for segment in self._segments]
+        if self._tail_ids:
+            tail_ids = np.asarray(self._tail_ids, dtype=np.int64)
+            parts.append(tail_ids[np.isin(np.asarray(self._tail_groups, dtype=np.int32), codes)])
+        ids = np.concatenate(parts).astype(np.int64) if parts else np.zeros(0, dtype=np.int64)
+        excluded = self._deleted | self._index_tombstones
+        if excluded and len(ids):
+            ids = ids[~np.isin(ids, np.fromiter(excluded, dtype=np.int64, count=len(excluded)))]
+        return ids
+
+    def _vectors_for(self, chunk_ids: np.ndarray) -> Optional[np.ndarray]:
+        """
+        取出一批文本块的向量用于精确计算距离
+
+        @param chunk_ids - 文本块ID
+        @returns 形状为 (N, dim) 的矩阵；量化索引返回原始向量，无法取出时返回None
+        """
+        if is_lossy_spec(self.index_spec):
+            vectors = np.empty((len(chunk_ids), self.dim), dtype=np.float32)
+            found = np.zeros(len(chunk_ids), dtype=bool)
+            for segment in self._segments:
+                if segment.vectors is None or len(segment) == 0:
+                    continue
+                positions = np.minimum(np.searchsorted(segment.ids, chunk_ids), len(segment) - 1)
+                hit = np.asarray(segment.ids[positions] == chunk_ids) & ~found
+                vectors[hit] = segment.vectors[positions[hit]]
+                found |= hit
+            for i in np.flatnonzero(~found).tolist():
+                vector = self._exact_vector(int(chunk_ids[i]))
+                if vector is None:
+                    return None
+                vectors[i] = vector
+            return vectors
+        if isinstance(self.index, faiss.IndexIDMap2):
+            return self.index.reconstruct_batch(chunk_ids)
+        return None
+
+    def matching_ids(self, metadata_filter: Dict[str, Any]) -> np.ndarray:
+        """
+        获取元数据满足过滤条件且未删除的文本块ID（供关键词检索等按相同条件过滤）
+
+        @param metadata_filter - {字段: 允许的值或值列表}
+        @returns 升序的文本块ID数组
+        """
+        return self._filter_selection(metadata_filter)[0]
+
+    def iter_texts(self):
+        """
+        按ID升序遍历所有未删除文本块的ID和文本（用于重建关键词索引）
+
+        @returns (ID, 文本) 的迭代器
+        """
+        for row in self._iter_live_rows():
+            yield row[0], row[4].decode("utf-8")
+
+    def _filter_selection(self, metadata_filter: Dict[str, Any]) -> tuple:
+        """
+        获取过滤条件匹配的ID和对应的FAISS选择器（带缓存）
+
+        @param metadata_filter - {字段: 允许的值或值列表}
+        @returns (升序的文本块ID数组, IDSelectorBatch)
+        """
+        key = self._group_key(metadata_filter)
+        cached = self._filter_cache.get(key)
+        if cached is not None:
+            self._filter_cache.move_to_end(key)
+            return cached
+        chunk_ids = self._matching_ids(metadata_filter)
+        cached = (chunk_ids, faiss.IDSelectorBatch(chunk_ids))
+        self._filter_cache[key] = cached
+        while len(self._filter_cache) > FILTER_CACHE_MAX:
+            self._filter_cache.popitem(last=False)
+        return cached
+
+    def _supports_selector(self) -> bool:
+        """
+        索引检索时是否支持 IDSelector
+
+        @remarks IVF、HNSW、Flat 和标量量化（SQ）支持；不带IVF的 IndexPQ 会拒绝检索参数
+        @returns 支持时返回True
+        """
+        if faiss.try_extract_index_ivf(self.index) is not None or self._hnsw_index() is not None:
+            return True
+        inner = faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap) else self.index
+        return isinstance(inner, (faiss.IndexFlat, faiss.IndexScalarQuantizer))
+
+    def _exact_search(self, query: np.ndarray, chunk_ids: np.ndarray, k: int) -> Optional[List[int]]:
+        """
+        分批取出向量并精确计算距离，只保留前k个
+
+        @param query - 查询向量
+        @param chunk_ids - 候选文本块ID
+        @param k - 返回的数量
+        @returns 按精确距离排序的ID列表，无法取出向量时返回None
+        """
+        best_ids = np.zeros(0, dtype=np.int64)
+        best_distances = np.zeros(0, dtype=np.float32)
+        for start in range(0, len(chunk_ids), FILTER_EXACT_BATCH):
+            batch_ids = chunk_ids[start:start + FILTER_EXACT_BATCH]
+            vectors = self._vectors_for(batch_ids)
+            if vectors is None:
+                return None
+            best_ids = np.concatenate([best_ids, batch_ids])
+            best_distances = np.concatenate([best_distances, ((vectors - query) ** 2).sum(axis=1)])
+            order = np.argsort(best_distances, kind="stable")[:k]
+            best_ids, best_distances = best_ids[order], best_distances[order]
+        return best_ids.tolist()
+
+    def _filtered_search(self, query: np.ndarray, k: int, metadata_filter: Dict[str, Any],
+                         rerank_factor: int) -> tuple:
+        """
+        只在元数据匹配的文本块中检索
+
+        @param query - 形状为 (1, dim) 的查询向量
+        @param k - 返回的文档数量
+        @param metadata_filter - {字段: 允许的值或值列表}
+        @param rerank_factor - 量化索引的精确重排倍数
+        @returns (候选ID列表, 是否已按精确距离排序)
+        """
+        chunk_ids, selector = self._filter_selection(metadata_filter)
+        if len(chunk_ids) == 0:
+            return [], True
+        supports_selector = self._supports_selector()
+        if len(chunk_ids) <= FILTER_BRUTE_FORCE_MAX or not supports_selector:
+            # 不支持选择器的索引（IDMap2,PQ）保存了原始向量，匹配较多时也分批精确计算
+            candidates = self._exact_search(query[0], chunk_ids, k)
+            if candidates is not None:
+                return candidates, True
+
+        fetch_k = min(k * max(rerank_factor, 1), len(chunk_ids))
+        # 按匹配比例放大 nprobe / efSearch，使访问到的匹配向量数量与不过滤时相当
+        fraction = len(chunk_ids) / max(self.index.ntotal, 1)
+        if not supports_selector:
+            # 取不出向量时退回：按匹配比例多取候选再过滤
+            _, ids = self.index.search(query, min(self.index.ntotal, math.ceil(fetch_k / fraction)))
+            return [chunk_id for chunk_id in ids[0].tolist() if chunk_id >= 0 and selector.is_member(chunk_id)], False
+        ivf = faiss.try_extract_index_ivf(self.index)
+        hnsw_index = self._hnsw_index()
+        if ivf is not None:
+            # 匹配的向量很少时扫描全部聚类（选择器先于距离计算，代价主要是ID判断）
+            nprobe = ivf.nlist if len(chunk_ids) <= FILTER_BRUTE_FORCE_MAX else min(
+                ivf.nlist, math.ceil(ivf.nprobe / fraction))
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+        elif hnsw_index is not None:
+            ef_search = min(self.index.ntotal, math.ceil(max(hnsw_index.hnsw.efSearch, fetch_k) / fraction))
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        _, ids = self.index.search(query, fetch_k, params=params)
+        return [chunk_id for chunk_id in ids[0].tolist() if chunk_id >= 0], False
+
+    def _exact_vector(self, chunk_id: int) -> Optional[np.ndarray]:
+        """
+        读取文本块的原始向量
+
+        @param chunk_id - 文本块ID
+        @returns float32向量，没有保存原始向量时返回None
+        """
+        position = self._tail_positions.get(chunk_id)
+        if position is not None:
+            return self._tail_vectors[position] if position < len(self._tail_vectors) else None
+        segment_index = int(np.searchsorted(self._segment_starts, chunk_id, side="right")) - 1
+        if segment_index < 0 or self._segments[segment_index].vectors is None:
+            return None
+        segment = self._segments[segment_index]
+        position = segment.find(chunk_id)
+        return segment.vectors[position] if position >= 0 else None
+
+    def _rerank(self, query: np.ndarray, candidates: List[int]) -> List[int]:
+        """
+        用原始向量计算候选结果的精确L2距离并重新排序
+
+        @param query - 查询向量
+        @param candidates - 索引返回的候选ID（按近似距离排序）
+        @returns 按精确距离排序的候选ID；缺少原始向量时保持原顺序
+        """
+        vectors = [self._exact_vector(chunk_id) for chunk_id in candidates]
+        if not vectors or any(vector is None for vector in vectors):
+            return candidates
+        distances = ((np.asarray(vectors, dtype=np.float32) - query) ** 2).sum(axis=1)
+        return [candidates[i] for i in np.argsort(distances, kind="stable")]
+
+    def _build_compacted_hnsw(self):
+        """
+        重建不含墓碑节点的HNSW图（只读取当前索引，不修改内存中的结构）
+
+        @returns 新的索引
+        """
+        id_map = faiss.vector_to_array(self.index.id_map)
+        live = ~np.isin(id_map, np.fromiter(self._index_tombstones, dtype=np.int64))
+        live_ids = id_map[live]
+        exact = [self._exact_vector(chunk_id) for chunk_id in live_ids.tolist()] if self._keeps_vectors() else []
+        if exact and all(vector is not None for vector in exact):
+            # 量化索引优先使用原始向量，避免反复量化累积误差
+            vectors = np.asarray(exact, dtype=np.float32)
+        else:
+            vectors = self.index.index.reconstruct_n(0, self.index.ntotal)[live]
+        index = faiss.index_factory(self.dim, self.index_spec)
+        if not index.is_trained:
+            rng = np.random.default_rng(0)
+            sample_size = min(len(vectors), 256 * IVF_MAX_TRAIN_POINTS_PER_LIST)
+            index.train(vectors[rng.choice(len(vectors), sample_size, replace=False)])
+        index.add_with_ids(vectors, live_ids)
+        return index
+
+    def _segment_rows(self) -> int:
+        """
+        段中的总行数（包括已删除的行）
+
+        @returns 行数
+        """
+        return sum(len(segment) for segment in self._segments)
+
+    def _iter_live_rows(self):
+        """
+        按ID升序遍历所有未删除的行（段和内存尾部）
+
+        @returns (ID, 分组号, 起始行, 结束行, 文本字节, 原始向量或None) 的迭代器
+        """
+        for segment in self._segments:
+            for position, chunk_id in enumerate(segment.ids.tolist()):
+                if chunk_id not in self._deleted:
+                    yield (chunk_id, int(segment.groups[position]), int(segment.row_start[position]),
+                           int(segment.row_end[position]), segment.text_bytes(position),
+                           segment.vectors[position] if segment.vectors is not None else None)
+        yield from self._iter_live_tail()
+
+    def _iter_live_tail(self):
+        """
+        遍历内存尾部中未删除的行
+
+        @returns (ID, 分组号, 起始行, 结束行, 文本字节, 原始向量或None) 的迭代器
+        """
+        keep_vectors = len(self._tail_vectors) == len(self._tail_ids)
+        for position, chunk_id in enumerate(self._tail_ids):
+            if chunk_id not in self._deleted:
+                yield (chunk_id, self._tail_groups[position], self._tail_row_start[position],
+                       self._tail_row_end[position], self._tail_texts[position],
+                       self._tail_vectors[position] if keep_vectors else None)
+
+    @staticmethod
+    def _write_rows(directory: Path, rows: Iterable[tuple]) -> Optional[str]:
+        """
+        把行写成一个新的段
+
+        @param directory - 存储目录
+        @param rows - (ID, 分组号, 起始行, 结束行, 文本字节, 原始向量或None) 的可迭代对象
+        @returns 段目录名，没有行时返回None
+        """
+        name = f"seg-{uuid.uuid4().hex}"
+        if _Segment.write(directory, name, rows) == 0:
+            shutil.rmtree(directory / name)
+            return None
+        return name
+
+    def save(self, directory: Path):
+        """
+        持久化到目录：内存尾部写成新段，必要时合并压缩所有段，再原子地替换清单
+
+        @remarks 段和索引文件每次都使用新文件名，不会覆盖仍在被内存映射的文件；
+                 清单替换后再清理不再引用的旧文件，清理失败（如Windows下文件仍被映射）时留待下次保存。
+                 需要在写文件期间继续检索时，依次调用 finalize()、write_files()、apply_saved_files()
+        @param directory - 存储目录
+        @returns 无返回值
+        """
+        self.finalize()
+        self.apply_saved_files(directory, self.write_files(directory))
+
+    def write_files(self, directory: Path) -> Dict[str, Any]:
+        """
+        写入新段、索引文件和清单，不修改内存中的结构
+
+        @remarks 写文件期间可以与检索并发执行，但不能有增删；调用前需先调用 finalize()
+        @param directory - 存储目录
+        @returns 写入结果，传给 apply_saved_files()
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        index, index_spec = self.index, self.index_spec
+        if index is None:
+            # 索引类型尚未确定且从未添加过向量
+            index_spec = FLAT_INDEX_SPEC
+            index = faiss.index_factory(self.dim, FLAT_INDEX_SPEC)
+        rebuilt = self._index_tombstones and len(self._index_tombstones) > COMPACT_DEAD_RATIO * index.ntotal
+        if rebuilt:
+            index = self._build_compacted_hnsw()
+
+        segment_rows = self._segment_rows()
+        segment_deleted = len(self._deleted.difference(self._tail_positions))
+        compact = len(self._segments) >= MAX_SEGMENTS or (
+            segment_rows > 0 and segment_deleted > COMPACT_DEAD_RATIO * segment_rows
+        )
+
+        if compact:
+            new_name = self._write_rows(directory, self._iter_live_rows())
+            segment_names = [new_name] if new_name else []
+            deleted = set()
+        else:
+            new_name = self._write_rows(directory, self._iter_live_tail())
+            segment_names = [segment.name for segment in self._segments] + ([new_name] if new_name else [])
+            deleted = self._deleted.difference(self._tail_positions)
+
+        token = uuid.uuid4().hex
+        index_file = f"vectors-{token}.faiss"
+        deleted_file = f"deleted-{token}.npy"
+        tombstones_file = f"tombstones-{token}.npy"
+        faiss.write_index(index, str(directory / index_file))
+        np.save(directory / deleted_file, np.asarray(sorted(deleted), dtype=np.int64))
+        np.save(directory / tombstones_file,
+                np.asarray([] if rebuilt else sorted(self._index_tombstones), dtype=np.int64))
+
+        manifest = {
+            "format": STORE_FORMAT_VERSION,
+            "dim": self.dim,
+            "next_id": self._next_id,
+            "index_spec": index_spec,
+            "quantization": self.quantization,
+            "index_file": index_file,
+            "deleted_file": deleted_file,
+            "tombstones_file": tombstones_file,
+            "segments": segment_names,
+            "groups": self._groups
+        }
+        temp_path = directory / f"{MANIFEST_NAME}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, default=str)
+        os.replace(temp_path, directory / MANIFEST_NAME)
+        return {
+            "index": index if index is not self.index else None,
+            "index_spec": index_spec,
+            "rebuilt": bool(rebuilt),
+            "segment_names": segment_names,
+            "deleted": deleted,
+            "referenced": set(segment_names) | {index_file, deleted_file, tombstones_file, MANIFEST_NAME}
+        }
+
+    def apply_saved_files(self, directory: Path, written: Dict[str, Any]):
+        """
+        切换到刚写入的文件：新段改为内存映射、释放内存尾部，并清理不再引用的旧文件
+
+        @remarks 修改内存中的结构，调用方需保证期间没有检索
+        @param directory - 存储目录
+        @param written - write_files() 的返回值
+        @returns 无返回值
+        """
+        directory = Path(directory)
+        if written["index"] is not None:
+            self.index = written["index"]
+            self.index_spec = written["index_spec"]
+        if written["rebuilt"]:
+            self._index_tombstones = set()
+            self._tombstone_selector = None
+            self.configure_search(**self._search_params)
+
+        # 新写入的段改为内存映射，释放内存尾部
+        kept = {segment.name: segment for segment in self._segments}
+        self._segments = [kept.get(name) or _Segment(directory, name) for name in written["segment_names"]]
+        self._segment_starts = [int(segment.ids[0]) for segment in self._segments]
+        self._deleted = written["deleted"]
+        self._reset_tail()
+
+        self._remove_unreferenced(directory, written["referenced"])
+
+    @staticmethod
+    def _remove_unreferenced(directory: Path, referenced: set):
+        """
+        删除目录中不再被清单引用的文件和段
+
+        @param directory - 存储目录
+        @param referenced - 仍被引用的文件名
+        @returns 无返回值
+        """
+        for path in directory.iterdir():
+            if path.name in referenced:
+                continue
+            try:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+            except OSError:
+                pass
+
+    @classmethod
+    def load(cls, directory: Path) -> Optional["ChunkVectorStore"]:
+        """
+        从目录加载向量库
+
+        @param directory - 存储目录
+        @returns 向量库，目录中没有清单时返回None
+        """
+        directory = Path(directory)
+        manifest_path = directory / MANIFEST_NAME
+        if not manifest_path.exists():
+            return None
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != STORE_FORMAT_VERSION:
+            raise ValueError(f"不支持的向量库格式版本: {manifest.get('format')}")
+
+        tombstones_file = manifest.get("tombstones_file")
+        return cls(
+            manifest["dim"],
+            index=faiss.read_index(str(directory / manifest["index_file"])),
+            segments=[_Segment(directory, name) for name in manifest["segments"]],
+            groups=manifest["groups"],
+            deleted=np.load(directory / manifest["deleted_file"]).tolist(),
+            next_id=manifest["next_id"],
+            index_spec=manifest.get("index_spec", FLAT_INDEX_SPEC),
+            quantization=manifest.get("quantization", "none"),
+            index_tombstones=np.load(directory / tombstones_file).tolist() if tombstones_file else None
+        )
+
+    def _index_bytes(self) -> int:
+        """
+        估算索引常驻内存的字节数（向量编码，不含图结构和倒排列表的额外开销）
+
+        @returns 字节数
+        """
+        if self.index is None:
+            return 0
+        base = faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap) else self.index
+        ivf = faiss.try_extract_index_ivf(base)
+        if ivf is not None:
+            code_size = ivf.code_size
+        elif isinstance(base, faiss.IndexHNSW):
+            code_size = faiss.downcast_index(base.storage).sa_code_size()
+        else:
+            code_size = base.sa_code_size()
+        return int(self.index.ntotal * (code_size + 8))
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        获取存储统计
+
+        @returns 包含向量数、索引内存、段数、墓碑数和文本字节数的字典
+        """
+        return {
+            "vectors": self.ntotal,
+            "index_spec": self.index_spec,
+            "index_bytes": self._index_bytes(),
+            "exact_vector_bytes": sum(segment.vectors.nbytes for segment in self._segments
+                                      if segment.vectors is not None),
+            "nprobe": self._search_params["nprobe"],
+            "ef_search": self._search_params["ef_search"],
+            "rerank_factor": self._search_params["rerank_factor"],
+            "index_tombstones": len(self._index_tombstones),
+            "segments": len(self._segments),
+            "segment_rows": self._segment_rows(),
+            "pending_rows": len(self._tail_ids),
+            "deleted_rows": len(self._deleted),
+            "text_bytes": sum(len(segment.text) for segment in self._segments)
+        }